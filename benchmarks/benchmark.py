@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+
+"""Offline benchmark of pyclowder extractors.
+
+This runs one of the sample extractors against a fake clowder server and an
+in memory stand-in for RabbitMQ, all in this process, so no clowder or
+RabbitMQ instance is needed. Messages are published at a fixed rate (or as
+fast as the extractor takes them) and the time from publishing a message to
+the ack is measured. The results are printed as JSON, for example:
+
+    python benchmarks/benchmark.py --extractor wordcount --messages 500 --file-size 100000
+"""
+
+import argparse
+import collections
+import imp
+import io
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pyclowder.metrics  # noqa: E402 pylint: disable=wrong-import-position
+import pyclowder.utils  # noqa: E402 pylint: disable=wrong-import-position
+
+
+class FakeClowder(ThreadingMixIn, HTTPServer):
+    """Fake clowder server implementing the endpoints used by files, datasets and geostreams.
+
+    Every file has file_size bytes of text, every dataset has dataset_files files. All
+    metadata and datapoints that are posted are counted, but not stored, except for the
+    datapoints which can be read back.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, file_size=1024, dataset_files=5):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeClowderHandler)
+        self.file_size = file_size
+        self.dataset_files = dataset_files
+        words = b"the quick brown fox jumps over the lazy dog\n"
+        self.content = (words * (file_size // len(words) + 1))[:file_size]
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.sensors = []
+        self.streams = []
+        self.datapoints = []
+        self.dataset_zip = self._create_zip()
+        self.thread = threading.Thread(target=self.serve_forever, name="FakeClowder")
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server_address
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _create_zip(self):
+        """Create the zip file returned when downloading a dataset."""
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as dszip:
+            for i in range(self.dataset_files):
+                dszip.writestr("dataset/data/file-%d.txt" % i, self.content)
+                dszip.writestr("dataset/data/file-%d.txt_metadata.json" % i, "[]")
+            dszip.writestr("dataset/_info.json", "{}")
+        return buf.getvalue()
+
+
+class FakeClowderHandler(BaseHTTPRequestHandler):
+    """Request handler of the FakeClowder."""
+
+    protocol_version = "HTTP/1.1"
+    # the headers are written one at a time, without this each response waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    routes = [
+        ('GET', r'api/files/([^/]+)/metadata$', 'file_info'),
+        ('GET', r'api/files/([^/]+)/metadata.jsonld$', 'empty_list'),
+        ('POST', r'api/files/([^/]+)/metadata.jsonld$', 'ok'),
+        ('GET', r'api/files/([^/]+)$', 'file_blob'),
+        ('GET', r'api/datasets/([^/]+)/listFiles$', 'dataset_files'),
+        ('GET', r'api/datasets/([^/]+)/download$', 'dataset_zip'),
+        ('GET', r'api/datasets/([^/]+)/metadata.jsonld$', 'empty_list'),
+        ('POST', r'api/datasets/([^/]+)/metadata.jsonld$', 'ok'),
+        ('GET', r'api/datasets/([^/]+)$', 'dataset_info'),
+        ('POST', r'api/extractors$', 'ok'),
+        ('GET', r'api/geostreams/sensors$', 'sensors'),
+        ('POST', r'api/geostreams/sensors$', 'create_sensor'),
+        ('GET', r'api/geostreams/streams$', 'streams'),
+        ('POST', r'api/geostreams/streams$', 'create_stream'),
+        ('GET', r'api/geostreams/datapoints$', 'datapoints'),
+        ('POST', r'api/geostreams/datapoints$', 'create_datapoint'),
+        ('POST', r'api/geostreams/datapoints/bulk$', 'create_datapoints'),
+    ]
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._route('GET')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self._route('POST')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _route(self, method):
+        path = urlparse(self.path).path.lstrip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        for (route_method, pattern, name) in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                with self.server.lock:
+                    self.server.requests[name] += 1
+                getattr(self, name)(body, *match.groups())
+                return
+        self._send(404, b'not found', 'text/plain')
+
+    def _send(self, status, data, content_type='application/json'):
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def ok(self, body, *args):  # pylint: disable=unused-argument
+        self._send(200, {"status": "OK"})
+
+    def empty_list(self, body, *args):  # pylint: disable=unused-argument
+        self._send(200, [])
+
+    def file_info(self, body, fileid):  # pylint: disable=unused-argument
+        self._send(200, {"id": fileid, "filename": "file-%s.txt" % fileid, "size": self.server.file_size,
+                         "content-type": "text/plain"})
+
+    def file_blob(self, body, fileid):  # pylint: disable=unused-argument
+        self._send(200, self.server.content, 'text/plain')
+
+    def dataset_info(self, body, datasetid):  # pylint: disable=unused-argument
+        self._send(200, {"id": datasetid, "name": "dataset-%s" % datasetid})
+
+    def dataset_files(self, body, datasetid):  # pylint: disable=unused-argument
+        self._send(200, [{"id": "%s-%d" % (datasetid, i), "filename": "file-%d.txt" % i,
+                          "size": self.server.file_size, "contentType": "text/plain"}
+                         for i in range(self.server.dataset_files)])
+
+    def dataset_zip(self, body, datasetid):  # pylint: disable=unused-argument
+        self._send(200, self.server.dataset_zip, 'application/zip')
+
+    def sensors(self, body):  # pylint: disable=unused-argument
+        self._send(200, self.server.sensors)
+
+    def create_sensor(self, body):
+        with self.server.lock:
+            sensor = json.loads(body.decode('utf-8'))
+            sensor['id'] = len(self.server.sensors) + 1
+            self.server.sensors.append(sensor)
+        self._send(200, {"id": sensor['id']})
+
+    def streams(self, body):  # pylint: disable=unused-argument
+        self._send(200, self.server.streams)
+
+    def create_stream(self, body):
+        with self.server.lock:
+            stream = json.loads(body.decode('utf-8'))
+            stream['id'] = len(self.server.streams) + 1
+            self.server.streams.append(stream)
+        self._send(200, {"id": stream['id']})
+
+    def datapoints(self, body):  # pylint: disable=unused-argument
+        self._send(200, self.server.datapoints)
+
+    def create_datapoint(self, body):
+        self.create_datapoints(b'[' + body + b']')
+
+    def create_datapoints(self, body):
+        with self.server.lock:
+            datapoints = json.loads(body.decode('utf-8'))
+            for datapoint in datapoints:
+                datapoint['id'] = len(self.server.datapoints) + 1
+                self.server.datapoints.append(datapoint)
+        self._send(200, {"id": datapoints[-1]['id'] if datapoints else None, "count": len(datapoints)})
+
+
+class FakeBroker(object):
+    """In memory stand-in for the pika connection and channel used by RabbitMQConnector.
+
+    Messages published with publish are delivered to the consumer, keeping at most
+    prefetch_count messages unacked, from process_data_events just like pika does.
+    The time each message is acked is recorded.
+    """
+
+    def __init__(self):
+        self.connection = self
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.pending = collections.deque()
+        self.unacked = dict()
+        self.callbacks = list()
+        self.prefetch_count = 0
+        self.consumer = None
+        self._consumer_infos = dict()
+        self.next_tag = 1
+        self.latencies = list()
+        self.published = collections.Counter()
+
+    # connection
+    def process_data_events(self, time_limit=0):
+        self.event.wait(time_limit)
+        self.event.clear()
+        while True:
+            with self.lock:
+                callbacks = self.callbacks
+                self.callbacks = list()
+                message = None
+                if self.consumer and self.pending and \
+                        (not self.prefetch_count or len(self.unacked) < self.prefetch_count):
+                    message = self.pending.popleft()
+                    tag = self.next_tag
+                    self.next_tag += 1
+                    self.unacked[tag] = message[0]
+            for callback in callbacks:
+                callback()
+            if message is None:
+                if not callbacks:
+                    return
+                continue
+            method = _Method(tag, message[1])
+            self.consumer(self, method, _Header(), message[2])
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+        self.event.set()
+
+    def channel(self):
+        return self
+
+    def close(self):
+        pass
+
+    # channel
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    def queue_declare(self, **kwargs):
+        pass
+
+    def exchange_declare(self, **kwargs):
+        pass
+
+    def queue_bind(self, **kwargs):
+        pass
+
+    def basic_consume(self, consumer, queue=None, no_ack=False):  # pylint: disable=unused-argument
+        self.consumer = consumer
+        self._consumer_infos['benchmark'] = consumer
+        return 'benchmark'
+
+    def stop_consuming(self, consumer_tag=None):  # pylint: disable=unused-argument
+        self._consumer_infos.clear()
+        self.event.set()
+
+    def basic_ack(self, delivery_tag):
+        now = time.time()
+        with self.lock:
+            published = self.unacked.pop(delivery_tag)
+            self.latencies.append(now - published)
+        self.event.set()
+
+    def basic_publish(self, exchange, routing_key, properties=None, body=None):  # pylint: disable=unused-argument
+        if routing_key.startswith('error.'):
+            self.published['error'] += 1
+        elif routing_key == 'reply':
+            self.published['status'] += 1
+        else:
+            self.published['resubmit'] += 1
+
+    # producer
+    def publish(self, routing_key, body):
+        with self.lock:
+            self.pending.append((time.time(), routing_key, body))
+        self.event.set()
+
+
+class _Method(object):
+    def __init__(self, delivery_tag, routing_key):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+        self.exchange = 'clowder'
+
+
+class _Header(object):
+    reply_to = 'reply'
+    correlation_id = 'benchmark'
+
+
+def load_extractor(name, args):
+    """Create an instance of one of the sample extractors, or of the extractor in a script."""
+    if name.endswith('.py'):
+        script = os.path.abspath(name)
+        name = os.path.splitext(os.path.basename(script))[0]
+    else:
+        script = os.path.join(ROOT, 'sample-extractors', name, name + '.py')
+    module = imp.load_source('benchmark_' + name, script)
+    classes = [c for c in vars(module).values()
+               if isinstance(c, type) and c.__module__ == module.__name__ and hasattr(c, 'process_message')]
+    # the extractor reads extractor_info.json and the command line when it is created
+    sys.argv = [script] + args
+    return classes[0]()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss():
+    """Return the peak resident memory of this process and its children in bytes."""
+    if resource is None:
+        return pyclowder.utils.get_rss()
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def run(options):
+    """Run a single benchmark and return the results."""
+    server = FakeClowder(file_size=options.file_size, dataset_files=options.dataset_files)
+    server.start()
+    broker = FakeBroker()
+
+    extractor = load_extractor(options.extractor, ['--max-inflight', str(options.max_inflight),
+                                                   '--workers-mode', options.workers_mode])
+    logging.getLogger().setLevel(options.log_level)
+    logging.getLogger('pyclowder').setLevel(options.log_level)
+    logging.getLogger('__main__').setLevel(options.log_level)
+    logging.getLogger('benchmark_' + options.extractor).setLevel(options.log_level)
+    pyclowder.metrics.registry.reset()
+
+    session_pool = pyclowder.utils.SessionPool()
+    connector = extractor._create_rabbitmq_connector(session_pool, None)  # pylint: disable=protected-access
+    # this is what connect does, using the fake broker instead of pika
+    connector.connection = broker
+    connector.channel = broker.channel()
+    connector.channel.basic_qos(prefetch_count=connector.max_inflight)
+    listener = threading.Thread(target=connector.listen, name="Benchmark-listener")
+    listener.start()
+
+    if options.resource == 'dataset':
+        routing_key = 'clowder.dataset.file.added'
+    else:
+        routing_key = 'clowder.file.text.plain'
+
+    start = time.time()
+    for i in range(options.messages):
+        if options.rate:
+            delay = start + i / float(options.rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        body = {
+            'host': server.url,
+            'secretKey': 'benchmark',
+            'id': 'file%d' % i,
+            'intermediateId': 'file%d' % i,
+            'datasetId': 'dataset%d' % i,
+            'filename': 'file%d.txt' % i,
+            'fileSize': options.file_size,
+            'routing_key': routing_key
+        }
+        broker.publish(routing_key, json.dumps(body))
+
+    while len(broker.latencies) < options.messages:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+
+    broker.add_callback_threadsafe(connector.stop)
+    listener.join()
+    session_pool.close()
+    server.stop()
+
+    latencies = broker.latencies
+    counters = pyclowder.metrics.registry.snapshot()['counters']
+    return {
+        'extractor': options.extractor,
+        'resource': options.resource,
+        'messages': options.messages,
+        'rate': options.rate,
+        'file_size': options.file_size,
+        'max_inflight': options.max_inflight,
+        'workers_mode': options.workers_mode,
+        'elapsed': elapsed,
+        'messages_per_second': options.messages / elapsed,
+        'latency': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies)
+        },
+        'peak_rss_bytes': peak_rss(),
+        'outcomes': dict((dict(key[1])['outcome'], value) for key, value in counters.items()
+                         if key[0] == 'pyclowder_messages_total'),
+        'requests': dict(server.requests)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a sample extractor using a fake clowder and RabbitMQ.')
+    parser.add_argument('--extractor', default='wordcount', choices=['wordcount', 'echo'],
+                        help='sample extractor to run (default=wordcount)')
+    parser.add_argument('--resource', default='file', choices=['file', 'dataset'],
+                        help='type of messages to send (default=file)')
+    parser.add_argument('--messages', type=int, default=200,
+                        help='number of messages to send (default=200)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second to send, 0 sends them all at once (default=0)')
+    parser.add_argument('--file-size', type=int, default=1024,
+                        help='size in bytes of the files served by the fake clowder (default=1024)')
+    parser.add_argument('--dataset-files', type=int, default=5,
+                        help='number of files in each dataset (default=5)')
+    parser.add_argument('--max-inflight', type=int, default=1,
+                        help='number of messages processed at the same time (default=1)')
+    parser.add_argument('--workers-mode', default='thread', choices=['thread', 'process'],
+                        help='process messages in a thread or in a separate process (default=thread)')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='log level used while running the benchmark (default=WARNING)')
+    parser.add_argument('--output', '-o',
+                        help='append the results as a line of JSON to this file instead of printing them')
+    options = parser.parse_args()
+
+    results = run(options)
+    if options.output:
+        with open(options.output, 'a') as out:
+            out.write(json.dumps(results, sort_keys=True) + '\n')
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
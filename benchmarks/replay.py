@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""Replay recorded messages against an extractor.
+
+Messages recorded by an extractor started with --record-messages are
+published again to the extractor, using the in memory stand-in for RabbitMQ
+of benchmark.py. By default the messages are sent to the fake clowder server
+of benchmark.py, use --host and --key to send them to a test instance of
+clowder instead. The messages are replayed with the timing they were recorded
+with (optionally faster or slower), at a fixed rate or as fast as the
+extractor takes them. The results are printed as JSON, for example:
+
+    python benchmarks/replay.py --extractor wordcount --speed 10 messages.jsonl
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+# benchmark.py adds the root of the repository to the path
+from benchmark import FakeBroker, FakeClowder, load_extractor, peak_rss, percentile
+
+import pyclowder.metrics
+import pyclowder.utils
+from pyclowder.recording import read_messages
+
+
+def run(options):
+    """Replay the recorded messages and return the results."""
+    messages = list(read_messages(options.messages))
+    if options.limit:
+        messages = messages[:options.limit]
+    if not messages:
+        raise ValueError("No messages found in %s" % options.messages)
+
+    server = None
+    host = options.host
+    if not host:
+        server = FakeClowder(file_size=options.file_size, dataset_files=options.dataset_files)
+        server.start()
+        host = server.url
+    broker = FakeBroker()
+
+    extractor = load_extractor(options.extractor, ['--max-inflight', str(options.max_inflight),
+                                                   '--workers-mode', options.workers_mode])
+    logging.getLogger().setLevel(options.log_level)
+    logging.getLogger('pyclowder').setLevel(options.log_level)
+    pyclowder.metrics.registry.reset()
+
+    session_pool = pyclowder.utils.SessionPool()
+    connector = extractor._create_rabbitmq_connector(session_pool, None)  # pylint: disable=protected-access
+    # this is what connect does, using the fake broker instead of pika
+    connector.connection = broker
+    connector.channel = broker.channel()
+    connector.channel.basic_qos(prefetch_count=connector.max_inflight)
+    listener = threading.Thread(target=connector.listen, name="Replay-listener")
+    listener.start()
+
+    start = time.time()
+    first = messages[0][0]
+    for i, (recorded, routing_key, body) in enumerate(messages):
+        if options.rate:
+            delay = start + i / float(options.rate) - time.time()
+        elif options.speed:
+            delay = start + (recorded - first) / options.speed - time.time()
+        else:
+            delay = 0
+        if delay > 0:
+            time.sleep(delay)
+        body = dict(body)
+        body['host'] = host
+        body['secretKey'] = options.key
+        broker.publish(routing_key, json.dumps(body))
+
+    while len(broker.latencies) < len(messages):
+        time.sleep(0.01)
+    elapsed = time.time() - start
+
+    broker.add_callback_threadsafe(connector.stop)
+    listener.join()
+    session_pool.close()
+    if server:
+        server.stop()
+
+    latencies = broker.latencies
+    counters = pyclowder.metrics.registry.snapshot()['counters']
+    return {
+        'extractor': options.extractor,
+        'messages': len(messages),
+        'recorded_seconds': messages[-1][0] - first,
+        'speed': options.speed,
+        'rate': options.rate,
+        'max_inflight': options.max_inflight,
+        'workers_mode': options.workers_mode,
+        'elapsed': elapsed,
+        'messages_per_second': len(messages) / elapsed,
+        'latency': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies)
+        },
+        'peak_rss_bytes': peak_rss(),
+        'outcomes': dict((dict(key[1])['outcome'], value) for key, value in counters.items()
+                         if key[0] == 'pyclowder_messages_total'),
+        'requests': dict(server.requests) if server else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay messages recorded with --record-messages.')
+    parser.add_argument('messages',
+                        help='JSON Lines file with the recorded messages')
+    parser.add_argument('--extractor', default='wordcount',
+                        help='name of a sample extractor, or the python script of an extractor (default=wordcount)')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='replay the messages this many times faster than recorded, 0 sends them all at once '
+                             '(default=1)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='send this many messages per second instead of using the recorded timing (default=0)')
+    parser.add_argument('--limit', type=int, default=0,
+                        help='only replay the first messages, 0 replays all messages (default=0)')
+    parser.add_argument('--host',
+                        help='clowder to send the messages to, by default the fake clowder of benchmark.py is used')
+    parser.add_argument('--key', default='replay',
+                        help='secret key used to access clowder (default=replay)')
+    parser.add_argument('--file-size', type=int, default=1024,
+                        help='size in bytes of the files served by the fake clowder (default=1024)')
+    parser.add_argument('--dataset-files', type=int, default=5,
+                        help='number of files in each dataset of the fake clowder (default=5)')
+    parser.add_argument('--max-inflight', type=int, default=1,
+                        help='number of messages processed at the same time (default=1)')
+    parser.add_argument('--workers-mode', default='thread', choices=['thread', 'process'],
+                        help='process messages in a thread or in a separate process (default=thread)')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='log level used while replaying the messages (default=WARNING)')
+    parser.add_argument('--output', '-o',
+                        help='append the results as a line of JSON to this file instead of printing them')
+    options = parser.parse_args()
+
+    results = run(options)
+    if options.output:
+        with open(options.output, 'a') as out:
+            out.write(json.dumps(results, sort_keys=True) + '\n')
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -136,6 +136,9 @@ def setup_commands(parser):
     parser.add_argument('--clowder-password', dest='password',
             default=os.environ.get('CLOWDER_PASSWORD', ''),
             help='Clowder password (Env: CLOWDER_PASSWORD)')
+    parser.add_argument('--index-file', dest='index_file',
+            default=os.environ.get('CLOWDER_INDEX_FILE'),
+            help='file used to store dataset and file ids between runs (Env: CLOWDER_INDEX_FILE)')
     subparsers = parser.add_subparsers()
 
     #datasets
@@ -241,8 +244,9 @@ def main():
     setup_commands(parser) 
     args = parser.parse_args()
 
-    clowder = Clowder(url=args.url, auth=(args.login, args.password))
-    args_operation(args, clowder)
+    with Clowder(url=args.url, auth=(args.login, args.password),
+                 index_file=args.index_file) as clowder:
+        args_operation(args, clowder)
 
         
 if __name__ == '__main__':
@@ -0,0 +1,326 @@
+"""Clowder Cache
+
+This module contains caches that can be used by the connectors to avoid
+fetching the same data from clowder more than once. The DownloadCache
+keeps a copy of downloaded files on the local disk, so that retries and
+other extractors running on the same node can reuse them. The ResponseCache
+keeps the JSON responses of clowder in memory for a short time.
+"""
+
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+# file locking is only available on unix systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DownloadCache(object):
+    """On-disk cache of files downloaded from clowder.
+
+    Files are stored in cache_dir, named by file id and size, and are handed out
+    read-only. Once the total size of the cache is more than max_bytes the least
+    recently used files are removed. The cache can be shared by multiple threads
+    and processes on the same node, a file is only downloaded once and a file is
+    never removed while it is in use. The size of the cache is checked after every
+    download, and at most every scan_interval seconds when a cached file is used,
+    to notice files added by other processes.
+
+    Every path returned by get must be released using release once it is no longer
+    needed.
+
+    Keyword arguments:
+    cache_dir -- folder used to store the cached files, will be created if needed
+    max_bytes -- maximum size of all files in the cache
+    min_age -- files accessed less than min_age seconds ago are never removed
+    scan_interval -- minimum number of seconds between size checks if nothing was downloaded
+    """
+
+    lock_ext = ".lock"
+
+    def __init__(self, cache_dir, max_bytes, min_age=60, scan_interval=60):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.scan_interval = scan_interval
+        self.last_scan = 0
+        self.locks = dict()
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by somebody else
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def get(self, fileid, size, ext, download):
+        """Return the path to the cached copy of the file, downloading it if needed.
+
+        Keyword arguments:
+        fileid -- id of the file in clowder
+        size -- size of the file, part of the key to detect changed files
+        ext -- the file extension, the cached file will end with this extension
+        download -- function without arguments that downloads the file and returns the path
+        """
+        logger = logging.getLogger(__name__)
+        path = os.path.join(self.cache_dir, "%s_%s%s" % (fileid, size, ext))
+
+        downloaded = False
+        # only one thread or process downloads the file, all others wait
+        lockfd = self._lock_entry(path, True)
+        try:
+            if os.path.isfile(path):
+                logger.debug("[%s] : found in download cache", fileid)
+                os.utime(path, None)
+            else:
+                downloaded = True
+                tmp_path = download()
+                try:
+                    (fd, cache_tmp) = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+                    os.close(fd)
+                    shutil.move(tmp_path, cache_tmp)
+                    os.chmod(cache_tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    os.rename(cache_tmp, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            # keep a shared lock while the file is in use
+            self._flock(lockfd, False)
+        except Exception:
+            os.close(lockfd)
+            raise
+
+        with self.lock:
+            self.locks.setdefault(path, []).append(lockfd)
+
+        self._evict(downloaded)
+        return path
+
+    def contains(self, path):
+        """Return True if path is a file in the cache."""
+        return os.path.dirname(os.path.abspath(path)) == self.cache_dir
+
+    def release(self, path):
+        """Release a path returned by get so it can be removed from the cache."""
+        with self.lock:
+            lockfds = self.locks.get(path)
+            if not lockfds:
+                return
+            lockfd = lockfds.pop()
+            if not lockfds:
+                del self.locks[path]
+        # closing the file will also release the lock
+        os.close(lockfd)
+
+    def _lock_entry(self, path, exclusive, blocking=True):
+        """Open and lock the lock file of a cached file, returns the file descriptor.
+
+        Returns None if blocking is False and the file is already locked. The lock file
+        can be removed by _evict while waiting for the lock, in that case the new lock
+        file is locked instead.
+        """
+        lockpath = path + DownloadCache.lock_ext
+        while True:
+            lockfd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                locked = self._flock(lockfd, exclusive, blocking)
+                if locked and self._is_current(lockfd, lockpath):
+                    return lockfd
+            except Exception:
+                os.close(lockfd)
+                raise
+            os.close(lockfd)
+            if not locked:
+                return None
+
+    # pylint: disable=no-self-use
+    def _is_current(self, fd, path):
+        """Return True if fd is the file at path, and not a file that was removed."""
+        try:
+            info = os.stat(path)
+        except OSError:
+            return False
+        fdinfo = os.fstat(fd)
+        return (info.st_dev, info.st_ino) == (fdinfo.st_dev, fdinfo.st_ino)
+
+    def _evict(self, force=False):
+        """Remove the least recently used files until the cache fits in max_bytes.
+
+        Unless force is True the cache is checked at most every scan_interval seconds.
+        """
+        logger = logging.getLogger(__name__)
+
+        now = time.time()
+        if not force and now - self.last_scan < self.scan_interval:
+            return
+        self.last_scan = now
+
+        evictfd = os.open(os.path.join(self.cache_dir, DownloadCache.lock_ext), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._flock(evictfd, True)
+
+            entries = []
+            total = 0
+            names = os.listdir(self.cache_dir)
+            for name in names:
+                if name.endswith(DownloadCache.lock_ext):
+                    # lock file left behind by a download that failed
+                    path = name[:-len(DownloadCache.lock_ext)]
+                    if path and path not in names:
+                        self._remove_entry(os.path.join(self.cache_dir, path), False)
+                    continue
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+            if total <= self.max_bytes:
+                return
+
+            for (mtime, size, path) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if now - mtime < self.min_age:
+                    break
+                if self._remove_entry(path, True):
+                    total -= size
+                    logger.debug("removed %s from download cache", path)
+        finally:
+            os.close(evictfd)
+
+    def _remove_entry(self, path, remove_file):
+        """Remove the lock file, and the cached file if remove_file is True, unless it is in use.
+
+        The lock file is removed while it is locked, anybody waiting for it will notice it
+        was removed and create a new one. Returns True if the entry was removed.
+        """
+        lockpath = path + DownloadCache.lock_ext
+        try:
+            lockfd = self._lock_entry(path, True, blocking=False)
+        except OSError:
+            logging.getLogger(__name__).exception("Error locking %s in download cache", path)
+            return False
+        if lockfd is None:
+            # file is in use
+            return False
+        try:
+            if remove_file:
+                os.remove(path)
+            elif os.path.exists(path):
+                # downloaded after the folder was listed
+                return False
+            os.remove(lockpath)
+            return True
+        except OSError:
+            logging.getLogger(__name__).exception("Error removing %s from download cache", path)
+            return False
+        finally:
+            os.close(lockfd)
+
+    # pylint: disable=no-self-use
+    def _flock(self, fd, exclusive, blocking=True):
+        """Lock the file, returns False if blocking is False and the file is already locked."""
+        if fcntl is None:
+            return True
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except IOError:
+            if blocking:
+                raise
+            return False
+        return True
+
+
+class ResponseCache(object):
+    """In memory cache of JSON responses from clowder.
+
+    Responses are reused for ttl seconds. After that the response is fetched again,
+    using a conditional request if clowder returned an ETag or Last-Modified header,
+    so an unchanged response does not need to be sent again. Entries can be tagged
+    (for example with the id of the dataset) so they can be invalidated when the
+    resource is changed.
+
+    Keyword arguments:
+    ttl -- number of seconds a response is reused, 0 disables the cache
+    max_entries -- maximum number of responses kept, the oldest are removed first
+    """
+
+    def __init__(self, ttl=10, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    def get(self, connector, url, tag=None, use_cache=True, **kwargs):
+        """Return the parsed JSON response of a GET request, using the cached response if possible.
+
+        Keyword arguments:
+        connector -- connector used to send the request
+        url -- the url to fetch
+        tag -- (optional) tag used to invalidate the response
+        use_cache -- set to False to always fetch the response from clowder
+        kwargs -- other arguments passed to connector.get
+        """
+        if self.ttl <= 0:
+            result = connector.get(url, **kwargs)
+            return json.loads(result.text) if result is not None else None
+
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry and use_cache and time.time() - entry['time'] < self.ttl:
+            return json.loads(entry['text'])
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        result = connector.get(url, headers=headers, **kwargs)
+        if result is None:
+            return None
+
+        if entry and result.status_code == 304:
+            logging.getLogger(__name__).debug("response for %s not modified", tag)
+            text = entry['text']
+        else:
+            text = result.text
+        with self.lock:
+            self.entries[url] = {
+                'time': time.time(),
+                'text': text,
+                'tag': tag,
+                'etag': result.headers.get('ETag'),
+                'last_modified': result.headers.get('Last-Modified')
+            }
+            if len(self.entries) > self.max_entries:
+                oldest = min(self.entries, key=lambda k: self.entries[k]['time'])
+                del self.entries[oldest]
+        return json.loads(text)
+
+    def invalidate(self, tag):
+        """Remove all responses with the given tag."""
+        with self.lock:
+            for url in [url for url, entry in self.entries.items() if entry['tag'] == tag]:
+                del self.entries[url]
+
+    def clear(self):
+        """Remove all responses."""
+        with self.lock:
+            self.entries = dict()
@@ -1,3 +1,4 @@
+import json
 import os
 import requests
 import sys
@@ -5,12 +6,40 @@ from datasets import get_file_list
 
 
 class Clowder(object):
+    """Client for the Clowder API.
 
-    def __init__(self, url=None, auth=None, verify=True):
+    Dataset and file names are resolved to ids using an index that is loaded
+    the first time it is needed and kept for the rest of the session. The index
+    is reloaded when a name is not found, and updated when datasets or files
+    are created or deleted using this client. If index_file is given the index
+    is also stored on disk, so it can be reused by the next session. It is
+    written once, by save() or when the client is used in a with block and the
+    block exits. A request that fails with 404 using an indexed id looks the
+    name up again and is retried once with the new id.
+    """
+
+    def __init__(self, url=None, auth=None, verify=True, index_file=None):
 
         self.url = url if url else os.environ.get('CLOWDER_URL','')
         self.auth = auth if auth else self._auth()
         self.verify = verify
+        self.session = requests.Session()
+        self.index_file = index_file
+        self._datasets = None
+        self._files = dict()
+        self._changed = False
+        self._load_index()
+
+
+    def __enter__(self):
+
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.save()
+        self.session.close()
 
 
     def _auth(self):
@@ -27,7 +56,7 @@ class Clowder(object):
     
     def _get(self, endpoint):
     
-        r = requests.get(self._api(endpoint), auth=self.auth, 
+        r = self.session.get(self._api(endpoint), auth=self.auth,
                 verify=self.verify)
         r.raise_for_status()
        
@@ -37,10 +66,10 @@ class Clowder(object):
     def _post(self, endpoint, data, files=None):
     
         if files:
-            r = requests.post(self._api(endpoint), auth=self.auth,
+            r = self.session.post(self._api(endpoint), auth=self.auth,
                 files=files, verify=self.verify)
         else:
-            r = requests.post(self._api(endpoint), auth=self.auth,
+            r = self.session.post(self._api(endpoint), auth=self.auth,
                 json=data, verify=self.verify)
 
         r.raise_for_status()
@@ -50,7 +79,7 @@ class Clowder(object):
     
     def _put(self, endpoint, data):
     
-        r = requests.put(self._api(endpoint), auth=self.auth, json=data, 
+        r = self.session.put(self._api(endpoint), auth=self.auth, json=data,
                 verify=self.verify)
         r.raise_for_status()
     
@@ -59,49 +88,160 @@ class Clowder(object):
     
     def _delete(self, endpoint):
     
-        r = requests.delete(self._api(endpoint), auth=self.auth, 
+        r = self.session.delete(self._api(endpoint), auth=self.auth,
                 verify=self.verify)
         r.raise_for_status()
        
         return r
     
 
-    def get_dataset_id(self, dataset_name):
+    def _load_index(self):
+        """Load the name to id index stored on disk, if any."""
 
-        dataset_list = self._get('datasets').json()
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f).get(self.url)
+        except ValueError:
+            sys.stderr.write('Ignoring invalid index file {}\n'.format(self.index_file))
+            return
+        if index:
+            self._datasets = index['datasets']
+            self._files = index['files']
+
+
+    def save(self):
+        """Store the name to id index on disk, if index_file is set and the
+        index changed since it was loaded or last saved."""
+
+        if not self.index_file or not self._changed:
+            return
+        indexes = dict()
+        if os.path.isfile(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    indexes = json.load(f)
+            except ValueError:
+                pass
+        indexes[self.url] = {'datasets': self._datasets, 'files': self._files}
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(indexes, f)
+        os.rename(tmp_file, self.index_file)
+        self._changed = False
+
+
+    def _index_datasets(self, dataset_list):
+
+        self._datasets = dict()
         for dataset in dataset_list:
-            if dataset['name']==dataset_name:
-                dataset_id = dataset['id']
+            self._datasets[dataset['name']] = {'id': dataset['id'],
+                                               'authorId': dataset.get('authorId'),
+                                               'description': dataset.get('description')}
+        self._changed = True
+
 
-        return dataset_id
+    def _find_dataset(self, dataset_name):
+        """Return the indexed dataset, reloading the index if the name is not found,
+        or the author of the dataset is not known."""
+
+        if self._datasets is None or dataset_name not in self._datasets or \
+                self._datasets[dataset_name]['authorId'] is None:
+            self.list_datasets()
+        return self._datasets.get(dataset_name)
+
+
+    def _forget_dataset(self, dataset_name):
+        """Drop a dataset and its files from the index."""
+
+        dataset = self._datasets.pop(dataset_name, None) if self._datasets else None
+        if dataset:
+            self._files.pop(dataset['id'], None)
+            self._changed = True
+
+
+    def _dataset_request(self, dataset_name, request):
+        """Call request with the id of the dataset. If it fails with 404 the id
+        may come from a stale index, the dataset is looked up again and the
+        request is retried once."""
+
+        dataset_id = self.get_dataset_id(dataset_name)
+        try:
+            return request(dataset_id)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            self._forget_dataset(dataset_name)
+            new_dataset_id = self.get_dataset_id(dataset_name)
+            if new_dataset_id is None or new_dataset_id == dataset_id:
+                raise e
+            return request(new_dataset_id)
+
+
+    def _file_request(self, dataset_name, file_name, request):
+        """Call request with the id of the dataset and of the file, retrying
+        once with ids looked up again if it fails with 404."""
+
+        dataset_id = self.get_dataset_id(dataset_name)
+        file_id = self.get_file_id(dataset_id, file_name)
+        try:
+            return request(dataset_id, file_id)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            self._forget_dataset(dataset_name)
+            new_dataset_id = self.get_dataset_id(dataset_name)
+            if new_dataset_id is None:
+                raise e
+            new_file_id = self.get_file_id(new_dataset_id, file_name)
+            if new_file_id is None or (new_dataset_id, new_file_id) == (dataset_id, file_id):
+                raise e
+            return request(new_dataset_id, new_file_id)
+
+
+    def refresh_index(self):
+        """Forget all indexed names, they will be reloaded when needed."""
+
+        self._datasets = None
+        self._files = dict()
+        self._changed = True
+
+
+    def get_dataset_id(self, dataset_name):
+
+        dataset = self._find_dataset(dataset_name)
+        return dataset['id'] if dataset else None
 
 
     def get_file_id(self, dataset_id, file_name):
 
-        file_list = self._get('datasets/{}/listFiles'.format\
-                              (dataset_id)).json()
-        for f in file_list:
-            if f['filename']==file_name:
-                file_id = f['id']
+        files = self._files.get(dataset_id)
+        if files is None or file_name not in files:
+            file_list = self._get('datasets/{}/listFiles'.format\
+                                  (dataset_id)).json()
+            files = {f['filename']: f['id'] for f in file_list}
+            self._files[dataset_id] = files
+            self._changed = True
 
-        return file_id
+        return files.get(file_name)
 
 
     def get_user_id(self, dataset_name):
 
-        dataset_list = self._get('datasets').json()
-
-        for dataset in dataset_list:
-            if dataset['name']==dataset_name:
-                user_id = 'http://141.142.170.103/api/users/{}'.\
-                          format(dataset['authorId'])
+        dataset = self._find_dataset(dataset_name)
+        if not dataset:
+            return None
 
-        return user_id
+        return 'http://141.142.170.103/api/users/{}'.\
+               format(dataset['authorId'])
 
 
     def list_datasets(self):
     
-        return self._get('datasets').json()
+        dataset_list = self._get('datasets').json()
+        self._index_datasets(dataset_list)
+        return dataset_list
     
     
     def create_dataset(self, name, description='', filenames=None,
@@ -114,9 +254,7 @@ class Clowder(object):
             payload['spaceid'] = spaceid
     
         # TODO
-        dataset_list = self.list_datasets()
-        dataname_list = [dataset['name'] for dataset in dataset_list]
-        if name in dataname_list:
+        if self._find_dataset(name):
             sys.stderr.write('Dataset name already existed.\n')
             return
 
@@ -124,17 +262,27 @@ class Clowder(object):
             pass
     
         else:
-            return self._post('datasets/createempty', payload).json()
+            dataset = self._post('datasets/createempty', payload).json()
+            # the response does not include the author, the index is
+            # reloaded the next time the dataset is used
+            return dataset
 
 
     def delete_dataset(self, dataset):
 
          r = self._delete('datasets/{}'.format(dataset))
+
+         if self._datasets:
+             for name in [n for n, ds in self._datasets.items() if ds['id'] == dataset]:
+                 del self._datasets[name]
+         self._files.pop(dataset, None)
+         self._changed = True
     
 
     def delete_dataset_name(self, name):
         """delete a dataset by name."""
     
+        # the index only keeps one dataset per name, use the full list to find duplicates
         datasets = self.list_datasets()
         ids = {ds['id']: ds['name'] for ds in datasets}
          
@@ -153,11 +301,10 @@ class Clowder(object):
 
     def show_dataset(self, dataset_name):
 
-        dataset_list = self.list_datasets()
-        for dataset in dataset_list:
-            if dataset['name']==dataset_name:
-                authorId = dataset['authorId']
-                description =dataset['description']
+        dataset = self._find_dataset(dataset_name)
+        if dataset:
+            authorId = dataset['authorId']
+            description = dataset['description']
 
         author_info = self._get('users/{}'.format(authorId)).json()
         author_name = author_info['fullName']
@@ -176,37 +323,33 @@ class Clowder(object):
 
     def list_dataset_metadata(self, dataset_name):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-
-        metadata = self._get('datasets/{}/metadata.jsonld'.format(dataset_id))
+        metadata = self._dataset_request(
+            dataset_name, lambda dataset_id: self._get('datasets/{}/metadata.jsonld'.format(dataset_id)))
 
         return metadata.json()
 
    
     def add_dataset_metadata(self, dataset_name, metadata):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-
         metadata['agent']['user_id'] = self.get_user_id(dataset_name)
 
-        r = self._post('datasets/{}/metadata.jsonld'.format(dataset_id),
-                   metadata)
+        r = self._dataset_request(
+            dataset_name, lambda dataset_id: self._post('datasets/{}/metadata.jsonld'.format(dataset_id), metadata))
         print('uploaded')
 
 
     def delete_dataset_metadata(self, dataset_name):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-
-        r = self._delete('datasets/{}/metadata.jsonld'.format(dataset_id))
+        r = self._dataset_request(
+            dataset_name, lambda dataset_id: self._delete('datasets/{}/metadata.jsonld'.format(dataset_id)))
 
         r.raise_for_status()
 
 
     def list_file(self, dataset_name):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-        file_list = self._get('datasets/{}/listFiles'.format(dataset_id))
+        file_list = self._dataset_request(
+            dataset_name, lambda dataset_id: self._get('datasets/{}/listFiles'.format(dataset_id)))
         
         return file_list.json()
 
@@ -214,24 +357,37 @@ class Clowder(object):
     def add_file(self, dataset_name, file_path):
 
         data = {'name': file_path}
-        dataset_id = self.get_dataset_id(dataset_name)
-        files = {'File': open(file_path, 'rb')}
-        r = self._post('uploadToDataset/{}'.format(dataset_id), data, files)
+
+        def upload(dataset_id):
+            with open(file_path, 'rb') as f:
+                r = self._post('uploadToDataset/{}'.format(dataset_id), data,
+                               {'File': f})
+            return dataset_id, r
+
+        dataset_id, r = self._dataset_request(dataset_name, upload)
+
+        if dataset_id in self._files:
+            self._files[dataset_id][os.path.basename(file_path)] = r.json()['id']
+            self._changed = True
 
 
     def delete_file(self, dataset_name, file_name):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-        file_id = self.get_file_id(dataset_id, file_name)
+        def delete(dataset_id, file_id):
+            self._delete('datasets/{}/{}'.format(dataset_id, file_id))
+            return dataset_id
+
+        dataset_id = self._file_request(dataset_name, file_name, delete)
 
-        r = self._delete('datasets/{}/{}'.format(dataset_id, file_id))
+        self._files.get(dataset_id, {}).pop(file_name, None)
+        self._changed = True
 
 
     def show_file(self, dataset_name, file_name):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-        file_id = self.get_file_id(dataset_id, file_name)
-        file_info = self._get('files/{}/metadata'.format(file_id)).json()
+        file_info = self._file_request(
+            dataset_name, file_name,
+            lambda dataset_id, file_id: self._get('files/{}/metadata'.format(file_id))).json()
 
         authorId = file_info['authorId']
         author_info = self._get('users/{}'.format(authorId)).json()
@@ -252,31 +408,27 @@ class Clowder(object):
 
     def list_file_metadata(self, dataset_name, file_name):
 
-         dataset_id = self.get_dataset_id(dataset_name)
-         file_id = self.get_file_id(dataset_id, file_name)
-
-         metadata = self._get('files/{}/metadata.jsonld'.format(file_id))
+         metadata = self._file_request(
+             dataset_name, file_name,
+            lambda dataset_id, file_id: self._get('files/{}/metadata.jsonld'.format(file_id)))
 
          return metadata.json()
 
 
     def add_file_metadata(self, dataset_name, file_name, metadata):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-        file_id = self.get_file_id(dataset_id, file_name)
-
         metadata['agent']['user_id'] = self.get_user_id(dataset_name)
 
-        r = self._post('files/{}/metadata.jsonld'.format(file_id),
-                       metadata) 
+        r = self._file_request(
+            dataset_name, file_name,
+            lambda dataset_id, file_id: self._post('files/{}/metadata.jsonld'.format(file_id), metadata))
         print('uploaded')
 
 
     def delete_file_metadata(self, dataset_name, file_name):
 
-        dataset_id = self.get_dataset_id(dataset_name)
-        file_id = self.get_file_id(dataset_id, file_name)
-
-        r = self._delete('files/{}/metadata.jsonld'.format(file_id))
+        r = self._file_request(
+            dataset_name, file_name,
+            lambda dataset_id, file_id: self._delete('files/{}/metadata.jsonld'.format(file_id)))
 
         r.raise_for_status()
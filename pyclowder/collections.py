@@ -4,8 +4,7 @@ This module provides simple wrappers around the clowder Collections API
 """
 import json
 import logging
-import requests
-from pyclowder.utils import StatusMessage
+from pyclowder.utils import MultipartEncoder, StatusMessage, default_connector, upload_progress
 
 
 def create_empty(connector, host, key, collectionname, description, parentid=None, spaceid=None):
@@ -21,31 +20,31 @@ def create_empty(connector, host, key, collectionname, description, parentid=Non
     spaceid -- id of the space to add dataset to
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
 
     if parentid:
         if (spaceid):
             url = '%sapi/collections/newCollectionWithParent?key=%s' % (host, key)
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data={"name": collectionname, "description": description, "parentId": [parentid],
-                                   "space": spaceid}, verify=connector.ssl_verify if connector else True)
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data={"name": collectionname, "description": description, "parentId": [parentid],
+                                    "space": spaceid}, verify=connector.ssl_verify)
         else:
             url = '%sapi/collections/newCollectionWithParent?key=%s' % (host, key)
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data={"name": collectionname, "description": description, "parentId": [parentid]},
-                                   verify=connector.ssl_verify if connector else True)
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data={"name": collectionname, "description": description, "parentId": [parentid]},
+                                    verify=connector.ssl_verify)
     else:
         if (spaceid):
             url = '%sapi/collections?key=%s' % (host, key)
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data={"name": collectionname, "description": description, "space": spaceid},
-                                   verify=connector.ssl_verify if connector else True)
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data={"name": collectionname, "description": description, "space": spaceid},
+                                    verify=connector.ssl_verify)
         else:
             url = '%sapi/collections?key=%s' % (host, key)
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data={"name": collectionname, "description": description},
-                                   verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data={"name": collectionname, "description": description},
+                                    verify=connector.ssl_verify)
 
     collectionid = result.json()['id']
     logger.debug("collection id = [%s]", collectionid)
@@ -63,17 +62,17 @@ def get_datasets(connector, host, key, collectionid):
     datasetid -- the collection to get datasets of
     """
 
+    connector = default_connector(connector)
     url = "%sapi/collections/%s/datasets?key=%s" % (host, collectionid, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     return json.loads(result.text)
 
 
 # pylint: disable=too-many-arguments
-def upload_preview(connector, host, key, collectionid, previewfile, previewmetadata):
+def upload_preview(connector, host, key, collectionid, previewfile, previewmetadata, filename=None, progress=False):
     """Upload preview to Clowder.
 
     Keyword arguments:
@@ -81,12 +80,15 @@ def upload_preview(connector, host, key, collectionid, previewfile, previewmetad
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     collectionid -- the file that is currently being processed
-    preview -- the file containing the preview
+    preview -- the file containing the preview, either a path, a file-like object or a bytes buffer
     previewdata: any metadata to be associated with preview,
                     this can contain a section_id to indicate the
                     section this preview should be associated with.
+    filename -- (optional) name of the preview, defaults to the name of previewfile
+    progress -- (optional) send status updates while the preview is uploaded
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "collection", "id": collectionid},
                             "Uploading collection preview.")
 
@@ -95,25 +97,27 @@ def upload_preview(connector, host, key, collectionid, previewfile, previewmetad
 
     # upload preview
     url = '%sapi/previews?key=%s' % (host, key)
-    with open(previewfile, 'rb') as filebytes:
-        result = requests.post(url, files={"File": filebytes},
-                               verify=connector.ssl_verify if connector else True)
-        result.raise_for_status()
+    callback = upload_progress(connector, {"type": "collection", "id": collectionid},
+                               "Uploading collection preview") if progress else None
+    encoder = MultipartEncoder([("File", (filename, previewfile))], callback)
+    try:
+        result = connector.post(url, data=encoder, headers={'Content-Type': encoder.content_type},
+                                verify=connector.ssl_verify)
+    finally:
+        encoder.close()
     previewid = result.json()['id']
     logger.debug("preview id = [%s]", previewid)
 
     # associate uploaded preview with original collection
     if collectionid and not (previewmetadata and previewmetadata['section_id']):
         url = '%sapi/collections/%s/previews/%s?key=%s' % (host, collectionid, previewid, key)
-        result = requests.post(url, headers=headers, data=json.dumps({}),
-                               verify=connector.ssl_verify if connector else True)
-        result.raise_for_status()
+        result = connector.post(url, headers=headers, data=json.dumps({}),
+                                verify=connector.ssl_verify)
 
     # associate metadata with preview
     if previewmetadata is not None:
         url = '%sapi/previews/%s/metadata?key=%s' % (host, previewid, key)
-        result = requests.post(url, headers=headers, data=json.dumps(previewmetadata),
-                               verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+        result = connector.post(url, headers=headers, data=json.dumps(previewmetadata),
+                                verify=connector.ssl_verify)
 
     return previewid
@@ -18,6 +18,10 @@ parameters:
 * rabbitmq_uri [REQUIRED] : the uri of the RabbitMQ server
 * rabbitmq_exchange [OPTIONAL] : the exchange to which to bind the queue
 * rabbitmq_key [OPTIONAL] : the key that binds the queue to the exchange
+* max_inflight [OPTIONAL] : the number of messages that are processed concurrently
+                            on the connection (default=1)
+* workers_mode [OPTIONAL] : process messages in a "thread" (default) or in a
+                            separate "process"
 
 HPCConnector
 
@@ -33,22 +37,156 @@ back to clowder. This connector takes a single argument (which can be list):
 
 import json
 import logging
+import multiprocessing
+import multiprocessing.util
 import os
 import pickle
+import copy
+import shutil
 import subprocess
 import time
 import tempfile
 import threading
 import errno
+import glob
+import hashlib
+import itertools
+from multiprocessing.pool import ThreadPool
 
 import pika
-import requests
 
 import pyclowder.datasets
 import pyclowder.files
+import pyclowder.metrics
 import pyclowder.utils
 
 
+class _NoLimit(object):
+    """Semaphore that does not limit anything."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class PreprocessError(Exception):
+    """Raised when the information about the dataset of a message can not be fetched."""
+    pass
+
+
+class LazyResource(dict):
+    """Resource whose fields are fetched when they are first used.
+
+    This behaves like the dict it replaces. The keys in loaders are part of the resource,
+    but the loader of a key is only called, with the resource as argument, the first time
+    its value is used, and the value is stored. Copies keep the fields that are not loaded
+    yet lazy. The loaders can not be pickled, so pickling loads all fields and stores a
+    dict, use loaded() for a snapshot that does not fetch anything.
+
+    Keyword arguments:
+    fields -- the fields that are known
+    loaders -- dictionary of field name to the function that returns its value
+    """
+
+    def __init__(self, fields, loaders):
+        dict.__init__(self, fields)
+        self.loaders = dict(loaders)
+        self.lock = threading.RLock()
+
+    def _load(self, key):
+        with self.lock:
+            loader = self.loaders.get(key)
+            if loader is not None and not dict.__contains__(self, key):
+                dict.__setitem__(self, key, loader(self))
+            self.loaders.pop(key, None)
+
+    def loaded(self):
+        """Return a dict with the fields that are loaded, without loading the others."""
+        return dict.copy(self)
+
+    def __getitem__(self, key):
+        if key in self.loaders:
+            self._load(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self.loaders:
+            self._load(key)
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.loaders.pop(key, None)
+            dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if self.loaders.pop(key, None) is not None and not dict.__contains__(self, key):
+                return
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self.loaders:
+            self._load(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self.loaders or dict.__contains__(self, key)
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for key in dict.__iter__(self):
+            yield key
+        for key in list(self.loaders):
+            if not dict.__contains__(self, key):
+                yield key
+
+    def __len__(self):
+        return dict.__len__(self) + len([k for k in self.loaders if not dict.__contains__(self, k)])
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+    def copy(self):
+        return LazyResource(self.loaded(), self.loaders)
+
+    def __repr__(self):
+        return "LazyResource(%r, not loaded: %r)" % (self.loaded(), sorted(self.loaders))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return LazyResource(copy.deepcopy(self.loaded(), memo), self.loaders)
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+
 class Connector(object):
     """ Class that will listen for messages.
 
@@ -58,7 +196,13 @@ class Connector(object):
 
     registered_clowder = list()
 
-    def __init__(self, extractor_info, check_message=None, process_message=None, ssl_verify=True, mounted_paths=None):
+    # limits the number of files of a dataset fetched concurrently from each host
+    fetch_semaphores = dict()
+    fetch_lock = threading.Lock()
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, extractor_info, check_message=None, process_message=None, ssl_verify=True, mounted_paths=None,
+                 session_pool=None, fetch_workers=4, fetch_host_limit=None, download_cache=None, profiler=None):
         self.extractor_info = extractor_info
         self.check_message = check_message
         self.process_message = process_message
@@ -67,6 +211,14 @@ class Connector(object):
             self.mounted_paths = {}
         else:
             self.mounted_paths = mounted_paths
+        if session_pool is None:
+            self.session_pool = pyclowder.utils.SessionPool()
+        else:
+            self.session_pool = session_pool
+        self.fetch_workers = fetch_workers
+        self.fetch_host_limit = fetch_host_limit
+        self.download_cache = download_cache
+        self.profiler = profiler
 
     def listen(self):
         """Listen for incoming messages.
@@ -151,35 +303,36 @@ class Connector(object):
 
         # determine what to download (if needed) and add relevant data to resource
         if resource_type == "dataset":
-            try:
-                datasetinfo = pyclowder.datasets.get_info(self, host, secret_key, datasetid)
-                filelist = pyclowder.datasets.get_file_list(self, host, secret_key, datasetid)
-                triggering_file = None
-                for f in filelist:
-                    if f['id'] == fileid:
-                        triggering_file = f['filename']
-                        break
-
-                return {
-                    "type": "dataset",
-                    "id": datasetid,
-                    "name": datasetinfo["name"],
-                    "files": filelist,
-                    "triggering_file": triggering_file,
-                    "parent": {},
-                    "dataset_info": datasetinfo
-                }
-            except:
-                msg = "[%s] : Error downloading dataset preprocess information." % datasetid
-                logger.exception(msg)
-                # Can't create full resource object but can provide essential details for status_update
-                resource = {
-                    "type": "dataset",
-                    "id": datasetid
-                }
-                self.status_update(pyclowder.utils.StatusMessage.error, resource, msg)
-                self.message_error(resource)
-                return None
+            # the dataset information is only fetched when it is used, by check_message or process_message
+            def load_dataset_info(resource):  # pylint: disable=unused-argument
+                return self._fetch_preprocess(datasetid, pyclowder.datasets.get_info, host, secret_key, datasetid)
+
+            def load_name(resource):
+                return resource["dataset_info"]["name"]
+
+            def load_files(resource):  # pylint: disable=unused-argument
+                return self._fetch_preprocess(datasetid, pyclowder.datasets.get_file_list, host, secret_key,
+                                              datasetid)
+
+            def load_triggering_file(resource):
+                triggering_file = self._find_filename(resource["files"], fileid)
+                if triggering_file is None and fileid and fileid != datasetid:
+                    # file could have been added after the file list was cached
+                    resource["files"] = self._fetch_preprocess(datasetid, pyclowder.datasets.get_file_list, host,
+                                                               secret_key, datasetid, use_cache=False)
+                    triggering_file = self._find_filename(resource["files"], fileid)
+                return triggering_file
+
+            return LazyResource({
+                "type": "dataset",
+                "id": datasetid,
+                "parent": {}
+            }, {
+                "name": load_name,
+                "files": load_files,
+                "triggering_file": load_triggering_file,
+                "dataset_info": load_dataset_info
+            })
 
         elif resource_type == "file":
             ext = os.path.splitext(filename)[1]
@@ -201,6 +354,23 @@ class Connector(object):
                 "metadata": body['metadata']
             }
 
+    def _fetch_preprocess(self, datasetid, func, *args, **kwargs):
+        """Call func to fetch information about the dataset, raises PreprocessError if this fails."""
+        try:
+            return func(self, *args, **kwargs)
+        except Exception:
+            msg = "[%s] : Error downloading dataset preprocess information." % datasetid
+            logging.getLogger(__name__).exception(msg)
+            raise PreprocessError(msg)
+
+    @staticmethod
+    def _find_filename(filelist, fileid):
+        """Return the name of the file with the given id in filelist, or None."""
+        for f in filelist:
+            if f['id'] == fileid:
+                return f['filename']
+        return None
+
     def _check_for_local_file(self, host, secret_key, file_metadata):
         """ Try to get pointer to locally accessible copy of file for extractor."""
 
@@ -237,61 +407,145 @@ class Connector(object):
 
         return (md_dir, md_file)
 
+    def _fetch_dataset_file(self, host, secret_key, ds_file, file_path):
+        """Download a single file of a dataset (if not local) and its metadata.
+
+        If anything fails, all temporary files created are removed before raising.
+
+        Returns:
+            (file path, metadata file, tmp files created, tmp dirs created)
+        """
+        tmp_files_created = []
+        tmp_dirs_created = []
+
+        with self._fetch_semaphore(host):
+            try:
+                if not file_path:
+                    # Download file to temp directory
+                    file_path = self._download_file(host, secret_key, ds_file['id'], ds_file['id'],
+                                                    ds_file['file_ext'], ds_file.get('size'))
+                    tmp_files_created.append(file_path)
+                # Also get file metadata in format expected by extractor
+                (file_md_dir, file_md_tmp) = self._download_file_metadata(host, secret_key, ds_file['id'],
+                                                                          ds_file['filepath'])
+                tmp_files_created.append(file_md_tmp)
+                tmp_dirs_created.append(file_md_dir)
+            except Exception:
+                self._remove_tmp(tmp_files_created, tmp_dirs_created)
+                raise
+
+        return (file_path, file_md_tmp, tmp_files_created, tmp_dirs_created)
+
+    def _download_file(self, host, secret_key, fileid, intermediatefileid, ext, size):
+        """Download file to be processed, using the download cache if there is one.
+
+        The returned path should be removed using _remove_tmp.
+        """
+        if self.download_cache:
+            return self.download_cache.get(fileid, size, ext,
+                                           lambda: pyclowder.files.download(self, host, secret_key, fileid,
+                                                                            intermediatefileid, ext))
+        return pyclowder.files.download(self, host, secret_key, fileid, intermediatefileid, ext)
+
+    def _fetch_semaphore(self, host):
+        """Return the semaphore limiting the number of concurrent fetches from host."""
+        with Connector.fetch_lock:
+            if host not in Connector.fetch_semaphores:
+                if self.fetch_host_limit:
+                    Connector.fetch_semaphores[host] = threading.BoundedSemaphore(self.fetch_host_limit)
+                else:
+                    Connector.fetch_semaphores[host] = _NoLimit()
+            return Connector.fetch_semaphores[host]
+
+    def _remove_tmp(self, tmp_files, tmp_dirs):
+        """Remove temporary files and directories, logging any errors.
+
+        Files from the download cache are released instead of removed.
+        """
+        logger = logging.getLogger(__name__)
+        for tmp_f in tmp_files:
+            try:
+                if self.download_cache and self.download_cache.contains(tmp_f):
+                    self.download_cache.release(tmp_f)
+                else:
+                    os.remove(tmp_f)
+            except OSError:
+                logger.exception("Error removing temporary file")
+        for tmp_d in tmp_dirs:
+            try:
+                os.rmdir(tmp_d)
+            except OSError:
+                logger.exception("Error removing temporary dataset directory")
+
     def _prepare_dataset(self, host, secret_key, resource):
         located_files = []
-        missing_files = []
+        local_paths = []
         tmp_files_created = []
         tmp_dirs_created = []
 
         # first check if any files in dataset accessible locally
         ds_file_list = pyclowder.datasets.get_file_list(self, host, secret_key, resource["id"])
         for ds_file in ds_file_list:
-            file_path = self._check_for_local_file(host, secret_key, ds_file)
-            if not file_path:
-                missing_files.append(ds_file)
-            else:
-                # Also get file metadata in format expected by extrator
-                (file_md_dir, file_md_tmp) = self._download_file_metadata(host, secret_key, ds_file['id'],
-                                                                          ds_file['filepath'])
-                located_files.append(file_path)
-                located_files.append(file_md_tmp)
-                tmp_files_created.append(file_md_tmp)
-                tmp_dirs_created.append(file_md_dir)
+            local_paths.append(self._check_for_local_file(host, secret_key, ds_file))
 
         # If only some files found locally, check & download any that were missed
-        if len(located_files) > 0:
-            for ds_file in missing_files:
-                # Download file to temp directory
-                inputfile = pyclowder.files.download(self, host, secret_key, ds_file['id'], ds_file['id'],
-                                                     ds_file['file_ext'])
-                # Also get file metadata in format expected by extractor
-                (file_md_dir, file_md_tmp) = self._download_file_metadata(host, secret_key, ds_file['id'],
-                                                                          ds_file['filepath'])
-                located_files.append(inputfile)
-                located_files.append(file_md_tmp)
-                tmp_files_created.append(inputfile)
-                tmp_files_created.append(file_md_tmp)
-                tmp_dirs_created.append(file_md_dir)
+        if any(local_paths):
+            # fetch the files and metadata in parallel, waiting for all fetches to finish
+            # so the temporary files of the successful fetches can be removed on error.
+            pool = ThreadPool(max(1, min(self.fetch_workers, len(ds_file_list))))
+            try:
+                fetches = [pool.apply_async(self._fetch_dataset_file, (host, secret_key, ds_file, file_path))
+                           for (ds_file, file_path) in zip(ds_file_list, local_paths)]
+                error = None
+                for fetch in fetches:
+                    try:
+                        (file_path, file_md_tmp, tmp_files, tmp_dirs) = fetch.get()
+                        located_files.append(file_path)
+                        located_files.append(file_md_tmp)
+                        tmp_files_created.extend(tmp_files)
+                        tmp_dirs_created.extend(tmp_dirs)
+                    except Exception as exc:  # pylint: disable=broad-except
+                        if error is None:
+                            error = exc
+            finally:
+                pool.close()
+                pool.join()
+            if error is not None:
+                self._remove_tmp(tmp_files_created, tmp_dirs_created)
+                raise error
 
-            # Also, get dataset metadata (normally included in dataset .zip download file)
-            ds_md = pyclowder.datasets.download_metadata(self, host, secret_key, resource["id"])
-            md_name = "%s_dataset_metadata.json" % resource["id"]
-            md_dir = tempfile.mkdtemp(suffix=resource["id"])
-            (fd, md_file) = tempfile.mkstemp(suffix=md_name, dir=md_dir)
-            with os.fdopen(fd, "w") as tmp_file:
-                tmp_file.write(json.dumps(ds_md))
-            located_files.append(md_file)
-            tmp_files_created.append(md_file)
-            tmp_dirs_created.append(md_dir)
+            try:
+                # Also, get dataset metadata (normally included in dataset .zip download file)
+                ds_md = pyclowder.datasets.download_metadata(self, host, secret_key, resource["id"])
+                md_name = "%s_dataset_metadata.json" % resource["id"]
+                md_dir = tempfile.mkdtemp(suffix=resource["id"])
+                tmp_dirs_created.append(md_dir)
+                (fd, md_file) = tempfile.mkstemp(suffix=md_name, dir=md_dir)
+                tmp_files_created.append(md_file)
+                with os.fdopen(fd, "w") as tmp_file:
+                    tmp_file.write(json.dumps(ds_md))
+                located_files.append(md_file)
+            except Exception:
+                self._remove_tmp(tmp_files_created, tmp_dirs_created)
+                raise
 
             file_paths = located_files
 
-        # If we didn't find any files locally, download dataset .zip as normal
+        # If we didn't find any files locally, download dataset .zip as normal, extracting
+        # the files while downloading.
         else:
-            inputzip = pyclowder.datasets.download(self, host, secret_key, resource["id"])
-            file_paths = pyclowder.utils.extract_zip_contents(inputzip)
+            output_folder = tempfile.mkdtemp(suffix=resource["id"])
+            try:
+                file_paths = list(pyclowder.datasets.download_extract(self, host, secret_key, resource["id"],
+                                                                      output_folder,
+                                                                      self.extractor_info.get('dataset_file_types')))
+            except Exception:
+                shutil.rmtree(output_folder, ignore_errors=True)
+                raise
             tmp_files_created += file_paths
-            tmp_files_created.append(inputzip)
+            for root, dirs, _ in os.walk(output_folder, topdown=False):
+                tmp_dirs_created += [os.path.join(root, d) for d in dirs]
+            tmp_dirs_created.append(output_folder)
 
         return (file_paths, tmp_files_created, tmp_dirs_created)
 
@@ -317,11 +571,12 @@ class Connector(object):
         if not resource:
             return
 
-        # register extractor
-        url = "%sapi/extractors" % host
-        if url not in Connector.registered_clowder:
-            Connector.registered_clowder.append(url)
-            self.register_extractor("%s?key=%s" % (url, secret_key))
+        self._register_with_host(host, secret_key)
+
+        metrics = pyclowder.metrics.registry
+        metrics.add('pyclowder_messages_inflight', 1)
+        started = time.time()
+        outcome = "error"
 
         # tell everybody we are starting to process the file
         self.status_update(pyclowder.utils.StatusMessage.start, resource, "Started processing")
@@ -331,7 +586,8 @@ class Connector(object):
         try:
             check_result = pyclowder.utils.CheckMessage.download
             if self.check_message:
-                check_result = self.check_message(self, host, secret_key, resource, body)
+                with metrics.timer('pyclowder_stage_seconds', stage='check_message'):
+                    check_result = self.check_message(self, host, secret_key, resource, body)
             if check_result != pyclowder.utils.CheckMessage.ignore:
                 if self.process_message:
 
@@ -341,67 +597,72 @@ class Connector(object):
                         found_local = False
                         try:
                             if check_result != pyclowder.utils.CheckMessage.bypass:
-                                file_metadata = pyclowder.files.download_info(self, host, secret_key, resource["id"])
-                                file_path = self._check_for_local_file(host, secret_key, file_metadata)
-                                if not file_path:
-                                    file_path = pyclowder.files.download(self, host, secret_key, resource["id"],
-                                                                         resource["intermediate_id"],
-                                                                         resource["file_ext"])
-                                else:
-                                    found_local = True
+                                with metrics.timer('pyclowder_stage_seconds', stage='download'):
+                                    file_metadata = pyclowder.files.download_info(self, host, secret_key,
+                                                                                  resource["id"])
+                                    file_path = self._check_for_local_file(host, secret_key, file_metadata)
+                                    if not file_path:
+                                        file_path = self._download_file(host, secret_key, resource["id"],
+                                                                        resource["intermediate_id"],
+                                                                        resource["file_ext"],
+                                                                        file_metadata.get('size',
+                                                                                          body.get('fileSize')))
+                                    else:
+                                        found_local = True
                                 resource['local_paths'] = [file_path]
 
-                            self.process_message(self, host, secret_key, resource, body)
+                            with metrics.timer('pyclowder_stage_seconds', stage='process_message'):
+                                self._call_process_message(host, secret_key, resource, body)
                         finally:
                             if file_path is not None and not found_local:
-                                try:
-                                    os.remove(file_path)
-                                except OSError:
-                                    logger.exception("Error removing download file")
+                                self._remove_tmp([file_path], [])
 
                     # DATASET/METADATA MESSAGES ---------------------------------------
                     else:
                         file_paths, tmp_files, tmp_dirs = [], [], []
                         try:
                             if check_result != pyclowder.utils.CheckMessage.bypass:
-                                (file_paths, tmp_files, tmp_dirs) = self._prepare_dataset(host, secret_key, resource)
+                                with metrics.timer('pyclowder_stage_seconds', stage='download'):
+                                    (file_paths, tmp_files, tmp_dirs) = self._prepare_dataset(host, secret_key,
+                                                                                              resource)
                             resource['local_paths'] = file_paths
 
-                            self.process_message(self, host, secret_key, resource, body)
+                            with metrics.timer('pyclowder_stage_seconds', stage='process_message'):
+                                self._call_process_message(host, secret_key, resource, body)
                         finally:
-                            for tmp_f in tmp_files:
-                                try:
-                                    os.remove(tmp_f)
-                                except OSError:
-                                    logger.exception("Error removing temporary dataset file")
-                            for tmp_d in tmp_dirs:
-                                try:
-                                    os.rmdir(tmp_d)
-                                except OSError:
-                                    logger.exception("Error removing temporary dataset directory")
+                            self._remove_tmp(tmp_files, tmp_dirs)
 
+                outcome = "ok"
             else:
                 self.status_update(pyclowder.utils.StatusMessage.processing, resource, "Skipped in check_message")
+                outcome = "ignored"
 
             self.message_ok(resource)
 
+        except PreprocessError as exc:
+            # the dataset is missing or can not be read, retrying will not help
+            self.status_update(pyclowder.utils.StatusMessage.error, resource, str(exc))
+            self.message_error(resource)
         except SystemExit as exc:
             status = "sys.exit : " + exc.message
             logger.exception("[%s] %s", resource['id'], status)
             self.status_update(pyclowder.utils.StatusMessage.error, resource, status)
             self.message_resubmit(resource, retry_count)
+            outcome = "resubmit"
             raise
         except KeyboardInterrupt:
             status = "keyboard interrupt"
             logger.exception("[%s] %s", resource['id'], status)
             self.status_update(pyclowder.utils.StatusMessage.error, resource, status)
             self.message_resubmit(resource, retry_count)
+            outcome = "resubmit"
             raise
         except GeneratorExit:
             status = "generator exit"
             logger.exception("[%s] %s", resource['id'], status)
             self.status_update(pyclowder.utils.StatusMessage.error, resource, status)
             self.message_resubmit(resource, retry_count)
+            outcome = "resubmit"
             raise
         except StandardError as exc:
             status = "standard error : " + str(exc.message)
@@ -409,6 +670,7 @@ class Connector(object):
             self.status_update(pyclowder.utils.StatusMessage.error, resource, status)
             if retry_count < 10:
                 self.message_resubmit(resource, retry_count+1)
+                outcome = "resubmit"
             else:
                 self.message_error(resource)
         except subprocess.CalledProcessError as exc:
@@ -421,6 +683,24 @@ class Connector(object):
             logger.exception("[%s] %s", resource['id'], status)
             self.status_update(pyclowder.utils.StatusMessage.error, resource, status)
             self.message_error(resource)
+        finally:
+            metrics.observe('pyclowder_stage_seconds', time.time() - started, stage='message')
+            metrics.inc('pyclowder_messages_total', outcome=outcome)
+            metrics.add('pyclowder_messages_inflight', -1)
+
+    def _register_with_host(self, host, secret_key):
+        """Register the extractor with the clowder instance, if not done yet by this process."""
+        url = "%sapi/extractors" % host
+        if url not in Connector.registered_clowder:
+            Connector.registered_clowder.append(url)
+            self.register_extractor("%s?key=%s" % (url, secret_key))
+
+    def _call_process_message(self, host, secret_key, resource, body):
+        """Call process_message, using the profiler if one is set."""
+        if self.profiler:
+            self.profiler.run(resource, self.process_message, self, host, secret_key, resource, body)
+        else:
+            self.process_message(self, host, secret_key, resource, body)
 
     def register_extractor(self, endpoints):
         """Register extractor info with Clowder.
@@ -442,10 +722,9 @@ class Connector(object):
             if url not in Connector.registered_clowder:
                 Connector.registered_clowder.append(url)
                 try:
-                    result = requests.post(url.strip(), headers=headers,
-                                           data=json.dumps(data),
-                                           verify=self.ssl_verify)
-                    result.raise_for_status()
+                    result = self.post(url.strip(), headers=headers,
+                                       data=json.dumps(data),
+                                       verify=self.ssl_verify)
                     logger.debug("Registering extractor with %s : %s", url, result.text)
                 except Exception as exc:  # pylint: disable=broad-except
                     logger.exception('Error in registering extractor: ' + str(exc))
@@ -476,7 +755,7 @@ class Connector(object):
 
     def get(self, url, params=None, raise_status=True, **kwargs):
         """
-        This methods wraps the Python requests GET method
+        This methods wraps the Python requests GET method using the session pool
         :param url: URl to use in GET request
         :param params: (optional) GET request parameters
         :param raise_status: (optional) If set to True, call raise_for_status. Default is True.
@@ -484,7 +763,7 @@ class Connector(object):
         :return: Response of the GET request
         """
 
-        response = requests.get(url, params=params, **kwargs)
+        response = self.session_pool.request('GET', url, params=params, **kwargs)
         if raise_status:
             response.raise_for_status()
 
@@ -492,7 +771,7 @@ class Connector(object):
 
     def post(self, url, data=None, json_data=None, raise_status=True, **kwargs):
         """
-        This methods wraps the Python requests POST method
+        This methods wraps the Python requests POST method using the session pool
         :param url: URl to use in POST request
         :param data: (optional) data (Dictionary, bytes, or file-like object) to send in the body of POST request
         :param json_data: (optional) json data to send with POST request
@@ -501,7 +780,7 @@ class Connector(object):
         :return: Response of the POST request
         """
 
-        response = requests.post(url, data=data, json=json_data, **kwargs)
+        response = self.session_pool.request('POST', url, data=data, json=json_data, **kwargs)
         if raise_status:
             response.raise_for_status()
 
@@ -509,7 +788,7 @@ class Connector(object):
 
     def put(self, url, data=None, raise_status=True, **kwargs):
         """
-        This methods wraps the Python requests PUT method
+        This methods wraps the Python requests PUT method using the session pool
         :param url: URl to use in PUT request
         :param data: (optional) data to send with PUT request
         :param raise_status: (optional) If set to True, call raise_for_status. Default is True.
@@ -517,7 +796,7 @@ class Connector(object):
         :return: Response of the PUT request
         """
 
-        response = requests.put(url, data=data, **kwargs)
+        response = self.session_pool.request('PUT', url, data=data, **kwargs)
         if raise_status:
             response.raise_for_status()
 
@@ -525,14 +804,14 @@ class Connector(object):
 
     def delete(self, url, raise_status=True, **kwargs):
         """
-        This methods wraps the Python requests DELETE method
+        This methods wraps the Python requests DELETE method using the session pool
         :param url: URl to use in DELETE request
         :param raise_status: (optional) If set to True, call raise_for_status. Default is True.
         :param kwargs: List of other optional arguments to pass to DELETE call
         :return: Response of the DELETE request
         """
 
-        response = requests.delete(url, **kwargs)
+        response = self.session_pool.request('DELETE', url, **kwargs)
         if raise_status:
             response.raise_for_status()
 
@@ -547,19 +826,59 @@ class RabbitMQConnector(Connector):
     and key are specified it will bind the exchange to the queue. If an exchange is
     specified it will always try to bind the special key extractors.<extractor_info[name]> to the
     exchange and queue.
+
+    Up to max_inflight messages are fetched from the queue and processed at the same time, each
+    in its own RabbitMQHandler. All communication with RabbitMQ (acks, status updates, resubmits)
+    is still done from the thread that owns the channel.
+
+    If workers_mode is "process" the check_message and process_message functions are called in
+    a pool of max_inflight worker processes, which send their messages back over a queue. This
+    allows CPU bound extractors to use more than one core, while the connection to RabbitMQ
+    stays in the parent. The pool is started by listen before the connection and any other
+    thread exist, and the workers are kept for all messages, so their sessions and caches are
+    reused.
+
+    Whenever a worker queues a message it will wake up the thread that owns the channel using
+    add_callback_threadsafe, so acks and status updates are send right away. With versions of
+    pika that do not support this the messages are send at least once a second.
+
+    If max_messages or max_rss (in bytes) is set the connector stops consuming once it has
+    processed that many messages, or once the process uses that much memory. It will finish
+    the messages it is working on and then return from listen, so it can be replaced by a
+    fresh process.
+
+    If a recorder (pyclowder.recording.MessageRecorder) is given, every message received
+    is recorded, so it can be replayed later.
     """
 
     # pylint: disable=too-many-arguments
     def __init__(self, extractor_info, rabbitmq_uri, rabbitmq_exchange=None, rabbitmq_key=None,
-                 check_message=None, process_message=None, ssl_verify=True, mounted_paths=None):
-        Connector.__init__(self, extractor_info, check_message, process_message, ssl_verify, mounted_paths)
+                 check_message=None, process_message=None, ssl_verify=True, mounted_paths=None,
+                 max_inflight=1, workers_mode="thread", session_pool=None, fetch_workers=4, fetch_host_limit=None,
+                 download_cache=None, max_messages=0, max_rss=0, profiler=None, recorder=None):
+        Connector.__init__(self, extractor_info, check_message, process_message, ssl_verify, mounted_paths,
+                           session_pool, fetch_workers, fetch_host_limit, download_cache, profiler)
         self.rabbitmq_uri = rabbitmq_uri
         self.rabbitmq_exchange = rabbitmq_exchange
         self.rabbitmq_key = rabbitmq_key
+        self.max_inflight = max(1, max_inflight)
+        self.workers_mode = workers_mode
+        self.max_messages = max_messages
+        self.max_rss = max_rss
+        self.recorder = recorder
+        self.processed = 0
+        self.draining = False
+        self.drain_requested = False
         self.channel = None
         self.connection = None
         self.consumer_tag = None
-        self.worker = None
+        self.workers = list()
+        # worker processes, the queue of their messages and the thread moving those to the handlers
+        self.pool = None
+        self.results = None
+        self.relay = None
+        self.pool_workers = dict()
+        self.next_key = 0
 
     def connect(self):
         """connect to rabbitmq using URL parameters"""
@@ -570,9 +889,10 @@ class RabbitMQConnector(Connector):
         # connect to channel
         self.channel = self.connection.channel()
 
-        # setting prefetch count to 1 so we only take 1 message of the bus at a time,
-        # so other extractors of the same type can take the next message.
-        self.channel.basic_qos(prefetch_count=1)
+        # setting prefetch count to max_inflight so we only take as many messages of the bus
+        # as we can process at the same time, so other extractors of the same type can take
+        # the next message.
+        self.channel.basic_qos(prefetch_count=self.max_inflight)
 
         # declare the queue in case it does not exist
         self.channel.queue_declare(queue=self.extractor_info['name'], durable=True)
@@ -603,6 +923,10 @@ class RabbitMQConnector(Connector):
     def listen(self):
         """Listen for messages coming from RabbitMQ"""
 
+        # fork the worker processes while this is the only thread
+        if self.workers_mode == "process" and self.pool is None:
+            self._start_pool()
+
         # check for connection
         if not self.channel:
             self.connect()
@@ -615,12 +939,14 @@ class RabbitMQConnector(Connector):
         logging.getLogger(__name__).info("Starting to listen for messages.")
         try:
             # pylint: disable=protected-access
-            while self.channel and self.channel._consumer_infos:
+            while self.channel and (self.channel._consumer_infos or (self.draining and self.workers)):
+                # workers will wake us up when they have messages, so this is only an upper bound
                 self.channel.connection.process_data_events(time_limit=1)  # 1 second
-                if self.worker:
-                    self.worker.process_messages(self.channel)
-                    if self.worker.thread and not self.worker.thread.isAlive():
-                        self.worker = None
+                self.process_workers()
+                if not self.draining and (self.drain_requested or self.recycle_needed()):
+                    # stop taking new messages, finish the ones we have
+                    self.draining = True
+                    self.channel.stop_consuming(self.consumer_tag)
         except SystemExit:
             raise
         except KeyboardInterrupt:
@@ -631,6 +957,8 @@ class RabbitMQConnector(Connector):
             logging.getLogger(__name__).exception("Error while consuming messages.")
         finally:
             logging.getLogger(__name__).info("Stopped listening for messages.")
+            if self.recorder:
+                self.recorder.flush()
             if self.channel:
                 try:
                     self.channel.close()
@@ -645,6 +973,85 @@ class RabbitMQConnector(Connector):
                     logging.getLogger(__name__).exception("Error while closing connection.")
                 finally:
                     self.connection = None
+            self._stop_pool()
+
+    def _start_pool(self):
+        """Start the worker processes, and the thread that moves their messages to the handlers."""
+        self.results = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(self.max_inflight, _init_rabbitmq_worker, (self, self.results))
+        self.relay = threading.Thread(target=self._relay_results, name="RabbitMQ-relay")
+        self.relay.daemon = True
+        self.relay.start()
+
+    def _stop_pool(self):
+        """Stop the worker processes, messages that are not done will be delivered again by RabbitMQ."""
+        if self.pool is None:
+            return
+        # the task of a worker process that exited is never completed, so close would wait forever
+        self.pool.terminate()
+        self.pool.join()
+        self.results.put(None)
+        self.relay.join(5)
+        self.pool = None
+        self.pool_workers = dict()
+
+    def _relay_results(self):
+        """Give the messages sent by the worker processes to their handler, until None is received."""
+        while True:
+            item = self.results.get()
+            if item is None:
+                break
+            (key, msg) = item
+            worker = self.pool_workers.get(key)
+            if worker is not None:
+                worker.receive(msg)
+
+    def process_workers(self):
+        """Send any pending messages of the workers to RabbitMQ and remove finished workers.
+
+        This needs to be called from the thread that owns the channel.
+        """
+        for worker in list(self.workers):
+            # check before sending messages so the last messages of a finished worker are not lost
+            finished = worker.finished()
+            worker.process_messages(self.channel)
+            if finished:
+                self.workers.remove(worker)
+                self.pool_workers.pop(worker.key, None)
+                self.processed += 1
+
+    def drain(self):
+        """Stop taking new messages and return from listen once the current messages are done.
+
+        Unlike stop this only sets a flag, so it can be called from a signal handler.
+        """
+        self.drain_requested = True
+
+    def recycle_needed(self):
+        """Return True if this connector has reached max_messages or max_rss."""
+        logger = logging.getLogger(__name__)
+        if self.max_messages and self.processed >= self.max_messages:
+            logger.info("Processed %d messages, stopping.", self.processed)
+            return True
+        if self.max_rss:
+            rss = pyclowder.utils.get_rss()
+            if rss >= self.max_rss:
+                logger.info("Using %d MB of memory, stopping.", rss // (1024 * 1024))
+                return True
+        return False
+
+    def wakeup(self):
+        """Wake up the thread that owns the channel so it will process the worker messages.
+
+        This is the only function of the connector that can be called from any thread.
+        """
+        connection = self.connection
+        if connection and hasattr(connection, 'add_callback_threadsafe'):
+            try:
+                connection.add_callback_threadsafe(self.process_workers)
+            except Exception:  # pylint: disable=broad-except
+                # connection is closing, any messages left will not be send
+                logging.getLogger(__name__).debug("Could not wake up connection.", exc_info=True)
 
     def stop(self):
         """Tell the connector to stop listening for messages."""
@@ -663,43 +1070,149 @@ class RabbitMQConnector(Connector):
         json_body = json.loads(body)
         if 'routing_key' not in json_body and method.routing_key:
             json_body['routing_key'] = method.routing_key
-
-        self.worker = RabbitMQHandler(self.extractor_info, self.check_message, self.process_message,
-                                      self.ssl_verify, self.mounted_paths, method, header, body)
-        self.worker.start_thread(json_body)
+        if self.recorder:
+            self.recorder.record(method.routing_key, json_body)
+
+        # a worker process can not tell this process it registered the extractor, so register here
+        host = json_body.get('host', '')
+        if self.pool and host:
+            self._register_with_host(host if host.endswith('/') else host + '/', json_body.get('secretKey', ''))
+
+        worker = RabbitMQHandler(self.extractor_info, self.check_message, self.process_message,
+                                 self.ssl_verify, self.mounted_paths, method, header, body,
+                                 workers_mode=self.workers_mode, notify=self.wakeup,
+                                 session_pool=self.session_pool, fetch_workers=self.fetch_workers,
+                                 fetch_host_limit=self.fetch_host_limit, download_cache=self.download_cache,
+                                 profiler=self.profiler)
+        self.workers.append(worker)
+        if self.pool:
+            self.next_key += 1
+            self.pool_workers[self.next_key] = worker
+            worker.start_in_pool(self.pool, self.next_key, json_body)
+        else:
+            worker.start_thread(json_body)
 
 
 class RabbitMQHandler(Connector):
-    """Simple handler that will process a single message at a time.
+    """Simple handler that will process a single message.
 
     To avoid sharing non-threadsafe channels across threads, this will maintain
-    a queue of messages that the super- loop can access and send later.
+    a queue of messages that the super- loop can access and send later. Since each
+    handler keeps the method and header of its own delivery, all acks and status
+    messages are routed back to the correct delivery.
+
+    If workers_mode is "process" the message is processed by a worker process of the
+    pool of the connector instead of a thread. The worker sends the messages to the
+    queue of the connector, and the connector gives them to this handler with receive.
+    If the worker process exits before the message is done, the message is sent to the
+    error queue.
+
+    The notify function is called (from the worker or relay thread) every time a message
+    is queued, and when the worker is finished.
     """
 
+    # seconds to wait for the last messages of a worker process that exited
+    lost_worker_grace = 5
+
     def __init__(self, extractor_info, check_message=None, process_message=None, ssl_verify=True,
-                 mounted_paths=None, method=None, header=None, body=None):
-        Connector.__init__(self, extractor_info, check_message, process_message, ssl_verify, mounted_paths)
+                 mounted_paths=None, method=None, header=None, body=None, workers_mode="thread",
+                 notify=None, session_pool=None, fetch_workers=4, fetch_host_limit=None, download_cache=None,
+                 profiler=None):
+        Connector.__init__(self, extractor_info, check_message, process_message, ssl_verify, mounted_paths,
+                           session_pool, fetch_workers, fetch_host_limit, download_cache, profiler)
         self.method = method
         self.header = header
         self.body = body
+        self.workers_mode = workers_mode
+        self.notify = notify
         self.messages = []
         self.thread = None
+        # process mode, in the parent
+        self.key = None
+        self.worker_pid = None
+        self.replied = False
+        self.done = False
+        self.lost_since = None
+        # process mode, in the worker process
+        self.results = None
 
     def start_thread(self, json_body):
         """Start the separate thread for processing & create a queue for messages.
 
         messages is a list of message objects:
         {
-            "type": status/ok/error/resubmit
+            "type": status/ok/error/resubmit/metrics
             "resource": resource
             "status": status (status_update only)
             "message": message content (status_update only)
             "retry_count": retry_count (message_resubmit only)
+            "metrics": metrics snapshot of the worker process (metrics only)
         }
         """
-        self.thread = threading.Thread(target=self._process_message, args=(json_body,))
+        self.thread = threading.Thread(target=self._process_message_in_thread, args=(json_body,))
         self.thread.start()
 
+    def start_in_pool(self, pool, key, json_body):
+        """Process the message in a worker process of the pool, key identifies its messages."""
+        self.key = key
+        # the worker process keeps its own gauge, count it here so it is visible in this process
+        pyclowder.metrics.registry.add('pyclowder_messages_inflight', 1)
+        pool.apply_async(_process_rabbitmq_message_in_worker, (key, json_body))
+
+    def receive(self, msg):
+        """Queue a message sent by the worker process, called by the relay thread of the connector."""
+        if msg["type"] == "started":
+            self.worker_pid = msg["pid"]
+        elif msg["type"] == "done":
+            self.done = True
+            pyclowder.metrics.registry.add('pyclowder_messages_inflight', -1)
+        else:
+            self.replied = self.replied or msg["type"] in ("ok", "error", "resubmit")
+            self.messages.append(msg)
+        self._notify()
+
+    def finished(self):
+        """Return whether the message is processed and all messages of the worker are queued."""
+        if self.thread is not None:
+            return not self.thread.is_alive()
+        if not self.done and self.worker_pid is not None and not _process_exists(self.worker_pid):
+            if self.lost_since is None:
+                self.lost_since = time.time()
+            elif time.time() - self.lost_since > self.lost_worker_grace:
+                logging.getLogger(__name__).error("Worker process %d exited while processing a message.",
+                                                  self.worker_pid)
+                if not self.replied:
+                    self.messages.append({"type": "error"})
+                self.done = True
+                pyclowder.metrics.registry.add('pyclowder_messages_inflight', -1)
+        return self.done
+
+    def _process_message_in_thread(self, json_body):
+        """Entry point of the worker thread."""
+        try:
+            self._process_message(json_body)
+        finally:
+            self._notify()
+
+    def _register_with_host(self, host, secret_key):
+        # a worker process is only sent messages after the connector registered the extractor
+        if self.results is None:
+            super(RabbitMQHandler, self)._register_with_host(host, secret_key)
+
+    def _notify(self):
+        if self.notify:
+            self.notify()
+
+    def _queue_message(self, msg):
+        """Queue a message to be send by the thread owning the channel."""
+        if self.results is not None:
+            # the resource is not used by the parent, and is not sent to keep the message small
+            msg.pop("resource", None)
+            self.results.put((self.key, msg))
+        else:
+            self.messages.append(msg)
+            self._notify()
+
     def process_messages(self, channel):
         while self.messages:
             msg = self.messages.pop(0)
@@ -715,6 +1228,9 @@ class RabbitMQHandler(Connector):
             elif msg["type"] == 'ok':
                 channel.basic_ack(self.method.delivery_tag)
 
+            elif msg["type"] == 'metrics':
+                pyclowder.metrics.registry.merge(msg['metrics'])
+
             elif msg["type"] == 'error':
                 properties = pika.BasicProperties(delivery_mode=2, reply_to=self.header.reply_to)
                 channel.basic_publish(exchange='',
@@ -747,56 +1263,147 @@ class RabbitMQHandler(Connector):
         status_report['extractor_id'] = self.extractor_info['name']
         status_report['status'] = "%s: %s" % (status, message)
         status_report['start'] = pyclowder.utils.iso8601time()
-        self.messages.append({"type": "status",
-                              "status": status_report,
-                              "resource": resource,
-                              "message": message})
+        self._queue_message({"type": "status",
+                             "status": status_report,
+                             "resource": resource,
+                             "message": message})
 
     def message_ok(self, resource):
         super(RabbitMQHandler, self).message_ok(resource)
-        self.messages.append({"type": "ok"})
+        self._queue_message({"type": "ok"})
 
     def message_error(self, resource):
         super(RabbitMQHandler, self).message_error(resource)
-        self.messages.append({"type": "error"})
+        self._queue_message({"type": "error"})
 
     def message_resubmit(self, resource, retry_count):
         super(RabbitMQHandler, self).message_resubmit(resource, retry_count)
-        self.messages.append({"type": "resubmit", "retry_count": retry_count})
+        self._queue_message({"type": "resubmit", "retry_count": retry_count})
 
 
 class HPCConnector(Connector):
-    """Takes pickle files and processes them."""
+    """Takes pickle files, or a manifest with one JSON message per line, and processes them.
+
+    With workers set to more than one the messages are processed by a pool of that many
+    processes, 0 uses all CPUs allocated to the job. If a checkpoint file is given, each
+    message that completed (processed or ignored by check_message) is appended to it, and
+    messages found in it are skipped, so a resubmitted job only processes the messages
+    that did not complete. Messages in the manifest are identified by a hash of their line.
+
+    Status updates are appended to the logfile of the message. The logfiles are kept open.
+    The first update of a message, and the update when it is done or fails, are written
+    right away, the updates in between are written status_flush_interval seconds after
+    the last write.
+    With status_shards each worker process writes to its own shard of the logfile, the
+    shards are appended to the logfile once all messages are processed.
+    """
 
     # pylint: disable=too-many-arguments
     def __init__(self, extractor_info, picklefile,
-                 check_message=None, process_message=None, ssl_verify=True, mounted_paths=None):
-        Connector.__init__(self, extractor_info, check_message, process_message, ssl_verify, mounted_paths)
+                 check_message=None, process_message=None, ssl_verify=True, mounted_paths=None, session_pool=None,
+                 fetch_workers=4, fetch_host_limit=None, download_cache=None, profiler=None,
+                 manifest=None, workers=1, checkpoint=None, status_flush_interval=5, status_shards=False):
+        Connector.__init__(self, extractor_info, check_message, process_message, ssl_verify, mounted_paths,
+                           session_pool, fetch_workers, fetch_host_limit, download_cache, profiler)
         self.picklefile = picklefile
+        self.manifest = manifest
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.status_shards = status_shards
+        self.status_log = pyclowder.utils.BufferedLogWriter(status_flush_interval, status_shards)
+        self.logfiles = set()
         self.logfile = None
+        self.completed = False
+        self.running = True
 
     def listen(self):
-        """Reads the picklefile, sets up the logfile and call _process_message."""
-        if isinstance(self.picklefile, str):
-            try:
-                with open(self.picklefile, 'rb') as pfile:
-                    body = pickle.load(pfile)
-                    self.logfile = body['logfile']
-                    self._process_message(body)
-            finally:
-                self.logfile = None
-        else:
-            for onepickle in self.picklefile:
+        """Reads the picklefiles and manifest, sets up the logfile and call _process_message."""
+        logger = logging.getLogger(__name__)
+
+        completed = set()
+        if self.checkpoint and os.path.isfile(self.checkpoint):
+            with open(self.checkpoint, 'r') as checkpoint:
+                completed = set(line.strip() for line in checkpoint if line.strip())
+            logger.info("Skipping %d messages found in checkpoint %s", len(completed), self.checkpoint)
+
+        workers = self.workers if self.workers > 0 else _allocated_cpus()
+        checkpoint = open(self.checkpoint, 'a') if self.checkpoint else None
+        count = 0
+        try:
+            messages = (m for m in self._read_messages() if m[0] not in completed)
+            if workers == 1:
+                results = (self._process_hpc_message(m) for m in messages)
+                for (key, done, _) in results:
+                    count += 1
+                    if done and checkpoint:
+                        checkpoint.write(key + '\n')
+                        checkpoint.flush()
+            else:
+                logger.info("Processing messages using %d processes", workers)
+                # limit the number of messages read ahead of the workers
+                semaphore = threading.Semaphore(workers * 2)
+                pool = multiprocessing.Pool(workers, _init_worker, (self,))
                 try:
-                    with open(onepickle, 'rb') as pfile:
-                        body = pickle.load(pfile)
-                        self.logfile = body['logfile']
-                        self._process_message(body)
+                    for (key, done, snapshot) in pool.imap_unordered(_process_hpc_message_in_worker,
+                                                                     _bounded(messages, semaphore)):
+                        semaphore.release()
+                        count += 1
+                        pyclowder.metrics.registry.merge(snapshot)
+                        if done and checkpoint:
+                            checkpoint.write(key + '\n')
+                            checkpoint.flush()
+                    pool.close()
                 finally:
-                    self.logfile = None
+                    # unblock reading messages, in case of an error
+                    for _ in range(workers * 2):
+                        semaphore.release()
+                    pool.terminate()
+                    pool.join()
+        finally:
+            if checkpoint:
+                checkpoint.close()
+            self.status_log.close()
+            if self.status_shards:
+                for logfile in filter(None, self.logfiles):
+                    pyclowder.utils.merge_log_shards(logfile)
+            self.running = False
+        logger.info("Processed %d messages", count)
+
+    def _read_messages(self):
+        """Yield (key, body) for every message in the pickle files and the manifest."""
+        for onepickle in _flatten(self.picklefile):
+            filename = getattr(onepickle, 'name', onepickle)
+            with open(filename, 'rb') as pfile:
+                body = pickle.load(pfile)
+            self.logfiles.add(body.get('logfile'))
+            yield (os.path.abspath(filename), body)
+        if self.manifest:
+            with open(self.manifest, 'r') as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line:
+                        body = json.loads(line)
+                        self.logfiles.add(body.get('logfile'))
+                        yield (hashlib.sha1(line.encode('utf-8')).hexdigest(), body)
+
+    def _process_hpc_message(self, message):
+        """Process a single message, returns (key, completed, metrics)."""
+        (key, body) = message
+        self.completed = False
+        self.logfile = body.get('logfile')
+        try:
+            self._process_message(body)
+        finally:
+            self.logfile = None
+            self.status_log.flush()
+        return (key, self.completed, None)
+
+    def message_ok(self, resource):
+        super(HPCConnector, self).message_ok(resource)
+        self.completed = True
 
     def alive(self):
-        return self.logfile is not None
+        return self.running
 
     def status_update(self, status, resource, message):
         """Store notification on log file with update"""
@@ -804,15 +1411,17 @@ class HPCConnector(Connector):
         logger = logging.getLogger(__name__)
         logger.debug("[%s] : %s : %s", resource["id"], status, message)
 
-        if self.logfile and os.path.isfile(self.logfile) is True:
+        if self.logfile:
             try:
-                with open(self.logfile, 'a') as log:
-                    statusreport = dict()
-                    statusreport['file_id'] = resource["id"]
-                    statusreport['extractor_id'] = self.extractor_info['name']
-                    statusreport['status'] = "%s: %s" % (status, message)
-                    statusreport['start'] = time.strftime('%Y-%m-%dT%H:%M:%S')
-                    log.write(json.dumps(statusreport) + '\n')
+                statusreport = dict()
+                statusreport['file_id'] = resource["id"]
+                statusreport['extractor_id'] = self.extractor_info['name']
+                statusreport['status'] = "%s: %s" % (status, message)
+                statusreport['start'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                # write the first and last update of a message right away, only batch the ones in between
+                force = status in (pyclowder.utils.StatusMessage.start, pyclowder.utils.StatusMessage.done,
+                                   pyclowder.utils.StatusMessage.error)
+                self.status_log.write(self.logfile, json.dumps(statusreport), force)
             except:
                 logger.exception("Error: unable to write extractor status to log file")
                 raise
@@ -824,18 +1433,318 @@ class LocalConnector(Connector):
 
     This will get the file to be processed from environment variables
 
+    The input can be a file, a folder (all files in it and its subfolders are processed),
+    a glob pattern or a list of these, and input_file_list can name a file with one path
+    per line. All files are processed in this process, using a pool of worker threads or
+    processes (workers_mode), 0 workers uses all CPUs allocated to the job. A file that
+    fails is logged and counted, and does not stop the other files. If output_file_path is
+    a folder, or more than one file is processed, the output of each file is written in that
+    folder (which is created if needed) using the path of the file relative to its input
+    folder.
+
+    If output_jsonl is set, all metadata is appended to that JSON Lines file instead, one
+    record with the input path, endpoint and metadata for each upload. The file is rotated
+    once it is larger than output_jsonl_max_bytes.
+
+    If manifest is set, the path, size, modification time (and with manifest_hash the SHA1
+    hash) of each processed file is stored in that file, together with the extractor name
+    and version and whether it was processed. Files that were processed by the same
+    version of the extractor and did not change are skipped when run again. With
+    watch_interval set the input is listed again every watch_interval seconds, and new or
+    changed files are processed once they did not change between two listings, until
+    stop is called.
     """
 
-    def __init__(self, extractor_info, input_file_path, process_message=None, output_file_path=None):
-        super(LocalConnector, self).__init__(extractor_info, process_message=process_message)
+    # pylint: disable=too-many-arguments
+    def __init__(self, extractor_info, input_file_path, process_message=None, output_file_path=None, profiler=None,
+                 input_file_list=None, workers=1, workers_mode="thread", progress_interval=10,
+                 output_jsonl=None, output_jsonl_max_bytes=0, manifest=None, manifest_hash=False, watch_interval=0):
+        super(LocalConnector, self).__init__(extractor_info, process_message=process_message, profiler=profiler)
         self.input_file_path = input_file_path
+        self.input_file_list = input_file_list
         self.output_file_path = output_file_path
+        # folder the output of each file is written to, and the folders of the input it is relative to
+        self.output_folder = None
+        self.input_roots = []
+        self.workers = workers
+        self.workers_mode = workers_mode
+        self.progress_interval = progress_interval
+        self.output_sink = None
+        if output_jsonl:
+            self.output_sink = pyclowder.utils.JsonLinesSink(output_jsonl, output_jsonl_max_bytes)
+        self.manifest = manifest
+        self.manifest_hash = manifest_hash
+        self.watch_interval = watch_interval
+        self.extractor_version = "%s %s" % (extractor_info.get('name'), extractor_info.get('version'))
+        # last entry of each file, also used to find changed files when watching
+        self.manifest_entries = dict() if manifest or watch_interval else None
+        # size and modification time of the files being processed, and that failed
+        self.manifest_state = dict()
+        self.failed = dict()
+        self.manifest_sink = None
+        self.manifest_lines = 0
+        self.stopping = threading.Event()
+        # file processed by the current thread
+        self.current = threading.local()
         self.completed_processing = False
 
     def listen(self):
+        logger = logging.getLogger(__name__)
+
+        workers = self.workers if self.workers > 0 else _allocated_cpus()
+        if workers > 1:
+            logger.info("Processing files using %d %s workers", workers, self.workers_mode)
+        if self.manifest:
+            self._load_manifest()
+        try:
+            if not self._prepare_output_folder():
+                return
+            polled = dict()
+            while True:
+                counts = {"ok": 0, "error": 0, "skipped": 0}
+                started = time.time()
+                self._process_files(self._changed_files(counts, polled), workers, counts, started)
+                if counts["ok"] or counts["error"]:
+                    self._log_progress(counts, started)
+                elif not self.watch_interval:
+                    if counts["skipped"]:
+                        logger.info("All %d local input files are unchanged.", counts["skipped"])
+                    else:
+                        logger.error("No local input files found. Please check the path.")
+                if not self.watch_interval:
+                    break
+                self.stopping.wait(self.watch_interval)
+                if self.stopping.is_set():
+                    break
+        finally:
+            if self.output_sink:
+                self.output_sink.close()
+            if self.manifest_sink:
+                self.manifest_sink.close()
+                self._compact_manifest()
+            self.completed_processing = True
+
+    def _process_files(self, files, workers, counts, started):
+        """Process the files, using a pool if more than one worker is used, and update counts."""
+        # don't start a pool if there is nothing to do
+        first = next(files, None)
+        if first is None:
+            return
+        files = itertools.chain([first], files)
+
+        last_report = started
+        pool = None
+        if workers == 1:
+            results = (self._process_local_file(f) for f in files)
+        else:
+            # limit the number of files listed ahead of the workers
+            semaphore = threading.Semaphore(workers * 2)
+            if self.workers_mode == "process":
+                pool = multiprocessing.Pool(workers, _init_local_worker, (self,))
+                results = pool.imap_unordered(_process_local_file_in_worker, _bounded(files, semaphore))
+            else:
+                pool = ThreadPool(workers)
+                results = pool.imap_unordered(self._process_local_file, _bounded(files, semaphore))
+        try:
+            for (input_file_path, outcome, snapshot) in results:
+                if workers > 1:
+                    semaphore.release()
+                if snapshot:
+                    pyclowder.metrics.registry.merge(snapshot)
+                counts[outcome] += 1
+                if self.manifest_entries is not None:
+                    self._update_manifest(input_file_path, outcome)
+                if time.time() - last_report >= self.progress_interval:
+                    last_report = time.time()
+                    self._log_progress(counts, started)
+            if pool:
+                # let the workers exit, so they write their output
+                pool.close()
+                pool.join()
+                pool = None
+        finally:
+            if pool:
+                # unblock listing files, in case of an error
+                for _ in range(workers * 2):
+                    semaphore.release()
+                pool.terminate()
+                pool.join()
+
+    def _changed_files(self, counts, polled):
+        """Yield the input files that are not in the manifest, or changed since they were processed.
+
+        When watching, a file is only returned once it did not change between two polls, so
+        files that are still being written are not processed yet.
+        """
+        for input_file_path in self._input_files():
+            if self.manifest_entries is None:
+                yield input_file_path
+                continue
+            try:
+                info = os.stat(input_file_path)
+            except OSError:
+                continue
+            state = (info.st_size, info.st_mtime)
+            if self.watch_interval and polled.get(input_file_path) != state:
+                polled[input_file_path] = state
+                continue
+            if self.failed.get(input_file_path) == state:
+                # only retry files that failed in this run once they change
+                continue
+            entry = self.manifest_entries.get(os.path.abspath(input_file_path))
+            if entry and entry['status'] == "ok" and entry['extractor'] == self.extractor_version:
+                if (entry['size'], entry['mtime']) == state:
+                    counts["skipped"] += 1
+                    continue
+                if self.manifest_hash and entry.get('hash') == _file_hash(input_file_path):
+                    # touched, but not changed
+                    entry['size'], entry['mtime'] = state
+                    if self.manifest_sink:
+                        self.manifest_sink.write(json.dumps(entry, separators=(',', ':')))
+                        self.manifest_lines += 1
+                    counts["skipped"] += 1
+                    continue
+            self.manifest_state[input_file_path] = state
+            yield input_file_path
+
+    def _load_manifest(self):
+        """Read the manifest, the last entry of each file is used."""
+        self.manifest_lines = 0
+        if os.path.isfile(self.manifest):
+            with open(self.manifest, 'r') as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partially written line
+                        continue
+                    self.manifest_entries[entry['path']] = entry
+                    self.manifest_lines += 1
+        self.manifest_sink = pyclowder.utils.JsonLinesSink(self.manifest)
+
+    def _update_manifest(self, input_file_path, outcome):
+        """Store the outcome of processing a file in the manifest."""
+        (size, mtime) = self.manifest_state.pop(input_file_path)
+        if outcome == "error":
+            self.failed[input_file_path] = (size, mtime)
+        entry = {
+            'path': os.path.abspath(input_file_path),
+            'size': size,
+            'mtime': mtime,
+            'extractor': self.extractor_version,
+            'status': outcome
+        }
+        if self.manifest_hash and outcome == "ok":
+            entry['hash'] = _file_hash(input_file_path)
+        self.manifest_entries[entry['path']] = entry
+        if self.manifest_sink:
+            self.manifest_sink.write(json.dumps(entry, separators=(',', ':')))
+            self.manifest_lines += 1
+
+    def _compact_manifest(self):
+        """Rewrite the manifest with only the last entry of each file, if it grew too large."""
+        if self.manifest_lines <= 2 * len(self.manifest_entries) + 1000:
+            return
+        tmp_path = self.manifest + ".tmp"
+        with open(tmp_path, 'w') as manifest:
+            for entry in self.manifest_entries.values():
+                manifest.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        os.rename(tmp_path, self.manifest)
+
+    def _inputs(self):
+        """Return the input paths, folders and patterns, including those in input_file_list."""
+        inputs = list(_flatten(self.input_file_path))
+        if self.input_file_list:
+            with open(self.input_file_list, 'r') as file_list:
+                inputs.extend(line.strip() for line in file_list if line.strip())
+        return inputs
+
+    def _prepare_output_folder(self):
+        """Create the output folder if more than one file is processed, returns False if it can not be used.
+
+        The output of each file is written in the output folder using its path relative to the input folder,
+        so files with the same name in different folders do not overwrite each others output.
+        """
+        if not self.output_file_path:
+            return True
+        inputs = self._inputs()
+        if len(inputs) == 1 and os.path.isfile(inputs[0]) and not os.path.isdir(self.output_file_path):
+            return True
+        if not os.path.isdir(self.output_file_path):
+            if os.path.exists(self.output_file_path):
+                logging.getLogger(__name__).error("Local output path %s is not a folder, but more than one file "
+                                                  "is processed.", self.output_file_path)
+                return False
+            os.makedirs(self.output_file_path)
+        self.output_folder = self.output_file_path
+        files = []
+        for path in inputs:
+            if os.path.isdir(path):
+                self.input_roots.append(os.path.abspath(path))
+            elif glob.has_magic(path):
+                prefix = []
+                for part in os.path.abspath(path).split(os.sep)[:-1]:
+                    if glob.has_magic(part):
+                        break
+                    prefix.append(part)
+                self.input_roots.append(os.sep.join(prefix) or os.sep)
+            else:
+                files.append(os.path.dirname(os.path.abspath(path)))
+        if files:
+            common = os.path.commonprefix([folder.rstrip(os.sep) + os.sep for folder in files])
+            self.input_roots.append(os.path.dirname(common))
+        # use the deepest folder an input file is in
+        self.input_roots.sort(key=len, reverse=True)
+        return True
+
+    def _input_files(self):
+        """Yield the path of every file that needs to be processed."""
+        for path in self._inputs():
+            if os.path.isdir(path):
+                for (dirpath, dirnames, filenames) in os.walk(path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        if not self._is_output(os.path.join(dirpath, filename)):
+                            yield os.path.join(dirpath, filename)
+            elif os.path.isfile(path):
+                yield path
+            elif glob.has_magic(path):
+                for filename in sorted(glob.glob(path)):
+                    if os.path.isfile(filename) and not self._is_output(filename):
+                        yield filename
+            else:
+                logging.getLogger(__name__).error("Local input file %s is not a regular file.", path)
+
+    def _is_output(self, path):
+        """Return whether the file is written by this connector, these are not processed."""
+        logger = logging.getLogger(__name__)
+        if not self.output_file_path and not self.output_sink and path.endswith(".json") and \
+                os.path.isfile(path[:-5]):
+            # without an output path the output of a file is written next to it
+            logger.debug("Skipping %s, it is the output of %s", path, path[:-5])
+            return True
+        path = os.path.abspath(path)
+        if self.output_folder:
+            outputs = [os.path.abspath(self.output_folder) + os.sep]
+        elif self.output_file_path:
+            outputs = [os.path.abspath(self.output_file_path), os.path.abspath(self.output_file_path) + ".json"]
+        else:
+            outputs = []
+        if any(path == output or (output.endswith(os.sep) and path.startswith(output)) for output in outputs):
+            logger.debug("Skipping %s, it is in the output path", path)
+            return True
+        # the JSON Lines output and the manifest, including rotated files
+        for output in [self.manifest, self.output_sink.filename if self.output_sink else None]:
+            if output and (path == os.path.abspath(output) or path.startswith(os.path.abspath(output) + ".")):
+                logger.debug("Skipping %s, it is written by this connector", path)
+                return True
+        return False
+
+    def _process_local_file(self, input_file_path):
+        """Process a single file, returns (input_file_path, outcome, metrics)."""
         local_parameters = dict()
-        local_parameters["inputfile"] = self.input_file_path
-        local_parameters["outputfile"] = self.output_file_path
+        local_parameters["inputfile"] = input_file_path
+        local_parameters["outputfile"] = self._output_file_path(input_file_path)
 
         # Set other parameters to emtpy string
         local_parameters["fileid"] = None
@@ -850,26 +1759,63 @@ class LocalConnector(Connector):
         local_parameters["secretKey"] = None
         local_parameters["routing_key"] = None
 
-        ext = os.path.splitext(self.input_file_path)[1]
+        ext = os.path.splitext(input_file_path)[1]
         resource = {
             "type": "file",
             "id": "",
             "intermediate_id": "",
-            "name": self.input_file_path,
+            "name": input_file_path,
             "file_ext": ext,
             "parent": dict(),
-            "local_paths": [self.input_file_path]
+            "local_paths": [input_file_path]
         }
 
-        # TODO: BD-1638 Call _process_message by generating pseudo JSON responses from get method
-        self.process_message(self, "", "", resource, local_parameters)
-        self.completed_processing = True
+        metrics = pyclowder.metrics.registry
+        outcome = "error"
+        self.current.input_file_path = input_file_path
+        try:
+            # TODO: BD-1638 Call _process_message by generating pseudo JSON responses from get method
+            with metrics.timer('pyclowder_stage_seconds', stage='process_message'):
+                self._call_process_message("", "", resource, local_parameters)
+            outcome = "ok"
+        except Exception:  # pylint: disable=broad-except
+            logging.getLogger(__name__).exception("Error processing local file %s", input_file_path)
+        finally:
+            self.current.input_file_path = None
+            metrics.inc('pyclowder_messages_total', outcome=outcome)
+        return (input_file_path, outcome, None)
+
+    def _output_file_path(self, input_file_path):
+        """Return the output file path of an input file."""
+        if not self.output_folder:
+            return self.output_file_path
+        input_file_path = os.path.abspath(input_file_path)
+        relative_path = input_file_path.lstrip(os.sep)
+        for root in self.input_roots:
+            if input_file_path.startswith(root.rstrip(os.sep) + os.sep):
+                relative_path = input_file_path[len(root.rstrip(os.sep)) + 1:]
+                break
+        output_file_path = os.path.join(self.output_folder, relative_path + ".json")
+        try:
+            os.makedirs(os.path.dirname(output_file_path))
+        except OSError:
+            # already created, possibly by another worker
+            if not os.path.isdir(os.path.dirname(output_file_path)):
+                raise
+        return output_file_path
+
+    @staticmethod
+    def _log_progress(counts, started):
+        elapsed = time.time() - started
+        total = counts["ok"] + counts["error"]
+        logging.getLogger(__name__).info("Processed %d files (%d failed) in %.1f seconds, %.1f files/second",
+                                         total, counts["error"], elapsed, total / elapsed if elapsed else 0)
 
     def alive(self):
         return not self.completed_processing
 
     def stop(self):
-        pass
+        self.stopping.set()
 
     def get(self, url, params=None, raise_status=True, **kwargs):
         logging.getLogger(__name__).debug("GET: " + url)
@@ -881,16 +1827,27 @@ class LocalConnector(Connector):
         # Handle metadata POST endpoints
         if url.find("/technicalmetadatajson") != -1 or url.find("/metadata.jsonld") != -1:
 
+            if self.output_sink:
+                metadata = data if data is not None else json.dumps(json_data)
+                if '\n' in metadata:
+                    metadata = json.dumps(json.loads(metadata), separators=(',', ':'))
+                self.output_sink.write('{"input":%s,"endpoint":%s,"metadata":%s}' % (
+                    json.dumps(getattr(self.current, 'input_file_path', None)), json.dumps(url.split('?')[0]),
+                    metadata))
+                return
+
             json_metadata_formatted_string = json.dumps(json.loads(data), indent=4, sort_keys=True)
             logging.getLogger(__name__).debug(json_metadata_formatted_string)
             extension = ".json"
 
             # If output file path is not set
-            if self.output_file_path is None or self.output_file_path == "":
+            input_file_path = getattr(self.current, 'input_file_path', None)
+            output_file_path = self._output_file_path(input_file_path)
+            if output_file_path is None or output_file_path == "":
                 # Create json filename from the input filename
-                json_filename = self.input_file_path + extension
+                json_filename = input_file_path + extension
             else:
-                json_filename = str(self.output_file_path)
+                json_filename = str(output_file_path)
                 if not json_filename.endswith(extension):
                     json_filename += extension
 
@@ -915,3 +1872,111 @@ class LocalConnector(Connector):
     def delete(self, url, raise_status=True, **kwargs):
         logging.getLogger(__name__).debug("DELETE: " + url)
         return None
+
+
+# connector used by the worker processes of the connectors
+_worker_connector = None
+# queue the worker processes of RabbitMQConnector send their messages to
+_worker_results = None
+
+
+def _init_worker(connector):
+    """Initialize a worker process of a connector, the connector is inherited when forked."""
+    global _worker_connector  # pylint: disable=global-statement
+    _worker_connector = connector
+
+
+def _process_hpc_message_in_worker(message):
+    """Process a message in a worker process, the metrics of the message are returned to the parent."""
+    pyclowder.metrics.registry.reset()
+    (key, completed, _) = _worker_connector._process_hpc_message(message)  # pylint: disable=protected-access
+    return (key, completed, pyclowder.metrics.registry.snapshot())
+
+
+def _init_rabbitmq_worker(connector, results):
+    """Initialize a worker process of the RabbitMQConnector, its messages are put on the results queue."""
+    global _worker_results  # pylint: disable=global-statement
+    _init_worker(connector)
+    _worker_results = results
+
+
+def _process_rabbitmq_message_in_worker(key, json_body):
+    """Process a message in a worker process, all messages of the handler are sent to the parent."""
+    connector = _worker_connector
+    handler = RabbitMQHandler(connector.extractor_info, connector.check_message, connector.process_message,
+                              connector.ssl_verify, connector.mounted_paths, session_pool=connector.session_pool,
+                              fetch_workers=connector.fetch_workers, fetch_host_limit=connector.fetch_host_limit,
+                              download_cache=connector.download_cache, profiler=connector.profiler)
+    handler.key = key
+    handler.results = _worker_results
+    handler._queue_message({"type": "started", "pid": os.getpid()})  # pylint: disable=protected-access
+    # only send the metrics of this message to the parent
+    pyclowder.metrics.registry.reset()
+    try:
+        handler._process_message(json_body)  # pylint: disable=protected-access
+    finally:
+        handler._queue_message({"type": "metrics",  # pylint: disable=protected-access
+                                "metrics": pyclowder.metrics.registry.snapshot()})
+        handler._queue_message({"type": "done"})  # pylint: disable=protected-access
+
+
+def _process_exists(pid):
+    """Return whether the process with this pid is still running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+def _init_local_worker(connector):
+    """Initialize a worker process of the LocalConnector, its output is written when the worker exits."""
+    _init_worker(connector)
+    if connector.output_sink:
+        multiprocessing.util.Finalize(None, connector.output_sink.close, exitpriority=10)
+
+
+def _process_local_file_in_worker(input_file_path):
+    """Process a local file in a worker process, the metrics of the file are returned to the parent."""
+    pyclowder.metrics.registry.reset()
+    (_, outcome, _) = _worker_connector._process_local_file(input_file_path)  # pylint: disable=protected-access
+    return (input_file_path, outcome, pyclowder.metrics.registry.snapshot())
+
+
+def _file_hash(path):
+    """Return the SHA1 hash of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as content:
+        for chunk in iter(lambda: content.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _allocated_cpus():
+    """Return the number of CPUs allocated to this job by the batch system, or usable by this process."""
+    for name in ['SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE', 'PBS_NUM_PPN', 'NSLOTS']:
+        value = os.getenv(name, '')
+        if value.isdigit() and int(value) > 0:
+            return int(value)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def _flatten(items):
+    """Yield all items in (nested) lists, a single item is yielded as is."""
+    if items is None:
+        return
+    if isinstance(items, (list, tuple)):
+        for item in items:
+            for value in _flatten(item):
+                yield value
+    else:
+        yield items
+
+
+def _bounded(iterable, semaphore):
+    """Acquire the semaphore before yielding each item, the consumer releases it."""
+    for item in iterable:
+        semaphore.acquire()
+        yield item
@@ -6,8 +6,12 @@ import json
 import logging
 import os
 import tempfile
-import requests
-from pyclowder.utils import StatusMessage
+from pyclowder.cache import ResponseCache
+from pyclowder.utils import StatusMessage, default_connector, stream_zip_contents
+
+# cache for dataset information and file lists, shared by all connectors in this process. It is
+# disabled unless its ttl is set, which Extractor.setup does using --dataset-cache-ttl.
+info_cache = ResponseCache(ttl=0)
 
 
 def create_empty(connector, host, key, datasetname, description, parentid=None, spaceid=None):
@@ -23,30 +27,32 @@ def create_empty(connector, host, key, datasetname, description, parentid=None,
     spaceid -- id of the space to add dataset to
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
 
     url = '%sapi/datasets/createempty?key=%s' % (host, key)
 
     if parentid:
         if spaceid:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description, "collection": [parentid],
-                                   "space": [spaceid]}), verify=connector.ssl_verify if connector else True)
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data=json.dumps({"name": datasetname, "description": description,
+                                                     "collection": [parentid], "space": [spaceid]}),
+                                    verify=connector.ssl_verify)
         else:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description, "collection": [parentid]}),
-                                   verify=connector.ssl_verify if connector else True)
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data=json.dumps({"name": datasetname, "description": description,
+                                                     "collection": [parentid]}),
+                                    verify=connector.ssl_verify)
     else:
         if spaceid:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description, "space": [spaceid]}),
-                                   verify=connector.ssl_verify if connector else True)
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data=json.dumps({"name": datasetname, "description": description,
+                                                     "space": [spaceid]}),
+                                    verify=connector.ssl_verify)
         else:
-            result = requests.post(url, headers={"Content-Type": "application/json"},
-                                   data=json.dumps({"name": datasetname, "description": description}),
-                                   verify=False)
-
-    result.raise_for_status()
+            result = connector.post(url, headers={"Content-Type": "application/json"},
+                                    data=json.dumps({"name": datasetname, "description": description}),
+                                    verify=False)
 
     datasetid = result.json()['id']
     logger.debug("dataset id = [%s]", datasetid)
@@ -64,13 +70,13 @@ def download(connector, host, key, datasetid):
     datasetid -- the file that is currently being processed
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "dataset", "id": datasetid}, "Downloading dataset.")
 
     # fetch dataset zipfile
     url = '%sapi/datasets/%s/download?key=%s' % (host, datasetid, key)
-    result = requests.get(url, stream=True,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url, stream=True,
+                           verify=connector.ssl_verify)
 
     (filedescriptor, zipfile) = tempfile.mkstemp(suffix=".zip")
     with os.fdopen(filedescriptor, "w") as outfile:
@@ -80,6 +86,41 @@ def download(connector, host, key, datasetid):
     return zipfile
 
 
+def download_extract(connector, host, key, datasetid, output_folder, file_types=None):
+    """Download dataset from Clowder and extract the files while the zip file is downloaded.
+
+    This is a generator that yields the path of each file once it is extracted. The zip
+    file itself is never written to disk.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    datasetid -- the file that is currently being processed
+    output_folder -- folder to extract the files into
+    file_types -- only extract files matching these extensions or mime types (such as .tif or image/*)
+    """
+
+    connector = default_connector(connector)
+    connector.status_update(StatusMessage.processing, {"type": "dataset", "id": datasetid}, "Downloading dataset.")
+
+    # fetch dataset zipfile
+    url = '%sapi/datasets/%s/download?key=%s' % (host, datasetid, key)
+    result = connector.get(url, stream=True,
+                           verify=connector.ssl_verify)
+    result.raw.decode_content = True
+
+    try:
+        for path in stream_zip_contents(result.raw, output_folder, file_types):
+            yield path
+        # read the rest of the zip file (the central directory), otherwise the connection
+        # can not be reused for the next request
+        for _ in result.iter_content(65536):
+            pass
+    finally:
+        result.close()
+
+
 def download_metadata(connector, host, key, datasetid, extractor=None):
     """Download dataset JSON-LD metadata from Clowder.
 
@@ -91,18 +132,18 @@ def download_metadata(connector, host, key, datasetid, extractor=None):
     extractor -- extractor name to filter results (if only one extractor's metadata is desired)
     """
 
+    connector = default_connector(connector)
     filterstring = "" if extractor is None else "&extractor=%s" % extractor
     url = '%sapi/datasets/%s/metadata.jsonld?key=%s%s' % (host, datasetid, key, filterstring)
 
     # fetch data
-    result = requests.get(url, stream=True,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url, stream=True,
+                           verify=connector.ssl_verify)
 
     return result.json()
 
 
-def get_info(connector, host, key, datasetid):
+def get_info(connector, host, key, datasetid, use_cache=True):
     """Get basic dataset information from UUID.
 
     Keyword arguments:
@@ -110,18 +151,17 @@ def get_info(connector, host, key, datasetid):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     datasetid -- the dataset to get info of
+    use_cache -- set to False to ignore any recently cached information
     """
 
+    connector = default_connector(connector)
     url = "%sapi/datasets/%s?key=%s" % (host, datasetid, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    return info_cache.get(connector, url, tag=datasetid, use_cache=use_cache,
+                          verify=connector.ssl_verify)
 
-    return json.loads(result.text)
 
-
-def get_file_list(connector, host, key, datasetid):
+def get_file_list(connector, host, key, datasetid, use_cache=True):
     """Get list of files in a dataset as JSON object.
 
     Keyword arguments:
@@ -129,14 +169,14 @@ def get_file_list(connector, host, key, datasetid):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     datasetid -- the dataset to get filelist of
+    use_cache -- set to False to ignore any recently cached file list
     """
 
+    connector = default_connector(connector)
     url = "%sapi/datasets/%s/listFiles?key=%s" % (host, datasetid, key)
 
-    result = requests.get(url, verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
-
-    return json.loads(result.text)
+    return info_cache.get(connector, url, tag=datasetid, use_cache=use_cache,
+                          verify=connector.ssl_verify)
 
 
 def remove_metadata(connector, host, key, datasetid, extractor=None):
@@ -151,13 +191,13 @@ def remove_metadata(connector, host, key, datasetid, extractor=None):
                     !!! ALL JSON-LD METADATA WILL BE REMOVED IF NO extractor PROVIDED !!!
     """
 
+    connector = default_connector(connector)
     filterstring = "" if extractor is None else "&extractor=%s" % extractor
     url = '%sapi/datasets/%s/metadata.jsonld?key=%s%s' % (host, datasetid, key, filterstring)
 
     # fetch data
-    result = requests.delete(url, stream=True,
-                             verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.delete(url, stream=True,
+                              verify=connector.ssl_verify)
 
 
 def submit_extraction(connector, host, key, datasetid, extractorname):
@@ -171,13 +211,13 @@ def submit_extraction(connector, host, key, datasetid, extractorname):
     extractorname -- registered name of extractor to trigger
     """
 
+    connector = default_connector(connector)
     url = "%sapi/datasets/%s/extractions?key=%s" % (host, datasetid, key)
 
-    result = requests.post(url,
-                           headers={'Content-Type': 'application/json'},
-                           data=json.dumps({"extractor": extractorname}),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url,
+                            headers={'Content-Type': 'application/json'},
+                            data=json.dumps({"extractor": extractorname}),
+                            verify=connector.ssl_verify)
 
     return result.status_code
 
@@ -193,11 +233,11 @@ def upload_metadata(connector, host, key, datasetid, metadata):
     metadata -- the metadata to be uploaded
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "dataset", "id": datasetid},
                             "Uploading dataset metadata.")
 
     headers = {'Content-Type': 'application/json'}
     url = '%sapi/datasets/%s/metadata.jsonld?key=%s' % (host, datasetid, key)
-    result = requests.post(url, headers=headers, data=json.dumps(metadata),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url, headers=headers, data=json.dumps(metadata),
+                            verify=connector.ssl_verify)
@@ -13,14 +13,21 @@ import json
 import logging
 import logging.config
 import os
+import signal
 import sys
 import threading
 import traceback
 import re
 import time
 
+import pyclowder.datasets
+import pyclowder.geostreams
+import pyclowder.metrics
+from pyclowder.cache import DownloadCache
 from pyclowder.connectors import RabbitMQConnector, HPCConnector, LocalConnector
-from pyclowder.utils import CheckMessage, setup_logging
+from pyclowder.profiling import MessageProfiler
+from pyclowder.recording import MessageRecorder
+from pyclowder.utils import CheckMessage, SessionPool, setup_logging
 
 
 class Extractor(object):
@@ -63,6 +70,38 @@ class Extractor(object):
         mounted_paths = os.getenv("MOUNTED_PATHS", "{}")
         input_file_path = os.getenv("INPUT_FILE_PATH")
         output_file_path = os.getenv("OUTPUT_FILE_PATH")
+        input_file_list = os.getenv("INPUT_FILE_LIST")
+        local_workers = int(os.getenv("LOCAL_WORKERS", "1"))
+        output_jsonl = os.getenv("OUTPUT_JSONL")
+        output_jsonl_max_size = int(os.getenv("OUTPUT_JSONL_MAX_SIZE", "0"))
+        local_manifest = os.getenv("LOCAL_MANIFEST")
+        local_manifest_hash = os.getenv('LOCAL_MANIFEST_HASH', "False").lower() == "true"
+        watch_interval = float(os.getenv("WATCH_INTERVAL", "0"))
+        max_inflight = int(os.getenv("MAX_INFLIGHT", "1"))
+        workers_mode = os.getenv("WORKERS_MODE", "thread")
+        http_pool_size = int(os.getenv("HTTP_POOL_SIZE", "10"))
+        http_timeout = os.getenv("HTTP_TIMEOUT")
+        fetch_workers = int(os.getenv("FETCH_WORKERS", "4"))
+        fetch_host_limit = os.getenv("FETCH_HOST_LIMIT")
+        download_cache = os.getenv("DOWNLOAD_CACHE")
+        download_cache_size = int(os.getenv("DOWNLOAD_CACHE_SIZE", "10240"))
+        dataset_cache_ttl = float(os.getenv("DATASET_CACHE_TTL", "10"))
+        geostreams_cache_ttl = float(os.getenv("GEOSTREAMS_CACHE_TTL", "300"))
+        prefork = os.getenv('PREFORK', "False").lower() == "true"
+        max_messages = int(os.getenv("MAX_MESSAGES", "0"))
+        max_rss = int(os.getenv("MAX_RSS", "0"))
+        metrics_port = os.getenv("METRICS_PORT")
+        metrics_file = os.getenv("METRICS_FILE")
+        profile_dir = os.getenv("PROFILE_DIR")
+        profile_fraction = float(os.getenv("PROFILE_FRACTION", "1"))
+        profile_slow = float(os.getenv("PROFILE_SLOW", "0"))
+        profile_max_size = int(os.getenv("PROFILE_MAX_SIZE", "1024"))
+        record_messages = os.getenv("RECORD_MESSAGES")
+        hpc_manifest = os.getenv("HPC_MANIFEST")
+        hpc_workers = int(os.getenv("HPC_WORKERS", "1"))
+        hpc_checkpoint = os.getenv("HPC_CHECKPOINT")
+        status_flush_interval = float(os.getenv("STATUS_FLUSH_INTERVAL", "5"))
+        status_shards = os.getenv('STATUS_SHARDS', "False").lower() == "true"
         connector_default = "RabbitMQ"
         if os.getenv('LOCAL_PROCESSING', "False").lower() == "true":
             connector_default = "Local"
@@ -76,9 +115,61 @@ class Extractor(object):
                                  help='file or url or logging coonfiguration (default=None)')
         self.parser.add_argument('--num', '-n', type=int, nargs='?', default=1,
                                  help='number of parallel instances (default=1)')
+        self.parser.add_argument('--max-inflight', type=int, nargs='?', dest="max_inflight", default=max_inflight,
+                                 help='number of messages processed concurrently by each RabbitMQ instance '
+                                      '(default=%d)' % max_inflight)
+        self.parser.add_argument('--workers-mode', type=str, nargs='?', dest="workers_mode", default=workers_mode,
+                                 choices=["thread", "process"],
+                                 help='process messages in a thread or in a separate process, use process for '
+                                      'CPU bound extractors (default=%s)' % workers_mode)
+        self.parser.add_argument('--prefork', dest="prefork", action='store_true', default=prefork,
+                                 help='call warmup once and fork --num worker processes that each listen to '
+                                      'RabbitMQ, instead of starting --num threads')
+        self.parser.add_argument('--max-messages', type=int, dest="max_messages", default=max_messages,
+                                 help='replace a prefork worker after it processed this many messages, 0 is no '
+                                      'limit (default=%d)' % max_messages)
+        self.parser.add_argument('--max-rss', type=int, dest="max_rss", default=max_rss,
+                                 help='replace a prefork worker once it uses this many MB of memory, 0 is no '
+                                      'limit (default=%d)' % max_rss)
+        self.parser.add_argument('--metrics-port', type=int, dest="metrics_port", default=metrics_port,
+                                 help='serve metrics in the Prometheus text format on this port of localhost, with '
+                                      '--prefork worker n uses port + n (default=%s)' % metrics_port)
+        self.parser.add_argument('--metrics-file', dest="metrics_file", default=metrics_file,
+                                 help='write the metrics to this file on shutdown, with --prefork each worker '
+                                      'appends its process id (default=%s)' % metrics_file)
+        self.parser.add_argument('--profile-dir', dest="profile_dir", default=profile_dir,
+                                 help='run process_message under cProfile and write the profiles to this folder '
+                                      '(default=%s)' % profile_dir)
+        self.parser.add_argument('--profile-fraction', type=float, dest="profile_fraction", default=profile_fraction,
+                                 help='fraction of the messages that is profiled (default=%s)' % profile_fraction)
+        self.parser.add_argument('--profile-slow', type=float, dest="profile_slow", default=profile_slow,
+                                 help='only keep profiles of messages that took at least this many seconds '
+                                      '(default=%s)' % profile_slow)
+        self.parser.add_argument('--profile-max-size', type=int, dest="profile_max_size", default=profile_max_size,
+                                 help='maximum size of all profiles in MB, the oldest are removed first '
+                                      '(default=%d)' % profile_max_size)
+        self.parser.add_argument('--record-messages', dest="record_messages", default=record_messages,
+                                 help='append the messages received from RabbitMQ to this JSON Lines file, to '
+                                      'replay them with benchmarks/replay.py (default=%s)' % record_messages)
         self.parser.add_argument('--pickle', type=file, nargs='*', dest="hpc_picklefile",
                                  default=None, action='append',
                                  help='pickle file that needs to be processed (only needed for HPC)')
+        self.parser.add_argument('--manifest', dest="hpc_manifest", default=hpc_manifest,
+                                 help='file with one JSON message per line that needs to be processed (only needed '
+                                      'for HPC) (default=%s)' % hpc_manifest)
+        self.parser.add_argument('--hpc-workers', type=int, dest="hpc_workers", default=hpc_workers,
+                                 help='number of processes used to process the HPC messages, 0 uses all CPUs '
+                                      'allocated to the job (default=%d)' % hpc_workers)
+        self.parser.add_argument('--checkpoint', dest="hpc_checkpoint", default=hpc_checkpoint,
+                                 help='file listing the HPC messages that completed, these are skipped when the '
+                                      'job is run again (default=%s)' % hpc_checkpoint)
+        self.parser.add_argument('--status-flush-interval', type=float, dest="status_flush_interval",
+                                 default=status_flush_interval,
+                                 help='seconds after the last write to the HPC logfile after which the next status '
+                                      'update writes the buffered updates (default=%s)' % status_flush_interval)
+        self.parser.add_argument('--status-shards', dest="status_shards", action='store_true', default=status_shards,
+                                 help='each HPC worker writes status updates to its own shard of the logfile, the '
+                                      'shards are merged once all messages are processed')
         self.parser.add_argument('--register', '-r', nargs='?', dest="regstration_endpoints",
                                  default=registration_endpoints,
                                  help='Clowder registration URL (default=%s)' % registration_endpoints)
@@ -89,10 +180,62 @@ class Extractor(object):
         self.parser.add_argument('--mounts', '-m', dest="mounted_paths", default=mounted_paths,
                                  help="dictionary of {'remote path':'local path'} mount mappings")
         self.parser.add_argument('--input-file-path', '-ifp', dest="input_file_path", default=input_file_path,
-                                 help="Full path to local input file to be processed (used by Big Data feature)")
+                                 help="Full path to local input file, folder or glob pattern to be processed "
+                                      "(used by Big Data feature)")
         self.parser.add_argument('--output-file-path', '-ofp', dest="output_file_path", default=output_file_path,
-                                 help="Full path to local output JSON file to store metadata "
+                                 help="Full path to local output JSON file, or folder, to store metadata "
+                                      "(used by Big Data feature)")
+        self.parser.add_argument('--input-file-list', dest="input_file_list", default=input_file_list,
+                                 help="file with the paths of local input files to be processed, one per line "
                                       "(used by Big Data feature)")
+        self.parser.add_argument('--local-workers', type=int, dest="local_workers", default=local_workers,
+                                 help='number of local input files processed at the same time, using --workers-mode, '
+                                      '0 uses all CPUs allocated to the job (default=%d)' % local_workers)
+        self.parser.add_argument('--output-jsonl', dest="output_jsonl", default=output_jsonl,
+                                 help='append the metadata of all local input files to this JSON Lines file instead '
+                                      'of writing a JSON file for each upload (default=%s)' % output_jsonl)
+        self.parser.add_argument('--output-jsonl-max-size', type=int, dest="output_jsonl_max_size",
+                                 default=output_jsonl_max_size,
+                                 help='rotate the JSON Lines file once it is larger than this many MB, 0 never '
+                                      'rotates the file (default=%d)' % output_jsonl_max_size)
+        self.parser.add_argument('--local-manifest', dest="local_manifest", default=local_manifest,
+                                 help='file that records which local input files were processed, unchanged files '
+                                      'are skipped when run again (default=%s)' % local_manifest)
+        self.parser.add_argument('--local-manifest-hash', dest="local_manifest_hash", action='store_true',
+                                 default=local_manifest_hash,
+                                 help='store the SHA1 hash of local input files in the manifest, files that were '
+                                      'touched but did not change are skipped')
+        self.parser.add_argument('--watch', type=float, dest="watch_interval", default=watch_interval,
+                                 help='list the local input files again every this many seconds and process new or '
+                                      'changed files, 0 stops once all files are processed (default=%s)'
+                                      % watch_interval)
+        self.parser.add_argument('--http-pool-size', type=int, dest="http_pool_size", default=http_pool_size,
+                                 help='number of connections kept open to each clowder host (default=%d)'
+                                      % http_pool_size)
+        self.parser.add_argument('--http-timeout', type=float, dest="http_timeout", default=http_timeout,
+                                 help='timeout in seconds for requests to clowder (default=%s)' % http_timeout)
+        self.parser.add_argument('--http-no-keepalive', dest="http_keepalive", action='store_false',
+                                 help='close the connection to clowder after each request')
+        self.parser.add_argument('--fetch-workers', type=int, dest="fetch_workers", default=fetch_workers,
+                                 help='number of files of a dataset downloaded in parallel (default=%d)'
+                                      % fetch_workers)
+        self.parser.add_argument('--fetch-host-limit', type=int, dest="fetch_host_limit", default=fetch_host_limit,
+                                 help='maximum number of files downloaded in parallel from a single clowder host, '
+                                      'for all messages combined (default=%s)' % fetch_host_limit)
+        self.parser.add_argument('--download-cache', dest="download_cache", default=download_cache,
+                                 help='folder used to cache downloaded files, shared by all extractors on this node '
+                                      '(default=%s)' % download_cache)
+        self.parser.add_argument('--download-cache-size', type=int, dest="download_cache_size",
+                                 default=download_cache_size,
+                                 help='maximum size of the download cache in MB (default=%d)' % download_cache_size)
+        self.parser.add_argument('--dataset-cache-ttl', type=float, dest="dataset_cache_ttl",
+                                 default=dataset_cache_ttl,
+                                 help='number of seconds dataset information and file lists are cached, 0 disables '
+                                      'the cache (default=%s)' % dataset_cache_ttl)
+        self.parser.add_argument('--geostreams-cache-ttl', type=float, dest="geostreams_cache_ttl",
+                                 default=geostreams_cache_ttl,
+                                 help='number of seconds geostreams sensors and streams are cached, 0 disables the '
+                                      'cache (default=%s)' % geostreams_cache_ttl)
         self.parser.add_argument('--sslignore', '-s', dest="sslverify", action='store_false',
                                  help='should SSL certificates be ignores')
         self.parser.add_argument('--version', action='version', version='%(prog)s 1.0')
@@ -114,6 +257,10 @@ class Extractor(object):
         # start logging system
         setup_logging(self.args.logging)
 
+        # configure cache for dataset information and geostreams sensors and streams
+        pyclowder.datasets.info_cache.ttl = self.args.dataset_cache_ttl
+        pyclowder.geostreams.metadata_cache.ttl = self.args.geostreams_cache_ttl
+
     def start(self):
         """Create the connector and start listening.
 
@@ -122,60 +269,73 @@ class Extractor(object):
         all connectors have stopped or the user kills the program.
         """
         logger = logging.getLogger(__name__)
+
+        self.warmup()
+        if self.args.prefork and self.args.connector == "RabbitMQ":
+            self._start_prefork()
+            return
+
+        metrics_server = None
+        if self.args.metrics_port:
+            metrics_server = pyclowder.metrics.registry.serve(self.args.metrics_port)
+
         connectors = list()
+        session_pool = SessionPool(pool_size=self.args.http_pool_size, timeout=self.args.http_timeout,
+                                   keep_alive=self.args.http_keepalive)
+        download_cache = None
+        if self.args.download_cache:
+            download_cache = DownloadCache(self.args.download_cache, self.args.download_cache_size * 1024 * 1024)
         for connum in xrange(self.args.num):
             if self.args.connector == "RabbitMQ":
                 if 'rabbitmq_uri' not in self.args:
                     logger.error("Missing URI for RabbitMQ")
                 else:
-                    rabbitmq_key = []
-                    if not self.args.nobind:
-                        for key, value in self.extractor_info['process'].iteritems():
-                            for mt in value:
-                                # Replace trailing '*' with '#'
-                                mt = re.sub('(\*$)', '#', mt)
-                                if mt.find('*') > -1:
-                                    logger.error("Invalid '*' found in rabbitmq_key: %s" % mt)
-                                else:
-                                    if mt == "":
-                                        rabbitmq_key.append("*.%s.#" % key)
-                                    else:
-                                        rabbitmq_key.append("*.%s.%s" % (key, mt.replace("/", ".")))
-
-                    rconn = RabbitMQConnector(self.extractor_info,
-                                              check_message=self.check_message,
-                                              process_message=self.process_message,
-                                              rabbitmq_uri=self.args.rabbitmq_uri,
-                                              rabbitmq_exchange=self.args.rabbitmq_exchange,
-                                              rabbitmq_key=rabbitmq_key,
-                                              mounted_paths=json.loads(self.args.mounted_paths))
+                    rconn = self._create_rabbitmq_connector(session_pool, download_cache)
                     rconn.connect()
                     rconn.register_extractor(self.args.regstration_endpoints)
                     connectors.append(rconn)
                     threading.Thread(target=rconn.listen, name="Connector-" + str(connum)).start()
             elif self.args.connector == "HPC":
-                if 'hpc_picklefile' not in self.args:
-                    logger.error("Missing hpc_picklefile for HPCExtractor")
+                if not self.args.hpc_picklefile and not self.args.hpc_manifest:
+                    logger.error("Missing hpc_picklefile or hpc_manifest for HPCExtractor")
                 else:
                     hconn = HPCConnector(self.extractor_info,
                                          check_message=self.check_message,
                                          process_message=self.process_message,
                                          picklefile=self.args.hpc_picklefile,
-                                         mounted_paths=json.loads(self.args.mounted_paths))
+                                         manifest=self.args.hpc_manifest,
+                                         workers=self.args.hpc_workers,
+                                         checkpoint=self.args.hpc_checkpoint,
+                                         status_flush_interval=self.args.status_flush_interval,
+                                         status_shards=self.args.status_shards,
+                                         mounted_paths=json.loads(self.args.mounted_paths),
+                                         session_pool=session_pool,
+                                         fetch_workers=self.args.fetch_workers,
+                                         fetch_host_limit=self.args.fetch_host_limit,
+                                         download_cache=download_cache,
+                                         profiler=self._create_profiler())
                     hconn.register_extractor(self.args.regstration_endpoints)
                     connectors.append(hconn)
                     threading.Thread(target=hconn.listen, name="Connector-" + str(connum)).start()
             elif self.args.connector == "Local":
 
-                if self.args.input_file_path is None:
+                if self.args.input_file_path is None and self.args.input_file_list is None:
                     logger.error("Environment variable INPUT_FILE_PATH or parameter --input-file-path is not set. "
                                  "Please try again after setting one of these")
-                elif not os.path.isfile(self.args.input_file_path):
-                    logger.error("Local input file is not a regular file. Please check the path.")
                 else:
                     local_connector = LocalConnector(self.extractor_info, self.args.input_file_path,
                                                      process_message=self.process_message,
-                                                     output_file_path=self.args.output_file_path)
+                                                     output_file_path=self.args.output_file_path,
+                                                     profiler=self._create_profiler(),
+                                                     input_file_list=self.args.input_file_list,
+                                                     workers=self.args.local_workers,
+                                                     workers_mode=self.args.workers_mode,
+                                                     output_jsonl=self.args.output_jsonl,
+                                                     output_jsonl_max_bytes=(self.args.output_jsonl_max_size *
+                                                                             1024 * 1024),
+                                                     manifest=self.args.local_manifest,
+                                                     manifest_hash=self.args.local_manifest_hash,
+                                                     watch_interval=self.args.watch_interval)
                     connectors.append(local_connector)
                     threading.Thread(target=local_connector.listen, name="Connector-" + str(connum)).start()
             else:
@@ -194,6 +354,159 @@ class Extractor(object):
 
         while connectors:
             connectors.pop(0).stop()
+        session_pool.close()
+
+        if metrics_server:
+            metrics_server.shutdown()
+        if self.args.metrics_file:
+            pyclowder.metrics.registry.dump(self.args.metrics_file)
+
+    def _create_profiler(self):
+        """Create the MessageProfiler if --profile-dir is set."""
+        if not self.args.profile_dir:
+            return None
+        return MessageProfiler(self.args.profile_dir, fraction=self.args.profile_fraction,
+                               slow_threshold=self.args.profile_slow,
+                               max_bytes=self.args.profile_max_size * 1024 * 1024)
+
+    def _create_rabbitmq_connector(self, session_pool, download_cache, max_messages=0, max_rss=0):
+        """Create a RabbitMQConnector bound to the message types in extractor_info."""
+        logger = logging.getLogger(__name__)
+
+        rabbitmq_key = []
+        if not self.args.nobind:
+            for key, value in self.extractor_info['process'].iteritems():
+                for mt in value:
+                    # Replace trailing '*' with '#'
+                    mt = re.sub('(\*$)', '#', mt)
+                    if mt.find('*') > -1:
+                        logger.error("Invalid '*' found in rabbitmq_key: %s" % mt)
+                    else:
+                        if mt == "":
+                            rabbitmq_key.append("*.%s.#" % key)
+                        else:
+                            rabbitmq_key.append("*.%s.%s" % (key, mt.replace("/", ".")))
+
+        return RabbitMQConnector(self.extractor_info,
+                                 check_message=self.check_message,
+                                 process_message=self.process_message,
+                                 rabbitmq_uri=self.args.rabbitmq_uri,
+                                 rabbitmq_exchange=self.args.rabbitmq_exchange,
+                                 rabbitmq_key=rabbitmq_key,
+                                 mounted_paths=json.loads(self.args.mounted_paths),
+                                 max_inflight=self.args.max_inflight,
+                                 workers_mode=self.args.workers_mode,
+                                 session_pool=session_pool,
+                                 fetch_workers=self.args.fetch_workers,
+                                 fetch_host_limit=self.args.fetch_host_limit,
+                                 download_cache=download_cache,
+                                 max_messages=max_messages,
+                                 max_rss=max_rss,
+                                 profiler=self._create_profiler(),
+                                 recorder=MessageRecorder(self.args.record_messages)
+                                 if self.args.record_messages else None)
+
+    def _start_prefork(self):
+        """Fork --num workers that each listen to RabbitMQ, and replace them when they stop.
+
+        The workers are forked after warmup, so they share the state of the extractor with the
+        parent copy-on-write. A worker stops after --max-messages messages or once it uses more
+        than --max-rss MB of memory, and is replaced by a new worker forked from the parent.
+        """
+        logger = logging.getLogger(__name__)
+
+        # register once, instead of in every worker
+        session_pool = SessionPool(pool_size=self.args.http_pool_size, timeout=self.args.http_timeout,
+                                   keep_alive=self.args.http_keepalive)
+        self._create_rabbitmq_connector(session_pool, None).register_extractor(self.args.regstration_endpoints)
+        session_pool.close()
+
+        stopping = [False]
+
+        def stop(signum, frame):  # pylint: disable=unused-argument
+            stopping[0] = True
+        signal.signal(signal.SIGTERM, stop)
+
+        children = dict()
+        logger.info("Waiting for messages. To exit press CTRL+C")
+        try:
+            while not stopping[0]:
+                while len(children) < self.args.num:
+                    slot = min(set(range(self.args.num)) - set(c[0] for c in children.values()))
+                    pid = os.fork()
+                    if pid == 0:
+                        self._run_prefork_worker(slot)
+                    logger.debug("Started worker %d.", pid)
+                    children[pid] = (slot, time.time())
+
+                (pid, status) = os.waitpid(-1, os.WNOHANG) if children else (0, 0)
+                if pid == 0:
+                    time.sleep(1)
+                    continue
+                (_, started) = children.pop(pid)
+                if status != 0:
+                    logger.error("Worker %d stopped with status %d.", pid, status)
+                    # avoid restarting workers as fast as possible when they fail on startup
+                    if time.time() - started < 10:
+                        time.sleep(10)
+                else:
+                    logger.debug("Worker %d stopped.", pid)
+        except KeyboardInterrupt:
+            stopping[0] = True
+        except BaseException:
+            logger.exception("Error while running workers.")
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def _run_prefork_worker(self, slot):
+        """Listen to RabbitMQ in a forked worker, this never returns."""
+        logger = logging.getLogger(__name__)
+        status = 0
+        try:
+            # the parent will tell the workers when to stop, using SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            pyclowder.metrics.registry.reset()
+            if self.args.metrics_port:
+                pyclowder.metrics.registry.serve(self.args.metrics_port + slot)
+
+            session_pool = SessionPool(pool_size=self.args.http_pool_size, timeout=self.args.http_timeout,
+                                       keep_alive=self.args.http_keepalive)
+            download_cache = None
+            if self.args.download_cache:
+                download_cache = DownloadCache(self.args.download_cache, self.args.download_cache_size * 1024 * 1024)
+            rconn = self._create_rabbitmq_connector(session_pool, download_cache, self.args.max_messages,
+                                                    self.args.max_rss * 1024 * 1024)
+            signal.signal(signal.SIGTERM, lambda signum, frame: rconn.drain())
+            rconn.connect()
+            rconn.listen()
+            session_pool.close()
+            if self.args.metrics_file:
+                pyclowder.metrics.registry.dump("%s.%d" % (self.args.metrics_file, os.getpid()))
+        except BaseException:  # pylint: disable=broad-except
+            logger.exception("Error in worker %d.", os.getpid())
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)  # pylint: disable=protected-access
+
+    def warmup(self):
+        """Load any state the extractor needs before messages are processed.
+
+        This is called once by start, before any connector is created. With --prefork it is
+        called in the parent process, so all workers share this state.
+        """
+        pass
 
     def get_metadata(self, content, resource_type, resource_id, server=None):
         """Generate a metadata field.
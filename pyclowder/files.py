@@ -12,7 +12,7 @@ import requests
 from urllib3.filepost import encode_multipart_formdata
 
 import pyclowder.datasets
-from pyclowder.utils import StatusMessage
+from pyclowder.utils import MultipartEncoder, StatusMessage, default_connector, upload_progress
 
 # Some sources of urllib3 support warning suppression, but not all
 try:
@@ -36,6 +36,7 @@ def download(connector, host, key, fileid, intermediatefileid=None, ext=""):
     ext -- the file extension, the downloaded file will end with this extension
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "file", "id": fileid}, "Downloading file.")
 
     # TODO: intermediateid doesn't really seem to be used here, can we remove entirely?
@@ -43,7 +44,7 @@ def download(connector, host, key, fileid, intermediatefileid=None, ext=""):
         intermediatefileid = fileid
 
     url = '%sapi/files/%s?key=%s' % (host, intermediatefileid, key)
-    result = connector.get(url, stream=True, verify=connector.ssl_verify if connector else True)
+    result = connector.get(url, stream=True, verify=connector.ssl_verify)
 
     (inputfile, inputfilename) = tempfile.mkstemp(suffix=ext)
     try:
@@ -66,10 +67,11 @@ def download_info(connector, host, key, fileid):
     fileid -- the file to fetch metadata of
     """
 
+    connector = default_connector(connector)
     url = '%sapi/files/%s/metadata?key=%s' % (host, fileid, key)
 
     # fetch data
-    result = connector.get(url, stream=True, verify=connector.ssl_verify if connector else True)
+    result = connector.get(url, stream=True, verify=connector.ssl_verify)
 
     return result.json()
 
@@ -85,11 +87,12 @@ def download_metadata(connector, host, key, fileid, extractor=None):
     extractor -- extractor name to filter results (if only one extractor's metadata is desired)
     """
 
+    connector = default_connector(connector)
     filterstring = "" if extractor is None else "&extractor=%s" % extractor
     url = '%sapi/files/%s/metadata.jsonld?key=%s%s' % (host, fileid, key, filterstring)
 
     # fetch data
-    result = connector.get(url, stream=True, verify=connector.ssl_verify if connector else True)
+    result = connector.get(url, stream=True, verify=connector.ssl_verify)
 
     return result.json()
 
@@ -105,12 +108,13 @@ def submit_extraction(connector, host, key, fileid, extractorname):
     extractorname -- registered name of extractor to trigger
     """
 
+    connector = default_connector(connector)
     url = "%sapi/files/%s/extractions?key=%s" % (host, fileid, key)
 
     result = connector.post(url,
                             headers={'Content-Type': 'application/json'},
                             data=json.dumps({"extractor": extractorname}),
-                            verify=connector.ssl_verify if connector else True)
+                            verify=connector.ssl_verify)
 
     return result.json()
 
@@ -126,16 +130,17 @@ def upload_metadata(connector, host, key, fileid, metadata):
     metadata -- the metadata to be uploaded
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "file", "id": fileid}, "Uploading file metadata.")
 
     headers = {'Content-Type': 'application/json'}
     url = '%sapi/files/%s/metadata.jsonld?key=%s' % (host, fileid, key)
     result = connector.post(url, headers=headers, data=json.dumps(metadata),
-                            verify=connector.ssl_verify if connector else True)
+                            verify=connector.ssl_verify)
 
 
 # pylint: disable=too-many-arguments
-def upload_preview(connector, host, key, fileid, previewfile, previewmetadata):
+def upload_preview(connector, host, key, fileid, previewfile, previewmetadata, filename=None, progress=False):
     """Upload preview to Clowder.
 
     Keyword arguments:
@@ -143,11 +148,14 @@ def upload_preview(connector, host, key, fileid, previewfile, previewmetadata):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     fileid -- the file that is currently being processed
-    previewfile -- the file containing the preview
+    previewfile -- the file containing the preview, either a path, a file-like object or a bytes buffer
     previewmetadata -- any metadata to be associated with preview, can contain a section_id
                     to indicate the section this preview should be associated with.
+    filename -- (optional) name of the preview, defaults to the name of previewfile
+    progress -- (optional) send status updates while the preview is uploaded
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "file", "id": fileid}, "Uploading file preview.")
 
     logger = logging.getLogger(__name__)
@@ -155,8 +163,8 @@ def upload_preview(connector, host, key, fileid, previewfile, previewmetadata):
 
     # upload preview
     url = '%sapi/previews?key=%s' % (host, key)
-    with open(previewfile, 'rb') as filebytes:
-        result = connector.post(url, files={"File": filebytes}, verify=connector.ssl_verify if connector else True)
+    result = _upload(connector, url, previewfile, filename,
+                     {"type": "file", "id": fileid} if progress else None, "Uploading file preview")
     previewid = result.json()['id']
     logger.debug("preview id = [%s]", previewid)
 
@@ -164,13 +172,13 @@ def upload_preview(connector, host, key, fileid, previewfile, previewmetadata):
     if fileid and not (previewmetadata and previewmetadata['section_id']):
         url = '%sapi/files/%s/previews/%s?key=%s' % (host, fileid, previewid, key)
         result = connector.post(url, headers=headers, data=json.dumps({}),
-                                verify=connector.ssl_verify if connector else True)
+                                verify=connector.ssl_verify)
 
     # associate metadata with preview
     if previewmetadata is not None:
         url = '%sapi/previews/%s/metadata?key=%s' % (host, previewid, key)
         result = connector.post(url, headers=headers, data=json.dumps(previewmetadata),
-                                verify=connector.ssl_verify if connector else True)
+                                verify=connector.ssl_verify)
 
     return previewid
 
@@ -186,15 +194,16 @@ def upload_tags(connector, host, key, fileid, tags):
     tags -- the tags to be uploaded
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "file", "id": fileid}, "Uploading file tags.")
 
     headers = {'Content-Type': 'application/json'}
     url = '%sapi/files/%s/tags?key=%s' % (host, fileid, key)
     result = connector.post(url, headers=headers, data=json.dumps(tags),
-                            verify=connector.ssl_verify if connector else True)
+                            verify=connector.ssl_verify)
 
 
-def upload_thumbnail(connector, host, key, fileid, thumbnail):
+def upload_thumbnail(connector, host, key, fileid, thumbnail, filename=None):
     """Upload thumbnail to Clowder.
 
     Keyword arguments:
@@ -202,15 +211,16 @@ def upload_thumbnail(connector, host, key, fileid, thumbnail):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     fileid -- the file that the thumbnail should be associated with
-    thumbnail -- the file containing the thumbnail
+    thumbnail -- the file containing the thumbnail, either a path, a file-like object or a bytes buffer
+    filename -- (optional) name of the thumbnail, defaults to the name of thumbnail
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
     url = host + 'api/fileThumbnail?key=' + key
 
     # upload preview
-    with open(thumbnail, 'rb') as inputfile:
-        result = connector.post(url, files={"File": inputfile}, verify=connector.ssl_verify if connector else True)
+    result = _upload(connector, url, thumbnail, filename)
     thumbnailid = result.json()['id']
     logger.debug("thumbnail id = [%s]", thumbnailid)
 
@@ -219,12 +229,14 @@ def upload_thumbnail(connector, host, key, fileid, thumbnail):
         headers = {'Content-Type': 'application/json'}
         url = host + 'api/files/' + fileid + '/thumbnails/' + thumbnailid + '?key=' + key
         result = connector.post(url, headers=headers, data=json.dumps({}),
-                                verify=connector.ssl_verify if connector else True)
+                                verify=connector.ssl_verify)
 
     return thumbnailid
 
 
-def upload_to_dataset(connector, host, key, datasetid, filepath, check_duplicate=False):
+# pylint: disable=too-many-arguments
+def upload_to_dataset(connector, host, key, datasetid, filepath, check_duplicate=False, filename=None,
+                      progress=False):
     """Upload file to existing Clowder dataset.
 
     Keyword arguments:
@@ -232,31 +244,39 @@ def upload_to_dataset(connector, host, key, datasetid, filepath, check_duplicate
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     datasetid -- the dataset that the file should be associated with
-    filepath -- path to file
+    filepath -- path to file, or a file-like object or bytes buffer with the contents of the file
     check_duplicate -- check if filename already exists in dataset and skip upload if so
+    filename -- (optional) name of the file in clowder, required if filepath is a bytes buffer
+    progress -- (optional) send status updates while the file is uploaded
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
+    is_path = isinstance(filepath, basestring)
+    if filename is None:
+        filename = os.path.basename(filepath if is_path else getattr(filepath, 'name', ''))
 
     if check_duplicate:
         ds_files = pyclowder.datasets.get_file_list(connector, host, key, datasetid)
         found_output_in_dataset = False
         for f in ds_files:
-            if f['filename'] == os.path.basename(filepath):
+            if f['filename'] == filename:
                 logger.debug("found %s in dataset %s; not re-uploading" % (f['filename'], datasetid))
 
-    for source_path in connector.mounted_paths:
-        if filepath.startswith(connector.mounted_paths[source_path]):
-            return _upload_to_dataset_local(connector, host, key, datasetid, filepath)
+    if is_path:
+        for source_path in connector.mounted_paths:
+            if filepath.startswith(connector.mounted_paths[source_path]):
+                return _upload_to_dataset_local(connector, host, key, datasetid, filepath)
 
     url = '%sapi/uploadToDataset/%s?key=%s' % (host, datasetid, key)
 
-    if os.path.exists(filepath):
-        result = connector.post(url, files={"File": open(filepath, 'rb')},
-                                verify=connector.ssl_verify if connector else True)
+    if not is_path or os.path.exists(filepath):
+        result = _upload(connector, url, filepath, filename,
+                         {"type": "dataset", "id": datasetid} if progress else None, "Uploading file")
 
         uploadedfileid = result.json()['id']
         logger.debug("uploaded file id = [%s]", uploadedfileid)
+        pyclowder.datasets.info_cache.invalidate(datasetid)
 
         return uploadedfileid
     else:
@@ -289,11 +309,33 @@ def _upload_to_dataset_local(connector, host, key, datasetid, filepath):
             ("file", '{"path":"%s"}' % filepath)
         ])
         result = connector.post(url, data=content, headers={'Content-Type': header},
-                                verify=connector.ssl_verify if connector else True)
+                                verify=connector.ssl_verify)
 
         uploadedfileid = result.json()['id']
         logger.debug("uploaded file id = [%s]", uploadedfileid)
+        pyclowder.datasets.info_cache.invalidate(datasetid)
 
         return uploadedfileid
     else:
         logger.error("unable to upload local file %s (not found)", filepath)
+
+
+def _upload(connector, url, source, filename, resource=None, message=None):
+    """Upload a file using a streaming multipart body, so the file is never loaded in memory.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    url -- the url to post the file to
+    source -- path to file, file-like object or bytes buffer
+    filename -- name of the file, if None the name of source is used
+    resource -- (optional) resource to send upload progress status updates for
+    message -- message used for the progress status updates
+    """
+
+    callback = upload_progress(connector, resource, message) if resource else None
+    encoder = MultipartEncoder([("File", (filename, source))], callback)
+    try:
+        return connector.post(url, data=encoder, headers={'Content-Type': encoder.content_type},
+                              verify=connector.ssl_verify)
+    finally:
+        encoder.close()
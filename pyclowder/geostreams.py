@@ -3,12 +3,193 @@
 This module provides simple wrappers around the clowder Geostreams API
 """
 
+import array
+import codecs
+import copy
+import datetime
 import json
 import logging
+import math
+import numbers
 import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import requests
 
+from pyclowder.utils import default_connector
+
+# numpy is optional, only used to serialize numpy columns faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class GeostreamsCache(object):
+    """In memory cache of the sensors and streams in Geostreams.
+
+    All sensors (or streams) of a host are loaded with a single request and kept for
+    ttl seconds. Lookups by name use a dict, lookups by circle or polygon use a grid
+    index with cells of cell_size degrees, so no request is sent to the server. New
+    sensors and streams created with create_sensor and create_stream are added to
+    the cache.
+
+    Keyword arguments:
+    ttl -- number of seconds the sensors and streams are kept, 0 disables the cache
+    cell_size -- size in degrees of the cells of the spatial index
+    """
+
+    def __init__(self, ttl=300, cell_size=1.0):
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    # pylint: disable=too-many-arguments
+    def find_by_name(self, connector, host, key, kind, name):
+        """Return the sensor or stream with the given name, or None.
+
+        Names that are not in the cache are looked up on the server, so sensors and streams
+        created by others since the cache was loaded are still found.
+
+        Keyword arguments:
+        connector -- connector used to send the request
+        host -- the clowder host, including http and port, should end with a /
+        key -- the secret key to login to clowder
+        kind -- either sensors or streams
+        name -- name to search for
+        """
+        entry = self._load(connector, host, key, kind)
+        with self.lock:
+            item = entry['names'].get(name)
+        if item is None:
+            url = "%sapi/geostreams/%s?%s_name=%s&key=%s" % (host, kind, kind[:-1], name, key)
+            result = connector.get(url, verify=connector.ssl_verify)
+            for found in result.json():
+                if found.get('name') == name:
+                    item = found
+                    self.add(host, kind, item)
+                    break
+        return copy.deepcopy(item)
+
+    # pylint: disable=too-many-arguments
+    def find_by_circle(self, connector, host, key, kind, lon, lat, radius=0):
+        """Return the sensors or streams within radius meters of the point, or None."""
+        entry = self._load(connector, host, key, kind)
+
+        (lon, lat, radius) = (float(lon), float(lat), float(radius))
+        dlat = radius / 111320.0
+        dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+        with self.lock:
+            candidates = entry['grid'].query((lon - dlon, lat - dlat, lon + dlon, lat + dlat))
+        result = []
+        for item in candidates:
+            coords = _geometry_coordinates(item.get('geometry'))
+            if any(_distance(lon, lat, c[0], c[1]) <= radius for c in coords) or \
+                    _in_geometry(lon, lat, item.get('geometry')):
+                result.append(item)
+        return copy.deepcopy(result) if result else None
+
+    def find_by_polygon(self, connector, host, key, kind, coord_list):
+        """Return the sensors or streams inside the polygon, or None.
+
+        The coord_list is either a list of (lon, lat) pairs, or a flat list of lat, lon values
+        as used by the geocode parameter of Geostreams.
+        """
+        entry = self._load(connector, host, key, kind)
+
+        if coord_list and isinstance(coord_list[0], (list, tuple)):
+            polygon = [(float(c[0]), float(c[1])) for c in coord_list]
+        else:
+            polygon = [(float(coord_list[i + 1]), float(coord_list[i])) for i in range(0, len(coord_list) - 1, 2)]
+        with self.lock:
+            candidates = entry['grid'].query(_bbox(polygon))
+        result = []
+        for item in candidates:
+            coords = _geometry_coordinates(item.get('geometry'))
+            if any(_in_polygon(c[0], c[1], polygon) for c in coords):
+                result.append(item)
+        return copy.deepcopy(result) if result else None
+
+    def add(self, host, kind, item):
+        """Add a new sensor or stream to the cache, if the cache for the host is loaded."""
+        with self.lock:
+            entry = self.entries.get((host, kind))
+            if entry:
+                self._insert(entry, copy.deepcopy(item))
+
+    def clear(self):
+        """Remove all sensors and streams."""
+        with self.lock:
+            self.entries = dict()
+
+    # pylint: disable=too-many-arguments
+    def _load(self, connector, host, key, kind):
+        """Return the cache entry for the host, fetching all sensors or streams if needed."""
+        with self.lock:
+            entry = self.entries.get((host, kind))
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry
+
+        url = "%sapi/geostreams/%s?key=%s" % (host, kind, key)
+        result = connector.get(url, verify=connector.ssl_verify)
+        entry = {'time': time.time(), 'names': dict(), 'grid': _GridIndex(self.cell_size), 'count': 0}
+        for item in result.json():
+            self._insert(entry, item)
+        logging.getLogger(__name__).debug("loaded %d %s from %s", entry['count'], kind, host)
+        with self.lock:
+            self.entries[(host, kind)] = entry
+        return entry
+
+    @staticmethod
+    def _insert(entry, item):
+        """Add a sensor or stream to the name lookup and spatial index."""
+        if 'name' in item:
+            entry['names'].setdefault(item['name'], item)
+        coords = _geometry_coordinates(item.get('geometry'))
+        if coords:
+            entry['grid'].insert(item, _bbox(coords))
+        entry['count'] += 1
+
+
+class _GridIndex(object):
+    """Spatial index that stores items in each grid cell their bounding box overlaps."""
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = dict()
+        self.count = 0
+
+    def insert(self, item, bbox):
+        """Add item with bounding box (minlon, minlat, maxlon, maxlat)."""
+        self.count += 1
+        for cell in self._cells(bbox):
+            self.cells.setdefault(cell, []).append((self.count, item))
+
+    def query(self, bbox):
+        """Return the items in cells overlapping the bounding box, in the order they were inserted."""
+        found = dict()
+        for cell in self._cells(bbox):
+            for (position, item) in self.cells.get(cell, []):
+                found[position] = item
+        return [found[k] for k in sorted(found)]
+
+    def _cells(self, bbox):
+        minx = int(math.floor(bbox[0] / self.cell_size))
+        miny = int(math.floor(bbox[1] / self.cell_size))
+        maxx = int(math.floor(bbox[2] / self.cell_size))
+        maxy = int(math.floor(bbox[3] / self.cell_size))
+        for x in range(minx, maxx + 1):
+            for y in range(miny, maxy + 1):
+                yield (x, y)
+
+
+# sensors and streams of all hosts used by this process, off until its ttl is set. Extractors
+# turn it on in Extractor.setup (--geostreams-cache-ttl), other programs can set the ttl themselves.
+metadata_cache = GeostreamsCache(ttl=0)
+
 
 def create_sensor(connector, host, key, sensorname, geom, type, region):
     """Create a new sensor in Geostreams.
@@ -23,6 +204,7 @@ def create_sensor(connector, host, key, sensorname, geom, type, region):
     region -- region of sensor
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
 
     body = {
@@ -39,14 +221,16 @@ def create_sensor(connector, host, key, sensorname, geom, type, region):
 
     url = "%sapi/geostreams/sensors?key=%s" % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url, headers={'Content-type': 'application/json'},
+                            data=json.dumps(body),
+                            verify=connector.ssl_verify)
 
     sensorid = result.json()['id']
     logger.debug("sensor id = [%s]", sensorid)
 
+    body['id'] = sensorid
+    metadata_cache.add(host, "sensors", body)
+
     return sensorid
 
 
@@ -63,6 +247,7 @@ def create_stream(connector, host, key, streamname, sensorid, geom, properties={
     properties -- JSON object with any desired properties
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
 
     body = {
@@ -75,14 +260,16 @@ def create_stream(connector, host, key, streamname, sensorid, geom, properties={
 
     url = "%sapi/geostreams/streams?key=%s" % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url, headers={'Content-type': 'application/json'},
+                            data=json.dumps(body),
+                            verify=connector.ssl_verify)
 
     streamid = result.json()['id']
     logger.debug("stream id = [%s]", streamid)
 
+    body['id'] = streamid
+    metadata_cache.add(host, "streams", body)
+
     return streamid
 
 
@@ -100,6 +287,7 @@ def create_datapoint(connector, host, key, streamid, geom, starttime, endtime, p
     properties -- JSON object with any desired properties
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
 
     body = {
@@ -113,10 +301,9 @@ def create_datapoint(connector, host, key, streamid, geom, starttime, endtime, p
 
     url = '%sapi/geostreams/datapoints?key=%s' % (host, key)
 
-    result = requests.post(url, headers={'Content-type': 'application/json'},
-                           data=json.dumps(body),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url, headers={'Content-type': 'application/json'},
+                            data=json.dumps(body),
+                            verify=connector.ssl_verify)
 
     dpid = result.json()['id']
     logger.debug("datapoint id = [%s]", dpid)
@@ -124,7 +311,531 @@ def create_datapoint(connector, host, key, streamid, geom, starttime, endtime, p
     return dpid
 
 
-def get_sensor_by_name(connector, host, key, sensorname):
+# pylint: disable=too-many-arguments
+def create_datapoints(connector, host, key, streamid, datapoints, chunk_size=1000, workers=4, retries=3):
+    """Create many datapoints in Geostreams using bulk requests.
+
+    The datapoints are sent in chunks of chunk_size datapoints, with up to workers chunks
+    sent at the same time. Chunks that fail because of a connection or server error are
+    retried, and chunks that are too large for the server are split in half. The datapoints
+    are read from the iterable as they are needed, so this works with generators.
+
+    Each datapoint is a dict with at least geometry, start_time and end_time, and optionally
+    properties (see create_datapoint). The stream_id and type are added if missing.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    streamid -- id of stream to attach datapoints to
+    datapoints -- iterable of datapoint dicts
+    chunk_size -- maximum number of datapoints in a single request
+    workers -- number of requests sent at the same time
+    retries -- number of times a failed chunk is retried
+
+    Returns:
+        (number of datapoints created, list of failed chunks) where each failed chunk is
+        a dict with the chunk number, the datapoints in the chunk and the error.
+    """
+
+    connector = default_connector(connector)
+
+    def encode(datapoint):
+        # don't change the datapoints of the caller
+        datapoint = dict(datapoint)
+        datapoint.setdefault("type", "Point")
+        datapoint.setdefault("properties", {})
+        datapoint["stream_id"] = str(streamid)
+        return json.dumps(datapoint)
+
+    def chunks():
+        chunk = []
+        for datapoint in datapoints:
+            chunk.append(encode(datapoint))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    (created, failures) = _send_datapoint_chunks(connector, host, key, chunks(), workers, retries)
+    for failure in failures:
+        failure['datapoints'] = [json.loads(dp) for dp in failure['datapoints']]
+    return (created, failures)
+
+
+def _send_datapoint_chunks(connector, host, key, chunks, workers, retries):
+    """Send chunks of JSON encoded datapoints to the bulk endpoint, see create_datapoints."""
+
+    logger = logging.getLogger(__name__)
+    url = '%sapi/geostreams/datapoints/bulk?key=%s' % (host, key)
+
+    lock = threading.Lock()
+    results = {"created": 0, "failures": []}
+    # limit the number of chunks waiting to be sent, so the datapoints are not all read in memory
+    pending = threading.BoundedSemaphore(2 * workers)
+
+    def send(chunknum, chunk):
+        try:
+            (count, failed) = _post_datapoint_chunk(connector, url, chunk, retries)
+            with lock:
+                results["created"] += count
+                for (datapoints, error) in failed:
+                    logger.error("Error uploading %d datapoints of chunk %d : %s", len(datapoints), chunknum, error)
+                    results["failures"].append({"chunk": chunknum, "datapoints": datapoints, "error": error})
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Error uploading datapoint chunk %d", chunknum)
+            with lock:
+                results["failures"].append({"chunk": chunknum, "datapoints": chunk, "error": str(exc)})
+        finally:
+            pending.release()
+
+    pool = ThreadPool(workers)
+    try:
+        for (chunknum, chunk) in enumerate(chunks):
+            pending.acquire()
+            pool.apply_async(send, (chunknum, chunk))
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.debug("created %d datapoints, %d chunks failed", results["created"], len(results["failures"]))
+    return (results["created"], sorted(results["failures"], key=lambda f: f["chunk"]))
+
+
+def _post_datapoint_chunk(connector, url, chunk, retries):
+    """Post a single chunk, retrying on errors and splitting it if it is too large.
+
+    Returns (number of datapoints created, list of (datapoints, error) that failed), so
+    if only part of a split chunk fails, only those datapoints are reported as failed.
+    """
+
+    attempt = 0
+    while True:
+        try:
+            connector.post(url, headers={'Content-type': 'application/json'},
+                           data='[' + ','.join(chunk) + ']',
+                           verify=connector.ssl_verify)
+            return (len(chunk), [])
+        except requests.exceptions.HTTPError as exc:
+            status = exc.response.status_code if exc.response is not None else None
+            if status == 413 and len(chunk) > 1:
+                # payload too large, send as two smaller chunks
+                half = len(chunk) // 2
+                (created_first, failed_first) = _post_datapoint_chunk(connector, url, chunk[:half], retries)
+                (created_second, failed_second) = _post_datapoint_chunk(connector, url, chunk[half:], retries)
+                return (created_first + created_second, failed_first + failed_second)
+            if status is None or status < 500 or attempt >= retries:
+                return (0, [(chunk, str(exc))])
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+            if attempt >= retries:
+                return (0, [(chunk, str(exc))])
+        attempt += 1
+        time.sleep(0.5 * 2 ** attempt)
+
+
+class DatapointBuffer(object):
+    """Columnar buffer of datapoints for a single stream.
+
+    Instead of a dict for each datapoint, whole columns (lists, array.array or numpy
+    arrays) of longitudes, latitudes, times and property values are appended. Each
+    column is converted to JSON in a single call and the datapoints are written using
+    a template, so no Python object is created per datapoint. The buffer is sent using
+    create_datapoints once it holds flush_size datapoints, when flush is called, or at
+    the end of a with block.
+
+    Times can be strings (in format 2017-01-25T09:33:02-06:00), seconds since epoch
+    or numpy datetime64 values. Any argument can also be a single value that is used
+    for all datapoints.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    streamid -- id of stream to attach datapoints to
+    flush_size -- number of datapoints buffered before they are sent
+    chunk_size -- maximum number of datapoints in a single request
+    workers -- number of requests sent at the same time
+    retries -- number of times a failed chunk is retried
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, connector, host, key, streamid, flush_size=100000, chunk_size=1000, workers=4, retries=3):
+        self.connector = default_connector(connector)
+        self.host = host
+        self.key = key
+        self.streamid = streamid
+        self.flush_size = flush_size
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+        self.datapoints = list()
+        self.created = 0
+        self.failures = list()
+
+    def __len__(self):
+        return len(self.datapoints)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    def append(self, lon, lat, start_time, end_time=None, alt=0, **properties):
+        """Add columns of datapoints to the buffer.
+
+        Keyword arguments:
+        lon -- longitudes of the datapoints
+        lat -- latitudes of the datapoints
+        start_time -- start times of the datapoints
+        end_time -- end times of the datapoints, start_time is used if not given
+        alt -- altitudes of the datapoints
+        properties -- property name to property values of the datapoints
+        """
+        lengths = [_column_length(c) for c in [lon, lat, start_time, end_time, alt] + list(properties.values())]
+        lengths = [length for length in lengths if length is not None]
+        count = max(lengths) if lengths else 1
+        if count == 0:
+            return
+
+        names = sorted(properties.keys())
+        columns = [_json_column(lon, count), _json_column(lat, count), _json_column(alt, count),
+                   _json_column(start_time, count, True)]
+        if end_time is None:
+            columns.append(columns[-1])
+        else:
+            columns.append(_json_column(end_time, count, True))
+        columns.extend([_json_column(properties[name], count) for name in names])
+
+        template = '{"type":"Point","geometry":{"type":"Point","coordinates":[%s,%s,%s]},' \
+                   '"start_time":%s,"end_time":%s,"properties":{' + \
+                   ','.join([json.dumps(name).replace('%', '%%') + ':%s' for name in names]) + \
+                   '},"stream_id":' + json.dumps(str(self.streamid)).replace('%', '%%') + '}'
+        self.datapoints.extend([template % row for row in zip(*columns)])
+
+        if len(self.datapoints) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Send all buffered datapoints to Geostreams.
+
+        Returns:
+            (number of datapoints created, list of failed chunks), see create_datapoints.
+        """
+        datapoints = self.datapoints
+        self.datapoints = list()
+        if not datapoints:
+            return (0, [])
+
+        chunks = (datapoints[i:i + self.chunk_size] for i in range(0, len(datapoints), self.chunk_size))
+        (created, failures) = _send_datapoint_chunks(self.connector, self.host, self.key, chunks,
+                                                     self.workers, self.retries)
+        for failure in failures:
+            failure['datapoints'] = [json.loads(dp) for dp in failure['datapoints']]
+        self.created += created
+        self.failures.extend(failures)
+        return (created, failures)
+
+
+def _column_length(values):
+    """Return the length of a column, or None if it is a single value."""
+    if values is None or isinstance(values, (str, bytes, type(u''), numbers.Number)):
+        return None
+    if numpy is not None and isinstance(values, numpy.ndarray) and values.ndim == 0:
+        return None
+    try:
+        return len(values)
+    except TypeError:
+        return None
+
+
+def _json_column(values, count, is_time=False):
+    """Convert a column to a list of count JSON encoded values."""
+    length = _column_length(values)
+    if length is None:
+        if numpy is not None and isinstance(values, (numpy.ndarray, numpy.generic)):
+            if values.dtype.kind == 'M':
+                values = str(numpy.datetime_as_string(values.astype('datetime64[s]'))) + '+00:00'
+            else:
+                values = values.tolist()
+        if is_time and isinstance(values, numbers.Real):
+            values = _format_time(values)
+        return [json.dumps(values)] * count
+    if length != count:
+        raise ValueError("columns should all have the same length, got %d and %d" % (length, count))
+
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if values.dtype.kind == 'M':
+            return ['"%s+00:00"' % t for t in numpy.datetime_as_string(values.astype('datetime64[s]'))]
+        if is_time and values.dtype.kind in 'iuf':
+            seconds = values.astype('int64').astype('datetime64[s]')
+            return ['"%s+00:00"' % t for t in numpy.datetime_as_string(seconds)]
+        if values.dtype.kind in 'S':
+            values = values.astype('U')
+        values = values.tolist()
+    elif isinstance(values, array.array):
+        values = values.tolist()
+    elif not isinstance(values, list):
+        values = list(values)
+
+    if is_time:
+        values = [_format_time(t) if isinstance(t, numbers.Real) else t for t in values]
+    if all(isinstance(v, numbers.Real) for v in values):
+        # encode the whole column at once, numbers never contain the separator
+        tokens = json.dumps(values, separators=(',', ':'))[1:-1].split(',')
+        return [('null' if t in ('NaN', 'Infinity', '-Infinity') else t) for t in tokens]
+    return [json.dumps(v) for v in values]
+
+
+def _format_time(seconds):
+    """Format seconds since epoch in the format used by Geostreams."""
+    return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(seconds))
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def get_datapoints(connector, host, key, stream_id=None, sensor_id=None, since=None, until=None, geocode=None,
+                   window=None, chunk_size=64 * 1024):
+    """Get datapoints from Geostreams, yielding them one at a time.
+
+    The response is decoded while it is downloaded, so only a single datapoint is kept in
+    memory. If since and until are datetime objects and window (a timedelta or number of
+    seconds) is given, the time range is fetched in separate requests of window long, so
+    the server does not need to return all datapoints at once.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    stream_id -- (optional) only return datapoints of this stream
+    sensor_id -- (optional) only return datapoints of this sensor
+    since -- (optional) only return datapoints after this time, a string or datetime
+    until -- (optional) only return datapoints before this time, a string or datetime
+    geocode -- (optional) only return datapoints in this area, either lat,lon,radius or a list of lat,lon values
+    window -- (optional) length of the time range of each request
+    chunk_size -- number of bytes read from the response at a time
+    """
+
+    connector = default_connector(connector)
+    logger = logging.getLogger(__name__)
+
+    params = {'key': key, 'format': 'json'}
+    if stream_id is not None:
+        params['stream_id'] = stream_id
+    if sensor_id is not None:
+        params['sensor_id'] = sensor_id
+    if geocode is not None:
+        params['geocode'] = ','.join([str(c) for c in geocode]) if isinstance(geocode, (list, tuple)) else geocode
+
+    if window is None:
+        ranges = [(since, until)]
+    else:
+        if not isinstance(since, datetime.datetime) or not isinstance(until, datetime.datetime):
+            raise ValueError("since and until should be datetime objects when using window")
+        if not isinstance(window, datetime.timedelta):
+            window = datetime.timedelta(seconds=window)
+        ranges = []
+        start = since
+        while start < until:
+            ranges.append((start, min(start + window, until)))
+            start += window
+
+    url = "%sapi/geostreams/datapoints" % host
+    previous = set()
+    for (start, end) in ranges:
+        if start is not None:
+            params['since'] = _format_datetime(start)
+        if end is not None:
+            params['until'] = _format_datetime(end)
+        logger.debug("fetching datapoints since %s until %s", params.get('since'), params.get('until'))
+
+        result = connector.get(url, params=params, stream=True,
+                               verify=connector.ssl_verify)
+        if result is None:
+            continue
+        current = set()
+        try:
+            for datapoint in _iter_json_array(result, chunk_size):
+                # datapoints on the boundary of two windows can be returned twice
+                dpid = datapoint.get('id') if isinstance(datapoint, dict) else None
+                if dpid is not None:
+                    if dpid in previous:
+                        continue
+                    if window is not None:
+                        current.add(dpid)
+                yield datapoint
+        finally:
+            result.close()
+        previous = current
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def get_datapoint_columns(connector, host, key, stream_id=None, sensor_id=None, since=None, until=None,
+                          geocode=None, window=None, size=10000, properties=None):
+    """Get datapoints from Geostreams as chunks of columns.
+
+    This returns the same datapoints as get_datapoints, but yields them as dicts with a
+    column for id, lon, lat, alt, start_time, end_time and each property, holding at most
+    size datapoints. The coordinates (and properties if numpy is installed) are numpy
+    arrays, or array.array if numpy is not installed. Missing values are None, or NaN for
+    the coordinates.
+
+    Keyword arguments:
+    size -- maximum number of datapoints in each chunk
+    properties -- names of the properties to return, by default the properties of the first datapoint
+    other arguments -- see get_datapoints
+    """
+
+    connector = default_connector(connector)
+    datapoints = get_datapoints(connector, host, key, stream_id=stream_id, sensor_id=sensor_id, since=since,
+                                until=until, geocode=geocode, window=window)
+    while True:
+        chunk = []
+        for datapoint in datapoints:
+            chunk.append(datapoint)
+            if len(chunk) >= size:
+                break
+        if not chunk:
+            return
+        if properties is None:
+            properties = sorted(chunk[0].get('properties', {}).keys())
+        yield _to_columns(chunk, properties)
+        if len(chunk) < size:
+            return
+
+
+def _to_columns(datapoints, properties):
+    """Convert a list of datapoints to a dict of columns."""
+    coords = [(datapoint.get('geometry') or {}).get('coordinates') or [] for datapoint in datapoints]
+    nan = float('nan')
+    columns = {
+        'id': [datapoint.get('id') for datapoint in datapoints],
+        'lon': [c[0] if len(c) > 0 and c[0] is not None else nan for c in coords],
+        'lat': [c[1] if len(c) > 1 and c[1] is not None else nan for c in coords],
+        'alt': [c[2] if len(c) > 2 and c[2] is not None else nan for c in coords],
+        'start_time': [datapoint.get('start_time') for datapoint in datapoints],
+        'end_time': [datapoint.get('end_time') for datapoint in datapoints]
+    }
+    for name in properties:
+        columns[name] = [datapoint.get('properties', {}).get(name) for datapoint in datapoints]
+
+    for name in ['lon', 'lat', 'alt']:
+        if numpy is not None:
+            columns[name] = numpy.array(columns[name], dtype='float64')
+        else:
+            columns[name] = array.array('d', columns[name])
+    if numpy is not None:
+        for name in properties:
+            columns[name] = numpy.array(columns[name])
+    return columns
+
+
+def _format_datetime(value):
+    """Format a datetime for a Geostreams query, strings are returned as is."""
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    return value
+
+
+def _iter_json_array(response, chunk_size):
+    """Yield the elements of the JSON array in the response while it is downloaded."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size)
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        # skip whitespace and separators
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != u'[':
+                    raise ValueError("expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == u']':
+                return
+            try:
+                (element, end) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # a number could continue in the next chunk
+                if end < len(buf) or eof or isinstance(element, (dict, list)):
+                    pos = end
+                    yield element
+                    continue
+        if eof:
+            if started:
+                raise ValueError("incomplete JSON array")
+            return
+        buf = buf[pos:]
+        pos = 0
+        try:
+            buf += utf8.decode(next(chunks))
+        except StopIteration:
+            buf += utf8.decode(b'', True)
+            eof = True
+
+
+def _geometry_coordinates(geom):
+    """Return all (lon, lat) pairs of a GeoJSON geometry."""
+    if not geom or 'coordinates' not in geom:
+        return []
+    result = []
+    stack = [geom['coordinates']]
+    while stack:
+        coords = stack.pop()
+        if coords and isinstance(coords[0], numbers.Number):
+            result.append((coords[0], coords[1]))
+        else:
+            stack.extend(reversed(coords))
+    return result
+
+
+def _in_geometry(lon, lat, geom):
+    """Return True if the point is inside a Polygon geometry."""
+    if not geom or geom.get('type') != 'Polygon' or not geom.get('coordinates'):
+        return False
+    return _in_polygon(lon, lat, [(c[0], c[1]) for c in geom['coordinates'][0]])
+
+
+def _in_polygon(lon, lat, polygon):
+    """Return True if the point is inside the polygon, a list of (lon, lat) pairs."""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        (xi, yi) = polygon[i]
+        (xj, yj) = polygon[j]
+        if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / float(yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _bbox(coords):
+    """Return the bounding box (minlon, minlat, maxlon, maxlat) of a list of (lon, lat) pairs."""
+    lons = [c[0] for c in coords]
+    lats = [c[1] for c in coords]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+
+def _distance(lon1, lat1, lon2, lat2):
+    """Return the distance in meters between two points."""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * 6371000 * math.asin(min(1.0, math.sqrt(a)))
+
+
+def get_sensor_by_name(connector, host, key, sensorname, use_cache=True):
     """Get sensor by name from Geostreams, or return None.
 
     Keyword arguments:
@@ -132,15 +843,19 @@ def get_sensor_by_name(connector, host, key, sensorname):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     sensorname -- name of sensor to search for
+    use_cache -- set to False to always send the request to the server
     """
 
+    connector = default_connector(connector)
+    if use_cache and metadata_cache.ttl > 0:
+        return metadata_cache.find_by_name(connector, host, key, "sensors", sensorname)
+
     logger = logging.getLogger(__name__)
 
     url = "%sapi/geostreams/sensors?sensor_name=%s&key=%s" % (host, sensorname, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     for sens in result.json():
         if 'name' in sens and sens['name'] == sensorname:
@@ -150,7 +865,7 @@ def get_sensor_by_name(connector, host, key, sensorname):
     return None
 
 
-def get_sensors_by_circle(connector, host, key, lon, lat, radius=0):
+def get_sensors_by_circle(connector, host, key, lon, lat, radius=0, use_cache=True):
     """Get sensor by coordinate from Geostreams, or return None.
 
     Keyword arguments:
@@ -160,15 +875,19 @@ def get_sensors_by_circle(connector, host, key, lon, lat, radius=0):
     lon -- longitude of point
     lat -- latitude of point
     radius -- distance in meters around point to search
+    use_cache -- set to False to always send the request to the server
     """
 
+    connector = default_connector(connector)
+    if use_cache and metadata_cache.ttl > 0:
+        return metadata_cache.find_by_circle(connector, host, key, "sensors", lon, lat, radius)
+
     logger = logging.getLogger(__name__)
 
     url = "%sapi/geostreams/sensors?geocode=%s,%s,%s&key=%s" % (host, lat, lon, radius, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     # Return first sensor
     jbody = result.json()
@@ -178,7 +897,7 @@ def get_sensors_by_circle(connector, host, key, lon, lat, radius=0):
         return None
 
 
-def get_sensors_by_polygon(connector, host, key, coord_list):
+def get_sensors_by_polygon(connector, host, key, coord_list, use_cache=True):
     """Get sensor by coordinate from Geostreams, or return None.
 
     Keyword arguments:
@@ -186,16 +905,20 @@ def get_sensors_by_polygon(connector, host, key, coord_list):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     coord_list -- list of (lon/lat) coordinate pairs forming polygon vertices
+    use_cache -- set to False to always send the request to the server
     """
 
+    connector = default_connector(connector)
+    if use_cache and metadata_cache.ttl > 0:
+        return metadata_cache.find_by_polygon(connector, host, key, "sensors", coord_list)
+
     logger = logging.getLogger(__name__)
 
     coord_strings = [str(i) for i in coord_list]
     url = "%sapi/geostreams/sensors?geocode=%s&key=%s" % (host, ','.join(coord_strings), key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     # Return first sensor
     jbody = result.json()
@@ -205,7 +928,7 @@ def get_sensors_by_polygon(connector, host, key, coord_list):
         return None
 
 
-def get_stream_by_name(connector, host, key, streamname):
+def get_stream_by_name(connector, host, key, streamname, use_cache=True):
     """Get stream by name from Geostreams, or return None.
 
     Keyword arguments:
@@ -213,15 +936,19 @@ def get_stream_by_name(connector, host, key, streamname):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     streamname -- name of stream to search for
+    use_cache -- set to False to always send the request to the server
     """
 
+    connector = default_connector(connector)
+    if use_cache and metadata_cache.ttl > 0:
+        return metadata_cache.find_by_name(connector, host, key, "streams", streamname)
+
     logger = logging.getLogger(__name__)
 
     url = "%sapi/geostreams/streams?stream_name=%s&key=%s" % (host, streamname, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     for strm in result.json():
         if 'name' in strm and strm['name'] == streamname:
@@ -231,7 +958,7 @@ def get_stream_by_name(connector, host, key, streamname):
     return None
 
 
-def get_streams_by_circle(connector, host, key, lon, lat, radius=0):
+def get_streams_by_circle(connector, host, key, lon, lat, radius=0, use_cache=True):
     """Get stream by coordinate from Geostreams, or return None.
 
     Keyword arguments:
@@ -241,15 +968,19 @@ def get_streams_by_circle(connector, host, key, lon, lat, radius=0):
     lon -- longitude of point
     lat -- latitude of point
     radius -- distance in meters around point to search
+    use_cache -- set to False to always send the request to the server
     """
 
+    connector = default_connector(connector)
+    if use_cache and metadata_cache.ttl > 0:
+        return metadata_cache.find_by_circle(connector, host, key, "streams", lon, lat, radius)
+
     logger = logging.getLogger(__name__)
 
     url = "%sapi/geostreams/stream?geocode=%s,%s,%s&key=%s" % (host, lat, lon, radius, key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     jbody = result.json()
     if len(jbody) > 0:
@@ -258,7 +989,7 @@ def get_streams_by_circle(connector, host, key, lon, lat, radius=0):
         return None
 
 
-def get_streams_by_polygon(connector, host, key, coord_list):
+def get_streams_by_polygon(connector, host, key, coord_list, use_cache=True):
     """Get stream by coordinate from Geostreams, or return None.
 
     Keyword arguments:
@@ -266,16 +997,20 @@ def get_streams_by_polygon(connector, host, key, coord_list):
     host -- the clowder host, including http and port, should end with a /
     key -- the secret key to login to clowder
     coord_list -- list of (lon/lat) coordinate pairs forming polygon vertices
+    use_cache -- set to False to always send the request to the server
     """
 
+    connector = default_connector(connector)
+    if use_cache and metadata_cache.ttl > 0:
+        return metadata_cache.find_by_polygon(connector, host, key, "streams", coord_list)
+
     logger = logging.getLogger(__name__)
 
     coord_strings = [str(i) for i in coord_list]
     url = "%sapi/geostreams/stream?geocode=%s&key=%s" % (host, ','.join(coord_strings), key)
 
-    result = requests.get(url,
-                          verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.get(url,
+                           verify=connector.ssl_verify)
 
     jbody = result.json()
     if len(jbody) > 0:
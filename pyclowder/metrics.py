@@ -0,0 +1,209 @@
+"""Clowder Metrics
+
+This module keeps track of how the connectors spend their time. It records
+how long each stage of a message takes (download, check_message,
+process_message), the latency and number of bytes of every request to
+clowder, how many messages end in each outcome (ok, error, resubmit,
+ignored) and how many messages and requests are in flight. The metrics can
+be served in the Prometheus text format on a local HTTP port and written
+to a file.
+"""
+
+import logging
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600, 1800)
+
+DESCRIPTIONS = {
+    'pyclowder_stage_seconds': 'Time spend in each stage of processing a message.',
+    'pyclowder_messages_total': 'Number of messages processed, by outcome.',
+    'pyclowder_messages_inflight': 'Number of messages being processed.',
+    'pyclowder_http_request_seconds': 'Time spend on requests to clowder, by method.',
+    'pyclowder_http_requests_inflight': 'Number of requests to clowder in progress.',
+    'pyclowder_http_bytes_total': 'Number of bytes send to and received from clowder.',
+}
+
+
+class Metrics(object):
+    """Thread safe collection of counters, gauges and histograms.
+
+    Each metric is identified by its name and labels, for example
+    metrics.inc('pyclowder_messages_total', outcome='ok').
+
+    Keyword arguments:
+    buckets -- upper bounds in seconds of the histogram buckets
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        """Add value (which can be negative) to a gauge."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def timer(self, name, **labels):
+        """Return a context manager that adds the time spend inside it to a histogram."""
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """Return a copy of all metrics that can be pickled and merged into another Metrics."""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': dict((k, {'buckets': list(v['buckets']), 'count': v['count'], 'sum': v['sum']})
+                                   for k, v in self.histograms.items())
+            }
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot, for example from a worker process, to these metrics."""
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in snapshot['gauges'].items():
+                self.gauges[key] = self.gauges.get(key, 0) + value
+            for key, value in snapshot['histograms'].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+                    self.histograms[key] = histogram
+                for i, count in enumerate(value['buckets']):
+                    histogram['buckets'][i] += count
+                histogram['count'] += value['count']
+                histogram['sum'] += value['sum']
+
+    def reset(self):
+        """Remove all metrics."""
+        with self.lock:
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        lines = []
+        for (kind, metrics) in [('counter', snapshot['counters']), ('gauge', snapshot['gauges'])]:
+            for name in sorted(set(k[0] for k in metrics)):
+                _add_header(lines, name, kind)
+                for key in sorted(k for k in metrics if k[0] == name):
+                    lines.append('%s%s %s' % (name, _format_labels(key[1]), _format_value(metrics[key])))
+        histograms = snapshot['histograms']
+        for name in sorted(set(k[0] for k in histograms)):
+            _add_header(lines, name, 'histogram')
+            for key in sorted(k for k in histograms if k[0] == name):
+                histogram = histograms[key]
+                total = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    total += count
+                    labels = _format_labels(key[1] + (('le', _format_value(bound)),))
+                    lines.append('%s_bucket%s %d' % (name, labels, total))
+                lines.append('%s_bucket%s %d' % (name, _format_labels(key[1] + (('le', '+Inf'),)),
+                                                 histogram['count']))
+                lines.append('%s_sum%s %s' % (name, _format_labels(key[1]), _format_value(histogram['sum'])))
+                lines.append('%s_count%s %d' % (name, _format_labels(key[1]), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        """Write all metrics in the Prometheus text format to a file."""
+        with open(filename, 'w') as out:
+            out.write(self.render())
+
+    def serve(self, port, address='127.0.0.1'):
+        """Serve the metrics on http://address:port/metrics from a background thread.
+
+        Returns the HTTP server, call shutdown on it to stop serving.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                logging.getLogger(__name__).debug(format, *args)
+
+        server = HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, name="Metrics-" + str(port))
+        thread.daemon = True
+        thread.start()
+        logging.getLogger(__name__).info("Serving metrics on http://%s:%d/metrics", address, port)
+        return server
+
+
+class _Timer(object):
+    """Context manager returned by Metrics.timer."""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+
+
+def _add_header(lines, name, kind):
+    if name in DESCRIPTIONS:
+        lines.append('# HELP %s %s' % (name, DESCRIPTIONS[name]))
+    lines.append('# TYPE %s %s' % (name, kind))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+def _format_value(value):
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# metrics of this process, used by the connectors
+registry = Metrics()
@@ -0,0 +1,111 @@
+"""Clowder Profiling
+
+This module contains the MessageProfiler, which can be given to a connector
+to run process_message under cProfile. The profile of each message is
+written to a directory, named after the resource that was processed, so
+a slow message in production can be analyzed without running it again.
+"""
+
+import cProfile
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+
+class MessageProfiler(object):
+    """Profile process_message and keep the results on disk.
+
+    Only a fraction of the messages is profiled. If slow_threshold is set the
+    profile is only kept if the message took at least that many seconds. The
+    oldest profiles are removed once all profiles in the directory are larger
+    than max_bytes. The profiles can be read using the pstats module or tools
+    such as snakeviz.
+
+    Keyword arguments:
+    profile_dir -- folder the profiles are written to, will be created if needed
+    fraction -- fraction of the messages that is profiled, between 0 and 1
+    slow_threshold -- only keep profiles of messages that took at least this many seconds
+    max_bytes -- maximum size of all profiles in profile_dir
+    """
+
+    def __init__(self, profile_dir, fraction=1.0, slow_threshold=0, max_bytes=1024 * 1024 * 1024):
+        self.profile_dir = os.path.abspath(profile_dir)
+        self.fraction = fraction
+        self.slow_threshold = slow_threshold
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.profile_dir):
+            try:
+                os.makedirs(self.profile_dir)
+            except OSError:
+                # created by somebody else
+                if not os.path.isdir(self.profile_dir):
+                    raise
+
+    def run(self, resource, func, *args, **kwargs):
+        """Call func with the arguments, profiling it if this message is selected.
+
+        Keyword arguments:
+        resource -- the resource of the message, used to name the profile
+        func -- the function to call
+        """
+        if self.fraction <= 0 or (self.fraction < 1 and random.random() >= self.fraction):
+            return func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            elapsed = time.time() - start
+            if elapsed >= self.slow_threshold:
+                try:
+                    self._save(profiler, resource, elapsed)
+                except Exception:  # pylint: disable=broad-except
+                    logging.getLogger(__name__).exception("Error saving profile of [%s]", resource.get('id'))
+
+    def _save(self, profiler, resource, elapsed):
+        """Write the profile to profile_dir and remove old profiles if needed."""
+        logger = logging.getLogger(__name__)
+
+        # local files do not have an id
+        ident = resource.get('id') or os.path.basename(resource.get('name') or '') or 'unknown'
+        name = "%s_%s_%s.prof" % (resource.get('type', 'resource'), ident, time.strftime('%Y%m%dT%H%M%S'))
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        (fd, tmp_path) = tempfile.mkstemp(suffix=".tmp", dir=self.profile_dir)
+        os.close(fd)
+        try:
+            profiler.dump_stats(tmp_path)
+            os.rename(tmp_path, os.path.join(self.profile_dir, name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.info("[%s] : took %.1f seconds, profile saved as %s", resource.get('id'), elapsed, name)
+
+        with self.lock:
+            entries = []
+            total = 0
+            for filename in os.listdir(self.profile_dir):
+                if not filename.endswith(".prof"):
+                    continue
+                path = os.path.join(self.profile_dir, filename)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+            for (_, size, path) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    logger.exception("Error removing profile %s", path)
@@ -0,0 +1,52 @@
+"""Clowder Message Recording
+
+This module contains the MessageRecorder, which writes the messages received
+by a connector to a JSON Lines file, and read_messages to read them back.
+Recorded messages can be replayed using benchmarks/replay.py to reproduce
+production load offline.
+"""
+
+import json
+import time
+
+from pyclowder.utils import JsonLinesSink
+
+
+class MessageRecorder(JsonLinesSink):
+    """Append the messages received by a connector to a JSON Lines file.
+
+    Each line holds the time the message was received, its routing key and its
+    body. The secret key is removed from the body, the replay tool will use its
+    own. Lines are buffered and written as described in JsonLinesSink, so
+    multiple processes can record to the same file.
+
+    Keyword arguments:
+    filename -- file the messages are appended to
+    flush_interval -- see JsonLinesSink
+    max_buffer -- see JsonLinesSink
+    """
+
+    def __init__(self, filename, flush_interval=1, max_buffer=64 * 1024):
+        super(MessageRecorder, self).__init__(filename, flush_interval=flush_interval, max_buffer=max_buffer,
+                                              mode=0o600)
+
+    def record(self, routing_key, body):
+        """Record a message.
+
+        Keyword arguments:
+        routing_key -- routing key the message was received with
+        body -- the message body, as a dict
+        """
+        body = dict((k, v) for k, v in body.items() if k != 'secretKey')
+        self.write(json.dumps({'time': time.time(), 'routing_key': routing_key, 'body': body},
+                              separators=(',', ':')))
+
+
+def read_messages(filename):
+    """Yield (time, routing_key, body) for each message in a file written by MessageRecorder."""
+    with open(filename) as messages:
+        for line in messages:
+            line = line.strip()
+            if line:
+                message = json.loads(line)
+                yield (message['time'], message['routing_key'], message['body'])
@@ -6,9 +6,7 @@ This module provides simple wrappers around the clowder Datasets API
 import json
 import logging
 
-import requests
-
-from pyclowder.utils import StatusMessage
+from pyclowder.utils import StatusMessage, default_connector
 
 
 def upload(connector, host, key, sectiondata):
@@ -21,14 +19,14 @@ def upload(connector, host, key, sectiondata):
     sectiondata -- section data to send
     """
 
+    connector = default_connector(connector)
     logger = logging.getLogger(__name__)
     headers = {'Content-Type': 'application/json'}
 
     # upload section
     url = '%sapi/sections?key=%s' % (host, key)
-    result = requests.post(url, headers=headers, data=json.dumps(sectiondata),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url, headers=headers, data=json.dumps(sectiondata),
+                            verify=connector.ssl_verify)
 
     sectionid = result.json()['id']
     logger.debug("section id = [%s]", sectionid)
@@ -47,10 +45,10 @@ def upload_tags(connector, host, key, sectionid, tags):
     tags -- the tags to be uploaded
     """
 
+    connector = default_connector(connector)
     connector.status_update(StatusMessage.processing, {"type": "section", "id": sectionid}, "Uploading section tags.")
 
     headers = {'Content-Type': 'application/json'}
     url = '%sapi/sections/%s/tags?key=%s' % (host, sectionid, key)
-    result = requests.post(url, headers=headers, data=json.dumps(tags),
-                           verify=connector.ssl_verify if connector else True)
-    result.raise_for_status()
+    result = connector.post(url, headers=headers, data=json.dumps(tags),
+                            verify=connector.ssl_verify)
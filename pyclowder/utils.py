@@ -2,23 +2,41 @@
 
 This module contains utilities that make it easier to work with clowder.
 Amongst these utilities is a simple way to initialize the logging system
-from either a file or the command line.
+from either a file or the command line, and a pool of HTTP sessions that
+is used by the connectors to talk to clowder.
 """
 
 import datetime
+import fnmatch
+import io
 import json
 import logging
 import logging.config
+import mimetypes
 import os
+import struct
+import sys
+import threading
 import time
+import uuid
 import zipfile
+import zlib
 import tempfile
 import requests
+import requests.adapters
+from requests.compat import urlparse
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from enum import Enum
 
 import yaml
 
+import pyclowder.metrics
+
 
 # this takes advantage of the fact that 0 == False and anything else == True
 # pylint: disable=too-few-public-methods
@@ -50,6 +68,448 @@ class StatusMessage(Enum):
     error = "ERROR"
 
 
+class SessionPool(object):
+    """Pool of HTTP sessions, one session for each clowder host.
+
+    Each session keeps up to pool_size connections open to the host, so
+    consecutive calls do not need to create a new TCP and TLS connection.
+    The sessions are shared by all threads using the pool. If the process
+    is forked the child will create new sessions, to make sure connections
+    are never shared between processes.
+
+    Keyword arguments:
+    pool_size -- maximum number of connections kept open for each host
+    timeout -- default timeout in seconds for all requests, None is no timeout
+    keep_alive -- set to False to close the connection after each request
+    """
+
+    def __init__(self, pool_size=10, timeout=None, keep_alive=True):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def get_session(self, url):
+        """Return the session used for the host in the url."""
+        parsed = urlparse(url)
+        host = "%s://%s" % (parsed.scheme, parsed.netloc)
+
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked, connections belong to the parent
+                self.sessions = dict()
+                self.pid = os.getpid()
+
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self.sessions[host] = session
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        """Send a request using the session for the host, see requests.request for the arguments."""
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+
+        metrics = pyclowder.metrics.registry
+        data = kwargs.get('data')
+        if data is not None and hasattr(data, '__len__'):
+            metrics.inc('pyclowder_http_bytes_total', len(data), direction='sent')
+        metrics.add('pyclowder_http_requests_inflight', 1)
+        try:
+            with metrics.timer('pyclowder_http_request_seconds', method=method):
+                response = self.get_session(url).request(method, url, **kwargs)
+        finally:
+            metrics.add('pyclowder_http_requests_inflight', -1)
+        # streamed responses are counted by their header, the body has not been read yet
+        length = response.headers.get('Content-Length')
+        if length is None and not kwargs.get('stream'):
+            length = len(response.content)
+        if length is not None:
+            metrics.inc('pyclowder_http_bytes_total', int(length), direction='received')
+        return response
+
+    def close(self):
+        """Close all sessions, and any connections they have open."""
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = dict()
+
+
+# connector used by the api functions when they are called without a connector
+_default_connector = None
+
+
+def default_connector(connector):
+    """Return the connector, or if it is None a connector shared by all calls without one.
+
+    The shared connector sends its requests using its own SessionPool, verifies SSL
+    certificates and only logs status updates.
+    """
+    global _default_connector  # pylint: disable=global-statement
+    if connector is not None:
+        return connector
+    if _default_connector is None:
+        import pyclowder.connectors  # pylint: disable=redefined-outer-name
+        _default_connector = pyclowder.connectors.Connector(None)
+    return _default_connector
+
+
+class MultipartEncoder(object):
+    """Streaming multipart/form-data encoder.
+
+    This is a file-like object that can be passed as data to requests, the body is
+    created while it is being sent, so the memory used does not depend on the size
+    of the files. The value of each field is either a string, or a tuple (filename,
+    source) where source is a path to a file, a file-like object or a bytes buffer
+    (bytearray or memoryview, as well as bytes on python 3). If filename is None the
+    name of the file is used, a ValueError is raised if source has no name. The length
+    of the body is sent with the request, a ValueError is also raised if source can not
+    seek, such as a pipe or a socket, those need to be written to a file first.
+
+    Keyword arguments:
+    fields -- list of (name, value) tuples
+    callback -- (optional) function called with (bytes read, total bytes) while reading
+    """
+
+    def __init__(self, fields, callback=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.callback = callback
+        self.bytes_read = 0
+        self.parts = []
+        self.opened = []
+
+        try:
+            for (name, value) in fields:
+                self._add_part(name, value)
+        except Exception:
+            self.close()
+            raise
+        self.parts.append(io.BytesIO(('--%s--\r\n' % self.boundary).encode('utf-8')))
+
+        self.len = sum(self._remaining(part) for part in self.parts)
+
+    def _add_part(self, name, value):
+        if isinstance(value, tuple):
+            (filename, source) = value
+            fileobj = self._open(source)
+            if not filename:
+                filename = os.path.basename(getattr(fileobj, 'name', None) or '')
+            if not filename:
+                raise ValueError("A filename is required to upload field %s from a buffer" % name)
+            try:
+                self._remaining(fileobj)
+            except (AttributeError, IOError, OSError, ValueError):
+                raise ValueError("Can not upload field %s, %s can not seek so its size is not known" %
+                                 (name, filename))
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            header = 'Content-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n' % \
+                     (self._quote(name), self._quote(filename), content_type)
+        else:
+            fileobj = io.BytesIO(value.encode('utf-8') if not isinstance(value, bytes) else value)
+            header = 'Content-Disposition: form-data; name="%s"\r\n' % self._quote(name)
+        header = '--%s\r\n%s\r\n' % (self.boundary, header)
+        self.parts.append(io.BytesIO(header.encode('utf-8')))
+        self.parts.append(fileobj)
+        self.parts.append(io.BytesIO(b'\r\n'))
+
+    @staticmethod
+    def _quote(value):
+        """Escape a name for a quoted header parameter, the same way browsers do."""
+        return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+    def _open(self, source):
+        if hasattr(source, 'read'):
+            return source
+        if isinstance(source, (bytearray, memoryview)) or (bytes is not str and isinstance(source, bytes)):
+            return io.BytesIO(source)
+        fileobj = open(source, 'rb')
+        self.opened.append(fileobj)
+        return fileobj
+
+    @staticmethod
+    def _remaining(fileobj):
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        end = fileobj.tell()
+        fileobj.seek(position)
+        return end - position
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        """Read up to size bytes of the body, or everything if size is negative."""
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self.parts.pop(0)
+            else:
+                data += chunk
+        self.bytes_read += len(data)
+        if self.callback and data:
+            self.callback(self.bytes_read, self.len)
+        return data
+
+    def close(self):
+        """Close any files opened by the encoder."""
+        for fileobj in self.opened:
+            fileobj.close()
+        self.opened = []
+
+
+class BufferedLogWriter(object):
+    """Append lines to log files, keeping a JsonLinesSink open for each file.
+
+    Lines are buffered by the sink of the file, and written as described in JsonLinesSink,
+    or right away when force is set. Lines for files that do not exist are dropped. With
+    shards set each process writes to its own file next to the log, use merge_log_shards
+    to append the shards to the log. If the process is forked the child will open the
+    files again and drop the lines buffered by the parent.
+
+    Keyword arguments:
+    flush_interval -- flush_interval of the sink of each file
+    shards -- write to <filename>.shard<pid> instead of the file itself
+    max_open -- maximum number of files kept open
+    """
+
+    def __init__(self, flush_interval=5, shards=False, max_open=16):
+        self.flush_interval = flush_interval
+        self.shards = shards
+        self.max_open = max_open
+        self.sinks = dict()
+        self.last_used = dict()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def write(self, filename, line, force=False):
+        """Append a line to the file."""
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked, files and lines belong to the parent
+                self.sinks = dict()
+                self.last_used = dict()
+                self.pid = os.getpid()
+
+            sink = self.sinks.get(filename)
+            if sink is None:
+                if not os.path.isfile(filename):
+                    return
+                if self.shards:
+                    shard = "%s.shard%d" % (filename, self.pid)
+                else:
+                    shard = filename
+                while len(self.sinks) >= self.max_open:
+                    # close the least recently used file
+                    oldest = min(self.last_used, key=self.last_used.get)
+                    del self.last_used[oldest]
+                    self.sinks.pop(oldest).close()
+                sink = JsonLinesSink(shard, flush_interval=self.flush_interval)
+                self.sinks[filename] = sink
+
+            self.last_used[filename] = time.time()
+            sink.write(line[:-1] if line.endswith('\n') else line, force)
+
+    def flush(self):
+        """Write all buffered lines."""
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            for sink in self.sinks.values():
+                sink.flush()
+
+    def close(self):
+        """Write all buffered lines and close the files."""
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            while self.sinks:
+                self.sinks.popitem()[1].close()
+            self.last_used = dict()
+
+
+def merge_log_shards(filename):
+    """Append the shards written by BufferedLogWriter to the log file and remove them.
+
+    The lines are ordered by their start field, lines with the same start keep the
+    order of their shard.
+    """
+    folder = os.path.dirname(filename) or '.'
+    prefix = os.path.basename(filename) + ".shard"
+    shards = [os.path.join(folder, x) for x in os.listdir(folder) if x.startswith(prefix)]
+    if not shards:
+        return
+    lines = []
+    for shard in shards:
+        with open(shard, 'r') as shard_file:
+            lines.extend(line if line.endswith('\n') else line + '\n' for line in shard_file)
+    lines.sort(key=_line_time)
+    with open(filename, 'a') as log:
+        log.write(''.join(lines))
+    for shard in shards:
+        os.remove(shard)
+
+
+def _line_time(line):
+    try:
+        return json.loads(line).get('start', '')
+    except (ValueError, AttributeError):
+        return ''
+
+
+class JsonLinesSink(object):
+    """Append records to a JSON Lines file, buffering the writes and rotating the file.
+
+    Records are written once max_buffer bytes are buffered, when a record is added more
+    than flush_interval seconds after the last write, when force is set or when flush is
+    called. There is no timer, a record that is not followed by another one stays buffered
+    until flush is called. Once the file is larger than max_bytes it is renamed to
+    <filename>.<n>, using the first n that is not used yet, and a new file is started.
+    Each write appends whole lines while holding a lock on the file, so threads and
+    processes can share the same file. If the process is forked the child will open the
+    file again and drop the records buffered by the parent.
+
+    Keyword arguments:
+    filename -- file the records are appended to
+    max_bytes -- size of the file before it is rotated, 0 never rotates the file
+    flush_interval -- seconds after the last write after which a record is written right away
+    max_buffer -- number of bytes buffered before the records are written
+    mode -- permissions of the file when it is created
+    """
+
+    def __init__(self, filename, max_bytes=0, flush_interval=1, max_buffer=64 * 1024, mode=0o644):
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.flush_interval = flush_interval
+        # never buffer more than fits in a file
+        self.max_buffer = min(max_buffer, max_bytes) if max_bytes else max_buffer
+        self.fd = None
+        self.buffer = []
+        self.size = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def write(self, line, force=False):
+        """Add a line of JSON, without newline, to the file, force writes it right away."""
+        with self.lock:
+            self._check_fork()
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            self.buffer.append(line)
+            self.buffer.append(b'\n')
+            self.size += len(line) + 1
+            if force or self.size >= self.max_buffer or time.time() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """Write all buffered records to the file."""
+        with self.lock:
+            self._check_fork()
+            self._flush()
+
+    def close(self):
+        """Write all buffered records and close the file."""
+        with self.lock:
+            self._check_fork()
+            self._flush()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            # forked, the file and records belong to the parent
+            self.fd = None
+            self.buffer = []
+            self.size = 0
+            self.pid = os.getpid()
+
+    def _flush(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.last_flush = time.time()
+        if not data:
+            return
+
+        while True:
+            if self.fd is None:
+                self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, self.mode)
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                # the file could have been rotated while waiting for the lock
+                try:
+                    current = os.stat(self.filename).st_ino
+                except OSError:
+                    current = None
+                if current != os.fstat(self.fd).st_ino:
+                    os.close(self.fd)
+                    self.fd = None
+                    continue
+                size = os.fstat(self.fd).st_size
+                if self.max_bytes and size and size + len(data) > self.max_bytes:
+                    self._rotate()
+                    continue
+                while data:
+                    data = data[os.write(self.fd, data):]
+                return
+            finally:
+                if fcntl and self.fd is not None:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _rotate(self):
+        """Rename the file, while holding its lock, and close it."""
+        index = 1
+        while os.path.exists("%s.%d" % (self.filename, index)):
+            index += 1
+        os.rename(self.filename, "%s.%d" % (self.filename, index))
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+def upload_progress(connector, resource, message, step=10):
+    """Create a MultipartEncoder callback that sends a status update every step percent.
+
+    Keyword arguments:
+    connector -- connector used to send the status updates
+    resource -- descriptor object with {"type", "id"} fields
+    message -- message send, followed by the percentage uploaded
+    step -- the percentage between status updates
+    """
+    reported = [0]
+
+    def callback(bytes_read, total):
+        percentage = 100 * bytes_read // total if total else 100
+        if percentage >= reported[0] + step:
+            reported[0] = percentage - percentage % step
+            connector.status_update(StatusMessage.processing, resource, "%s %d%%" % (message, reported[0]))
+
+    return callback
+
+
 def iso8601time():
     if time.daylight == 0:
         tz = str.format('{0:+06.2f}', -float(time.timezone) / 3600).replace('.', ':')
@@ -59,6 +519,25 @@ def iso8601time():
     return now.isoformat() + tz
 
 
+def get_rss():
+    """Return the resident memory of this process in bytes.
+
+    This uses /proc if available, otherwise the peak resident memory is returned.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, mac os x bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
 def setup_logging(config_info=None):
     """Given config_info setup logging.
 
@@ -130,3 +609,163 @@ def extract_zip_contents(zipfilepath):
             file_list.append(os.path.join(root, currfile))
 
     return file_list
+
+
+def match_file_types(filename, file_types):
+    """Check if the filename matches any of the file types.
+
+    A file type is either an extension starting with a '.' (such as .tif) or a
+    mime type that can contain wildcards (such as image/*). If file_types is None
+    all files will match.
+
+    Keyword arguments:
+    filename -- name of the file to check
+    file_types -- list of extensions and mime types
+    """
+    if file_types is None:
+        return True
+
+    extension = os.path.splitext(filename)[1].lower()
+    mimetype = mimetypes.guess_type(filename)[0]
+    for file_type in file_types:
+        if file_type.startswith('.'):
+            if extension == file_type.lower():
+                return True
+        elif mimetype and fnmatch.fnmatch(mimetype, file_type):
+            return True
+    return False
+
+
+class _ZipStreamReader(object):
+    """Read exact amounts of data from a stream, with support for pushing data back."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b''
+
+    def read_some(self, size):
+        """Read up to size bytes, returns an empty string at the end of the stream."""
+        if self.buffer:
+            data = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return data
+        return self.stream.read(size)
+
+    def read(self, size):
+        """Read exactly size bytes."""
+        data = b''
+        while len(data) < size:
+            chunk = self.read_some(size - len(data))
+            if not chunk:
+                raise EOFError("Unexpected end of zip stream")
+            data += chunk
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+# pylint: disable=too-many-locals,too-many-branches,too-many-statements
+def stream_zip_contents(stream, output_folder, file_types=None, chunk_size=64*1024):
+    """Extract a zipfile while it is read from stream and yield the path of each extracted file.
+
+    The zipfile is never stored on disk, each entry is written to output_folder as soon
+    as it is read. This reads the local headers in the zipfile, so it works for zipfiles
+    that are created while streaming, such as the dataset download from clowder.
+
+    Keyword arguments:
+    stream -- file-like object to read the zipfile from
+    output_folder -- folder to extract the files into
+    file_types -- only extract files matching these extensions or mime types (see
+                  match_file_types), metadata files (*_metadata.json) are always extracted
+    chunk_size -- size of the blocks read from the stream
+    """
+
+    reader = _ZipStreamReader(stream)
+    output_folder = os.path.abspath(output_folder)
+
+    while True:
+        signature = reader.read_some(4)
+        if len(signature) < 4:
+            signature += reader.read(4 - len(signature))
+        if signature != b'PK\x03\x04':
+            # central directory, no more files
+            break
+
+        (_, flags, method, _, _, crc, compressed_size, size, name_length, extra_length) = \
+            struct.unpack('<HHHHHIIIHH', reader.read(26))
+        name = reader.read(name_length)
+        extra = reader.read(extra_length)
+        name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+
+        # sizes are stored in the zip64 extra field if they do not fit
+        zip64 = False
+        while len(extra) >= 4:
+            (header_id, data_size) = struct.unpack('<HH', extra[:4])
+            if header_id == 0x0001:
+                zip64 = True
+                if size == 0xFFFFFFFF and data_size >= 8:
+                    size = struct.unpack('<Q', extra[4:12])[0]
+                if compressed_size == 0xFFFFFFFF and data_size >= 16:
+                    compressed_size = struct.unpack('<Q', extra[12:20])[0]
+            extra = extra[4 + data_size:]
+
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise zipfile.BadZipfile("Unsupported compression method %d for %s" % (method, name))
+        has_descriptor = (flags & 0x08) != 0
+        if has_descriptor and method == zipfile.ZIP_STORED:
+            raise zipfile.BadZipfile("Can not stream stored file %s without size" % name)
+
+        # same checks as extractall to make sure we stay in the output folder
+        path = None
+        if not name.endswith('/') and (name.endswith('_metadata.json') or match_file_types(name, file_types)):
+            path = os.path.normpath(os.path.join(output_folder, name.lstrip('/\\')))
+            if not path.startswith(output_folder + os.sep):
+                raise zipfile.BadZipfile("Invalid path %s in zipfile" % name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+        output = open(path, 'wb') if path else None
+        try:
+            checksum = 0
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else None
+            remaining = None if has_descriptor else compressed_size
+            while remaining is None or remaining > 0:
+                chunk = reader.read_some(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    raise EOFError("Unexpected end of zip stream")
+                if remaining is not None:
+                    remaining -= len(chunk)
+                if decompressor:
+                    data = decompressor.decompress(chunk)
+                    if decompressor.unused_data:
+                        # end of the compressed data, rest belongs to the next entry
+                        reader.unread(decompressor.unused_data)
+                        remaining = 0
+                else:
+                    data = chunk
+                if data:
+                    checksum = zlib.crc32(data, checksum)
+                    if output:
+                        output.write(data)
+            if decompressor:
+                data = decompressor.flush()
+                if data:
+                    checksum = zlib.crc32(data, checksum)
+                    if output:
+                        output.write(data)
+        finally:
+            if output:
+                output.close()
+
+        if has_descriptor:
+            descriptor = reader.read(4)
+            if descriptor == b'PK\x07\x08':
+                descriptor = reader.read(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            reader.read(16 if zip64 else 8)
+        if (checksum & 0xFFFFFFFF) != crc:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %s" % name)
+
+        if path:
+            yield path
@@ -8,7 +8,7 @@ setup(
 
     install_requires=[
         'enum34',
-        'pika',
+        'pika>=0.12.0',
         'PyYAML',
         'requests',
     ],